@@ -2,25 +2,42 @@
 Main app module.
 Initializes the application and starts the uvicorn server.
 """
-from collections import defaultdict, Counter
+import argparse
+import asyncio
+from collections import defaultdict
+import csv
+from datetime import datetime, timedelta
+import functools
+import hmac
+import importlib.util
 import io
+import itertools
+import os
+import time
 from typing import Optional, List
-from fastapi import FastAPI, Request, Query, Depends
-from fastapi.responses import HTMLResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-import pandas as pd
+from fastapi import FastAPI, Request, Response, Query, Depends, Header, HTTPException
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
+from jinja2 import pass_context
 from sqlalchemy.orm import Session
-import uvicorn
 
-from db_utils import models, crud, schemas
+from db_utils import crud, database, migrations, schemas, statistics
 from db_utils.database import SessionLocal, engine
-from utils import constants, create_db_folder
+from db_utils.executor import run_in_db_executor
+from db_utils.snapshot import SnapshotStore
+from utils import constants, create_db_folder, dump_json, QueryCache
+from utils import build_etag, http_date, is_not_modified
+from utils.compression import CompressionMiddleware
+from utils.ingest import AdParser, INGEST_FORMATS, iter_line_batches
+from utils.location_search import location_index
+from utils.instrumentation import InstrumentationMiddleware, METRICS
+from utils.instrumentation import phase, query_phase, record_rows
+from utils.profiling import ProfilingMiddleware
+from utils.static import PrecompressedStaticFiles
+from utils.templating import build_templates, precompile_templates, CardRenderer
 
 
-# prepare directory and build the database
-create_db_folder()
-models.Base.metadata.create_all(bind=engine)
+# Read-only snapshots of the database, only read in the snapshot mode
+snapshots = SnapshotStore(constants.SNAPSHOT_DIR, keep=constants.SNAPSHOT_KEEP)
 
 
 # Dependency
@@ -28,17 +45,147 @@ def get_db():
     """
     It creates a database connection, and then yields it to the caller.
     The caller can then use the connection, and when it's done, the connection is closed.
+    In the snapshot mode the connection reads the published snapshot, the live database
+    is read until the first snapshot is published.
     """
-    database = SessionLocal()
+    bind = snapshots.engine() if constants.SNAPSHOT_MODE else None
+    session = SessionLocal(bind=bind) if bind is not None else SessionLocal()
     try:
-        yield database
+        yield session
     finally:
-        database.close()
+        session.close()
+
+
+def get_writer_db():
+    """
+    It yields a connection to the live database, for the endpoints writing to it.
+    """
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+# Results of the ads queries, valid until the crawler changes the data
+query_cache = QueryCache(max_entries=constants.QUERY_CACHE_MAX_ENTRIES,
+                         max_weight=constants.QUERY_CACHE_MAX_ROWS,
+                         ttl=constants.QUERY_CACHE_TTL)
+
+
+def _cached(db_session, key, compute, weigh=lambda value: 1):
+    """
+    It returns the cached result of the query for the key, computing it again only when the
+    data in the database has changed since it was cached.
+    Results of databases without a data version (in memory ones) are not cached.
+    """
+    def _timed_compute():
+        with query_phase():
+            return compute()
+
+    version = database.data_version(db_session.get_bind())
+    if version is None:
+        return _timed_compute()
+    return query_cache.get_or_compute(key, version, _timed_compute, weigh)
+
+
+def _page_weight(page):
+    """
+    It weighs a (rows, next_cursor) page by its amount of rows
+    """
+    return len(page[0]) + 1
+
+
+def _data_validators(request, db_session):
+    """
+    It computes the ETag and the Last-Modified time of the response to the request, out of the
+    fingerprint of the data in the database and the path and query parameters of the request.
+    The fingerprint is the same in every process, so the ETags of one worker (or of the
+    process before a restart) are validated correctly by the others.
+    Returns None for databases without a data version.
+    """
+    bind = db_session.get_bind()
+    fingerprint = database.data_fingerprint(bind)
+    if fingerprint is None:
+        return None
+    query = sorted(request.query_params.multi_items())
+    return build_etag(fingerprint, request.url.path, query), database.data_last_modified(bind)
+
+
+async def _conditional(http_request, session, func, /, **kwargs):
+    """
+    It answers the conditional requests of the clients that already have the current data with
+    304 Not Modified, without running the queries or rendering the template.
+    Otherwise it builds the response with func in the database thread pool and adds
+    the validators to it. The keyword arguments of func may repeat the request and the session.
+    """
+    validators = await run_in_db_executor(_data_validators, http_request, session)
+    if validators is None:
+        return await run_in_db_executor(func, **kwargs)
+    etag, last_modified = validators
+    # The clients have to revalidate their copy on every use
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    if is_not_modified(http_request.headers, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response = await run_in_db_executor(func, **kwargs)
+    response.headers.update(headers)
+    return response
 
 
 app = FastAPI()
-app.mount("/static", StaticFiles(directory=constants.STATIC_DIR), name="static")
-templates = Jinja2Templates("templates")
+app.add_middleware(ProfilingMiddleware, admin_token=constants.ADMIN_TOKEN,
+                   interval=constants.PROFILE_INTERVAL_MS / 1000)
+app.add_middleware(CompressionMiddleware, minimum_size=constants.GZIP_MIN_SIZE,
+                   compresslevel=constants.GZIP_LEVEL)
+# Outermost, so the measured time includes the compression
+app.add_middleware(InstrumentationMiddleware)
+static_files = PrecompressedStaticFiles(directory=constants.STATIC_DIR)
+app.mount("/static", static_files, name="static")
+templates = build_templates("templates", auto_reload=constants.TEMPLATES_AUTO_RELOAD)
+
+
+@pass_context
+def static_url(context, path):
+    """
+    Template function returning the content hashed URL of a static file
+    """
+    return static_files.url(context["request"], path)
+
+
+templates.env.globals["static_url"] = static_url
+card_renderer = CardRenderer(templates.env, "_card.html", max_entries=constants.CARD_CACHE_SIZE)
+
+
+@functools.lru_cache(maxsize=None)
+def prepare_database():
+    """
+    It creates the data folder and upgrades the database, once per process.
+    """
+    create_db_folder()
+    migrations.migrate(engine)
+
+
+def prepare_snapshot():
+    """
+    It publishes the first snapshot of the database in the snapshot mode, the next ones are
+    published by the ingest once per crawl run (or by python -m db_utils.snapshot).
+    """
+    if constants.SNAPSHOT_MODE and snapshots.published() is None:
+        snapshots.build(engine)
+
+
+@app.on_event("startup")
+def startup():
+    """
+    It prepares the process for the first request. Nothing is done when the module is imported,
+    so the imports by the tests, the tools and the server workers stay cheap.
+    """
+    if constants.MIGRATE_ON_STARTUP:
+        prepare_database()
+    prepare_snapshot()
+    precompile_templates(templates, cache_dir=constants.TEMPLATE_CACHE_DIR)
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -54,11 +201,12 @@ async def read_homepage(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
-def _build_summary_dict(dataset) -> Counter:
+def _build_summary_dict(source_counts) -> dict:
     """
-    It takes a dataset and returns a dictionary of the number of listings per source
+    It completes the number of listings per source with the sources that have no listings
 
-    :param dataset: a list of tuples, where each tuple is a listing and its source
+    :param source_counts: dictionary of source names and their number of listings
+                          as returned by crud.count_ads_by_source
     :return: A dictionary with the source as the key and the number of listings as the value.
     """
     all_sources = defaultdict(int)
@@ -66,179 +214,752 @@ def _build_summary_dict(dataset) -> Counter:
         # Initialize the value for all sources
         all_sources[source.value] = 0
     # collect the sources that have listings
-    sources = [data.source_name for data in dataset]
-    source_counter = Counter(sources)
-    all_sources.update(source_counter)
+    all_sources.update(source_counts)
     return all_sources
 
 
-def _save_to_csv(data, filename="export.csv"):
+FIELDS_DESCRIPTION = ("Comma separated ad fields to be returned, all of them by default: "
+                      + ", ".join(crud.EXPORT_COLUMNS))
+# Column headers of the exported CSV files, in the order of crud.EXPORT_COLUMNS
+CSV_HEADER = ("id", "Свалено от", "Цена", "Квартал", "Големина в кв.м.",
+              "Тип на имота", "URL", "Снимка", "Намерено на дата")
+# The exported CSV can be ingested again
+CSV_HEADER_COLUMNS = dict(zip(CSV_HEADER, crud.EXPORT_COLUMNS))
+# Amount of rows fetched and written per streamed CSV chunk
+CSV_CHUNK_SIZE = 1000
+# Path of the cards fragment of an ads page, relative to the page
+CARDS_PATH_SUFFIX = "/cards"
+
+
+def _csv_chunk(rows, chunk_size=CSV_CHUNK_SIZE) -> str:
+    """
+    It takes the next chunk_size rows from the rows iterator and returns them as CSV text
+
+    :param rows: iterator over the exported row tuples
+    :param chunk_size: the amount of rows to be written
+    :return: the CSV text of the chunk or an empty string when the rows are exhausted.
     """
-    It takes a list of objects and converts them to a list of dictionaries,
-    then it converts the list of dictionaries to a pandas dataframe and
-    then it converts the dataframe to a csv file and returns it as a response
+    with query_phase():
+        chunk_rows = list(itertools.islice(rows, chunk_size))
+    record_rows(len(chunk_rows))
+    with phase("serialize"):
+        stream = io.StringIO()
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerows(chunk_rows)
+        return stream.getvalue()
 
-    :param data: the list of ads objects
+
+async def _stream_csv(rows):
+    """
+    It yields the CSV header followed by the rows, chunk by chunk.
+    Every chunk is fetched and formatted in the database thread pool.
+    """
+    header = io.StringIO()
+    csv.writer(header, lineterminator="\n").writerow(CSV_HEADER)
+    yield header.getvalue()
+    while True:
+        chunk = await run_in_db_executor(_csv_chunk, rows, CSV_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _save_to_csv(rows, filename="export.csv"):
+    """
+    It streams the rows to the client as a csv file without building the whole file in memory
+
+    :param rows: iterator over the ads row tuples as returned by crud.stream_ads
     :param filename: The name of the file that will be downloaded, defaults to export.csv (optional)
     :return: A StreamingResponse object.
     """
-    # Convert the ads objects to a list of regular dictionaries and remove unneccesary keys
-    ad_list = []
-    for each_ad in data:
-        ad_list.append({"id": each_ad.id,
-                        "Свалено от": each_ad.source_name,
-                        "Цена": each_ad.price,
-                        "Квартал": each_ad.location,
-                        "Големина в кв.м.": each_ad.home_size,
-                        "Тип на имота": each_ad.home_type,
-                        "URL": each_ad.url,
-                        "Снимка": each_ad.image,
-                        "Намерено на дата": each_ad.scraping_date})
-    data_frame = pd.DataFrame(ad_list)
-    stream = io.StringIO()
-    data_frame.to_csv(stream, index=False)
-    response = StreamingResponse(iter([stream.getvalue()]),
-                                 media_type="text/csv")
+    response = StreamingResponse(_stream_csv(rows), media_type="text/csv")
     response.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return response
 
 
-def _read_ads(source_name, price, location, home_size,  # pylint: disable=R0913
-              home_type, limit, db_session, only_new_ads=False):
-    filters_list = [source_name, price, home_size, home_type, location]
-    filtered = (param for param in filters_list if param is not None)
-    if any(filtered):
+def ad_filters(source_name: Optional[List[constants.AdSource]] = Query( # pylint: disable=R0913,R0914
+                   None, description="The source of the ads, can be repeated"),
+               location: Optional[List[constants.AdLocation]] = Query(
+                   None, description="The location of the ads, can be repeated"),
+               location_search: Optional[List[str]] = Query(
+                   None, max_length=100,
+                   description="Free text matched against the locations, in Cyrillic or Latin "
+                               "letters. A prefix stands for every location it starts, typos "
+                               "are tolerated. Can be repeated"),
+               home_type: Optional[List[constants.HomeType]] = Query(
+                   None, description="The home type of the ads, can be repeated"),
+               price: Optional[int] = Query(None, ge=1, description="Price lower than"),
+               home_size: Optional[int] = Query(None, ge=1, description="Home size bigger than"),
+               min_price: Optional[int] = Query(None, ge=1),
+               max_price: Optional[int] = Query(None, ge=1),
+               min_size: Optional[int] = Query(None, ge=1),
+               max_size: Optional[int] = Query(None, ge=1),
+               min_price_per_m2: Optional[float] = Query(None, gt=0),
+               max_price_per_m2: Optional[float] = Query(None, gt=0),
+               ) -> dict:
+    """
+    Dependency collecting the filters of the ads endpoints into the keyword arguments of
+    the crud queries. The repeated equality filters become sorted tuples of their values,
+    the missing filters are left out, so equal filters always give the same cache key.
+    The searched locations are resolved to the matching ones and added to the location filter.
+    """
+    filters = {"source_name": source_name, "location": location, "home_type": home_type}
+    filters = {name: {member.value for member in members}
+               for name, members in filters.items() if members}
+    for text in location_search or ():
+        matches = location_index().resolve(text)
+        if not matches:
+            raise HTTPException(status_code=422, detail=f"No location matches {text!r}")
+        filters.setdefault("location", set()).update(matches)
+    filters = {name: tuple(sorted(values)) for name, values in filters.items()}
+    bounds = {"price": price, "home_size": home_size,
+              "min_price": min_price, "max_price": max_price,
+              "min_size": min_size, "max_size": max_size,
+              "min_price_per_m2": min_price_per_m2, "max_price_per_m2": max_price_per_m2}
+    for name in ("price", "size", "price_per_m2"):
+        lower, upper = bounds[f"min_{name}"], bounds[f"max_{name}"]
+        if lower is not None and upper is not None and lower > upper:
+            raise HTTPException(status_code=422,
+                                detail=f"min_{name} is bigger than max_{name}")
+    filters.update((name, value) for name, value in bounds.items() if value is not None)
+    return filters
+
+
+def _filters_key(filters) -> tuple:
+    """
+    It returns the hashable cache key of the filters
+    """
+    return tuple(sorted(filters.items()))
+
+
+def _export_ads(db_session, filters, limit, only_new_ads):
+    """
+    It starts the streamed CSV export of the ads matching the filters
+    """
+    return _save_to_csv(crud.stream_ads(db_session=db_session, limit=limit,
+                                        only_new_ads=only_new_ads, **filters))
+
+
+def _decode_cursor(cursor):
+    """
+    It decodes the cursor query parameter and rejects the malformed ones with a 422 error
+    """
+    if cursor is None:
+        return None
+    try:
+        return crud.decode_cursor(cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail="Invalid cursor") from exc
+
+
+def _read_ads(filters, limit, db_session, only_new_ads=False, cursor=None):
+    """
+    It reads a single page of ads and returns it along with the cursor of the next page.
+    The next cursor is None when there are no more ads or no limit was given.
+    """
+    after = _decode_cursor(cursor)
+    # One extra row tells whether there is a next page
+    fetch_limit = limit + 1 if limit else None
+    if filters:
         my_ads = crud.get_filtered_ads(db_session=db_session,
-                                       source_name=source_name,
-                                       price=price,
-                                       location=location,
-                                       home_size=home_size,
-                                       home_type=home_type,
-                                       limit=limit,
-                                       only_new_ads=only_new_ads)
+                                       limit=fetch_limit,
+                                       only_new_ads=only_new_ads,
+                                       after=after,
+                                       **filters)
     else:
         my_ads = crud.get_ordered_ads(
-            db_session=db_session, limit=limit, only_new_ads=only_new_ads)
-    return my_ads
+            db_session=db_session, limit=fetch_limit, only_new_ads=only_new_ads, after=after)
+    return _split_page(my_ads, limit)
+
+
+def _split_page(my_ads, limit):
+    """
+    It cuts the extra row fetched beyond the limit and builds the next cursor out of the last ad
+    """
+    record_rows(len(my_ads))
+    next_cursor = None
+    if limit and len(my_ads) > limit:
+        my_ads = my_ads[:limit]
+        next_cursor = crud.encode_cursor(my_ads[-1])
+    return my_ads, next_cursor
+
+
+def _next_page_url(request, next_cursor):
+    """
+    It returns the URL of the next page (same filters, new cursor) or None on the last page
+    """
+    if next_cursor is None:
+        return None
+    return str(request.url.include_query_params(cursor=next_cursor))
+
+
+def _pagination_headers(next_url):
+    """
+    It returns the Link header pointing to the next page
+    """
+    return {"Link": f'<{next_url}>; rel="next"'} if next_url else {}
+
+
+def _next_card_urls(request, next_cursor):
+    """
+    It returns the URLs of the full next page and of its cards fragment, both with the
+    same filters, or (None, None) on the last page
+    """
+    if next_cursor is None:
+        return None, None
+    url = request.url.include_query_params(cursor=next_cursor)
+    page_path = url.path
+    if page_path.endswith(CARDS_PATH_SUFFIX):
+        page_path = page_path[:-len(CARDS_PATH_SUFFIX)]
+    return str(url.replace(path=page_path)), str(url.replace(path=page_path + CARDS_PATH_SUFFIX))
 
 
-def _display_ads(request, source_name, price, location,  # pylint: disable=R0913
-                 home_size, home_type, limit, db_session, only_new_ads=False):
+def _display_ads(request, filters, limit, db_session, # pylint: disable=R0913
+                 only_new_ads=False, cursor=None, fragment=False):
+    """
+    It renders a page of ads as cards, the whole HTML page or only the cards fragment
+    fetched by the page when the user scrolls to its end.
+    """
+    filters_key = _filters_key(filters)
     # my_ads is a list of Ads objects. The attributes are the db columns
-    my_ads = _read_ads(source_name, price, location,
-                       home_size, home_type, limit, db_session, only_new_ads)
-    dict_param = {"request": request, "ad_list": my_ads, "show_summary": False}
+    my_ads, next_cursor = _cached(
+        db_session, ("page", only_new_ads, filters_key, limit, cursor),
+        lambda: _read_ads(filters, limit, db_session, only_new_ads, cursor),
+        _page_weight)
+    next_url, next_fragment_url = _next_card_urls(request, next_cursor)
+    dict_param = {"request": request, "ad_list": my_ads, "show_summary": False,
+                  "next_url": next_url, "next_fragment_url": next_fragment_url}
+    with phase("render"):
+        # The cards of the ads shown since the last change of the data are not rendered again
+        dict_param["cards"] = card_renderer.render(
+            my_ads, database.data_version(db_session.get_bind()))
+    if fragment:
+        with phase("render"):
+            return templates.TemplateResponse("_cards.html", dict_param,
+                                              headers=_pagination_headers(next_fragment_url))
     if only_new_ads:
-        summary = _build_summary_dict(my_ads)
+        # The summary counts every matching ad, not only the ones on the current page
+        source_counts = _cached(
+            db_session, ("summary", only_new_ads, filters_key),
+            lambda: crud.count_ads_by_source(db_session=db_session,
+                                             only_new_ads=only_new_ads,
+                                             **filters))
+        summary = _build_summary_dict(source_counts)
         dict_param["summary_data"] = summary
         dict_param["show_summary"] = True
-    return templates.TemplateResponse("ads.html", dict_param)
+    with phase("render"):
+        return templates.TemplateResponse("ads.html", dict_param,
+                                          headers=_pagination_headers(next_url))
+
+
+def _parse_fields(fields):
+    """
+    It validates the comma separated list of requested columns, all of them by default
+    """
+    if not fields:
+        return crud.EXPORT_COLUMNS
+    names = tuple(name.strip() for name in fields.split(",") if name.strip())
+    invalid = [name for name in names if name not in crud.EXPORT_COLUMNS]
+    if invalid or not names:
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid fields: {', '.join(invalid)}. "
+                                   f"Allowed fields: {', '.join(crud.EXPORT_COLUMNS)}")
+    return names
+
+
+def _ads_page(request, fields, filters, limit, db_session, # pylint: disable=R0913
+              only_new_ads=False, cursor=None):
+    """
+    It reads a page of ads as plain rows holding only the requested fields and serializes it
+    straight to JSON, without ORM objects and per row pydantic validation.
+    """
+    after = _decode_cursor(cursor)
+    # The sort key columns are needed for the next cursor even if they were not requested
+    columns = fields + tuple(column for column in crud.SORT_KEY if column not in fields)
+    rows, next_cursor = _cached(
+        db_session,
+        ("rows", only_new_ads, columns, _filters_key(filters), limit, after),
+        lambda: _split_page(crud.get_ads_rows(db_session=db_session,
+                                              columns=columns,
+                                              limit=limit + 1,
+                                              only_new_ads=only_new_ads,
+                                              after=after,
+                                              **filters), limit),
+        _page_weight)
+    next_url = _next_page_url(request, next_cursor)
+    field_count = len(fields)
+    with phase("serialize"):
+        items = [dict(zip(fields, row[:field_count])) for row in rows]
+        body = dump_json({"items": items, "next_cursor": next_cursor, "next": next_url})
+    return Response(body, media_type="application/json",
+                    headers=_pagination_headers(next_url))
 
 
 @app.get("/new-ads", response_class=HTMLResponse, response_model=List[schemas.NewAds])
 async def read_new_ads(request: Request,  # pylint: disable=R0913
-                       source_name: Optional[constants.AdSource] = None,
-                       price: Optional[int] = Query(None, ge=1),
-                       location: Optional[constants.AdLocation] = None,
-                       home_size: Optional[int] = Query(None, ge=1),
-                       home_type: Optional[constants.HomeType] = None,
-                       limit: Optional[int] = Query(None, ge=1),
+                       filters: dict = Depends(ad_filters),
+                       limit: int = Query(constants.ADS_PAGE_SIZE, ge=1,
+                                          le=constants.ADS_MAX_PAGE_SIZE),
+                       cursor: Optional[str] = None,
                        db_session: Session = Depends(get_db),
                        ):
     """
     Dispay function for all collected new ads with support for filters based on a set of
-    price, location, source, home_size, home_type.
+    price, location, source, home_size, home_type (see ad_filters).
+    Only the first page of cards is rendered, the next ones are loaded on scroll
+    from /new-ads/cards. The cursor continues from the page where the "next page" link was taken.
+    """
+    return await _conditional(request, db_session, _display_ads,
+                              request=request,
+                              filters=filters,
+                              limit=limit,
+                              db_session=db_session,
+                              only_new_ads=True,
+                              cursor=cursor)
+
+
+@app.get("/new-ads" + CARDS_PATH_SUFFIX, response_class=HTMLResponse)
+async def read_new_ads_cards(request: Request,  # pylint: disable=R0913
+                             filters: dict = Depends(ad_filters),
+                             limit: int = Query(constants.ADS_PAGE_SIZE, ge=1,
+                                                le=constants.ADS_MAX_PAGE_SIZE),
+                             cursor: Optional[str] = None,
+                             db_session: Session = Depends(get_db),
+                             ):
     """
-    return _display_ads(request=request,
-                        source_name=source_name,
-                        price=price, location=location,
-                        home_size=home_size,
-                        home_type=home_type,
-                        limit=limit,
-                        db_session=db_session,
-                        only_new_ads=True)
+    It returns only the cards of a page of the new ads, as an HTML fragment appended to
+    the /new-ads page.
+    """
+    return await _conditional(request, db_session, _display_ads,
+                              request=request,
+                              filters=filters,
+                              limit=limit,
+                              db_session=db_session,
+                              only_new_ads=True,
+                              cursor=cursor,
+                              fragment=True)
 
 
 @app.get("/all-ads", response_class=HTMLResponse, response_model=List[schemas.Ads])
 async def read_all_ads(request: Request,  # pylint: disable=R0913
-                       source_name: Optional[constants.AdSource] = None,
-                       price: Optional[int] = Query(None, ge=1),
-                       location: Optional[constants.AdLocation] = None,
-                       home_size: Optional[int] = Query(None, ge=1),
-                       home_type: Optional[constants.HomeType] = None,
-                       limit: Optional[int] = Query(None, ge=1, le=100),
+                       filters: dict = Depends(ad_filters),
+                       limit: int = Query(constants.ADS_PAGE_SIZE, ge=1,
+                                          le=constants.ADS_MAX_PAGE_SIZE),
+                       cursor: Optional[str] = None,
                        db_session: Session = Depends(get_db),
                        ):
     """
     Dispay function for all collected ads with support for filters based on a set of
-    price, location, source, home_size, home_type.
+    price, location, source, home_size, home_type (see ad_filters).
+    Only the first page of cards is rendered, the next ones are loaded on scroll
+    from /all-ads/cards. The cursor continues from the page where the "next page" link was taken.
+    """
+    return await _conditional(request, db_session, _display_ads,
+                              request=request,
+                              filters=filters,
+                              limit=limit,
+                              db_session=db_session,
+                              cursor=cursor)
+
+
+@app.get("/all-ads" + CARDS_PATH_SUFFIX, response_class=HTMLResponse)
+async def read_all_ads_cards(request: Request,  # pylint: disable=R0913
+                             filters: dict = Depends(ad_filters),
+                             limit: int = Query(constants.ADS_PAGE_SIZE, ge=1,
+                                                le=constants.ADS_MAX_PAGE_SIZE),
+                             cursor: Optional[str] = None,
+                             db_session: Session = Depends(get_db),
+                             ):
+    """
+    It returns only the cards of a page of the ads, as an HTML fragment appended to
+    the /all-ads page.
+    """
+    return await _conditional(request, db_session, _display_ads,
+                              request=request,
+                              filters=filters,
+                              limit=limit,
+                              db_session=db_session,
+                              cursor=cursor,
+                              fragment=True)
+
+
+@app.get("/api/new-ads", response_class=Response,
+         responses={200: {"model": schemas.AdsPage, "content": {"application/json": {}}}})
+async def read_new_ads_json(request: Request,  # pylint: disable=R0913
+                            fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+                            filters: dict = Depends(ad_filters),
+                            limit: int = Query(constants.ADS_PAGE_SIZE, ge=1,
+                                               le=constants.ADS_MAX_PAGE_SIZE),
+                            cursor: Optional[str] = None,
+                            db_session: Session = Depends(get_db),
+                            ):
+    """
+    JSON variant of the new-ads endpoint. Returns one page of ads and the link to the next one.
+    Only the requested fields of the ads are selected and returned.
     """
-    return _display_ads(request=request,
-                        source_name=source_name,
-                        price=price,
-                        location=location,
-                        home_size=home_size,
-                        home_type=home_type,
-                        limit=limit,
-                        db_session=db_session)
+    return await _conditional(request, db_session, _ads_page,
+                              request=request,
+                              fields=_parse_fields(fields),
+                              filters=filters,
+                              limit=limit,
+                              db_session=db_session,
+                              only_new_ads=True,
+                              cursor=cursor)
+
+
+@app.get("/api/ads", response_class=Response,
+         responses={200: {"model": schemas.AdsPage, "content": {"application/json": {}}}})
+async def read_all_ads_json(request: Request,  # pylint: disable=R0913
+                            fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+                            filters: dict = Depends(ad_filters),
+                            limit: int = Query(constants.ADS_PAGE_SIZE, ge=1,
+                                               le=constants.ADS_MAX_PAGE_SIZE),
+                            cursor: Optional[str] = None,
+                            db_session: Session = Depends(get_db),
+                            ):
+    """
+    JSON variant of the all-ads endpoint. Returns one page of ads and the link to the next one.
+    Only the requested fields of the ads are selected and returned.
+    """
+    return await _conditional(request, db_session, _ads_page,
+                              request=request,
+                              fields=_parse_fields(fields),
+                              filters=filters,
+                              limit=limit,
+                              db_session=db_session,
+                              cursor=cursor)
 
 
 @app.get("/download-all-ads", response_model=List[schemas.Ads])
-async def download_all_ads(source_name: Optional[constants.AdSource] = None,  # pylint: disable=R0913
-                           price: Optional[int] = Query(None, ge=1),
-                           location: Optional[constants.AdLocation] = None,
-                           home_size: Optional[int] = Query(None, ge=1),
-                           home_type: Optional[constants.HomeType] = None,
+async def download_all_ads(request: Request,  # pylint: disable=R0913
+                           filters: dict = Depends(ad_filters),
                            limit: Optional[int] = Query(None, ge=1),
                            db_session: Session = Depends(get_db),
                            ):
     """
     Download API endpoint function for all collected ads with support for filters based on a set of
-    price, location, source, home_size, home_type.
+    price, location, source, home_size, home_type (see ad_filters).
     """
-    my_ads = _read_ads(source_name, price, location, home_size,
-                       home_type, limit, db_session, only_new_ads=False)
-    return _save_to_csv(my_ads)
+    return await _conditional(request, db_session, _export_ads,
+                              db_session=db_session,
+                              filters=filters,
+                              limit=limit,
+                              only_new_ads=False)
 
 
 @app.get("/download-new-ads", response_model=List[schemas.NewAds])
-async def download_new_ads(source_name: Optional[constants.AdSource] = None,  # pylint: disable=R0913
-                           price: Optional[int] = Query(None, ge=1),
-                           location: Optional[constants.AdLocation] = None,
-                           home_size: Optional[int] = Query(None, ge=1),
-                           home_type: Optional[constants.HomeType] = None,
+async def download_new_ads(request: Request,  # pylint: disable=R0913
+                           filters: dict = Depends(ad_filters),
                            limit: Optional[int] = Query(None, ge=1),
                            db_session: Session = Depends(get_db),
                            ):
     """
     Download API endpoint function for new ads with support for filters based on a set of
-    price, location, source, home_size, home_type.
+    price, location, source, home_size, home_type (see ad_filters).
+    """
+    return await _conditional(request, db_session, _export_ads,
+                              db_session=db_session,
+                              filters=filters,
+                              limit=limit,
+                              only_new_ads=True)
+
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    """
+    Dependency refusing the requests without the configured admin token with 403.
+    The admin endpoints are disabled when no admin token is configured.
+    """
+    if not constants.ADMIN_TOKEN or x_admin_token is None or \
+            not hmac.compare_digest(x_admin_token.encode("latin-1"),
+                                    constants.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="A valid admin token is needed")
+
+
+INGEST_STATS = ("lines", "rows", "rejected", "inserted", "updated", "unchanged")
+
+
+def _ingest_batch(parser, lines, db_session, crawl_run) -> dict:
+    """
+    It parses and validates the lines and upserts their valid listings in a transaction
+
+    :return: the stats of the batch.
+    """
+    start = time.perf_counter()
+    rejected = parser.rejected
+    rows = parser.parse(lines)
+    if rows:
+        stats = crud.upsert_ads(db_session, rows, crawl_run)
+    else:
+        stats = {"inserted": 0, "updated": 0, "unchanged": 0}
+    return {"lines": len(lines), "rows": len(rows), "rejected": parser.rejected - rejected,
+            **stats, "seconds": round(time.perf_counter() - start, 4)}
+
+
+@app.post("/api/ingest", dependencies=[Depends(require_admin_token)])
+async def ingest_ads(request: Request,
+                     crawl_run: Optional[int] = Query(
+                         None, ge=1, description="Continue the given unfinished crawl run "
+                                                 "instead of starting a new one"),
+                     finish: bool = Query(
+                         True, description="Finish the crawl run once the body is stored, "
+                                           "its listings become the new ones"),
+                     db_session: Session = Depends(get_writer_db),
+                     ):
+    """
+    Bulk ingest endpoint of the crawler, needs the admin token in the X-Admin-Token header.
+    The body holds one listing per line, as NDJSON (application/x-ndjson) or as CSV with
+    a header line (text/csv). The listings are upserted by their url in batches of
+    IMOT_INGEST_BATCH_SIZE lines, the invalid lines are skipped and reported back.
+    In the snapshot mode a finished crawl run publishes a new snapshot for the readers.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    content_format = INGEST_FORMATS.get(content_type)
+    if content_format is None:
+        raise HTTPException(status_code=415,
+                            detail=f"Unsupported content type. Supported content types: "
+                                   f"{', '.join(INGEST_FORMATS)}")
+    if crawl_run is None:
+        crawl_run = await run_in_db_executor(crud.start_crawl_run, db_session)
+    else:
+        existing_run = await run_in_db_executor(crud.get_crawl_run, db_session, crawl_run)
+        if existing_run is None:
+            raise HTTPException(status_code=404, detail="Unknown crawl run")
+        if existing_run.finished_at is not None:
+            raise HTTPException(status_code=409, detail="The crawl run is already finished")
+
+    parser = AdParser(content_format, CSV_HEADER_COLUMNS)
+    batches = []
+    pending = None
+    try:
+        async for lines in iter_line_batches(request.stream(), constants.INGEST_BATCH_SIZE):
+            if pending is not None:
+                batches.append(await pending)
+            # The next lines are received while the batch is written
+            pending = asyncio.ensure_future(
+                run_in_db_executor(_ingest_batch, parser, lines, db_session, crawl_run))
+        if pending is not None:
+            batches.append(await pending)
+            pending = None
+    finally:
+        if pending is not None and not pending.done():
+            # The session is closed after the endpoint, the write has to end first
+            await asyncio.wait([pending])
+    if finish:
+        await run_in_db_executor(crud.finish_crawl_run, db_session, crawl_run)
+        # Once per crawl run, the listings stored since the previous refresh are folded in
+        await run_in_db_executor(statistics.refresh_statistics, db_session.get_bind())
+    snapshot = None
+    if finish and constants.SNAPSHOT_MODE:
+        snapshot = os.path.basename(
+            await run_in_db_executor(snapshots.build, db_session.get_bind()))
+    return {"crawl_run": crawl_run,
+            "finished": finish,
+            "snapshot": snapshot,
+            "totals": {name: sum(batch[name] for batch in batches) for name in INGEST_STATS},
+            "batches": batches,
+            "errors": parser.errors}
+
+
+def _history_entry(crawl_run, started_at, price, price_change) -> dict:
+    return {"crawl_run": crawl_run, "date": started_at, "price": price,
+            "price_change": price_change}
+
+
+def _price_history(db_session, url):
+    """
+    It returns the price history of the listing as JSON, 404 when the url has no history
+    """
+    rows = _cached(db_session, ("price_history", url),
+                   lambda: crud.get_price_history(db_session, url), lambda rows: len(rows) + 1)
+    if not rows:
+        raise HTTPException(status_code=404, detail="No price history for the url")
+    with phase("serialize"):
+        body = dump_json({"url": url, "history": [_history_entry(*row) for row in rows]})
+    return Response(body, media_type="application/json")
+
+
+def _price_drops(db_session, locations, days, limit):
+    """
+    It returns the biggest price drops of the crawl runs started in the last days per location
+    as JSON. Only the locations with drops are listed.
+    """
+    since = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    since_run = crud.first_crawl_run_since(db_session, since)
+
+    def _query():
+        if since_run is None:
+            return {}
+        drops = {}
+        for location in locations:
+            rows = crud.get_price_drops(db_session, location, since_run, limit)
+            if rows:
+                drops[location] = rows
+        return drops
+
+    drops = _cached(db_session, ("price_drops", locations, since_run, limit), _query,
+                    lambda drops: sum(map(len, drops.values())) + 1)
+    with phase("serialize"):
+        body = dump_json({"since": since, "locations": {
+            location: [dict(_history_entry(crawl_run, started_at, price, price_change),
+                            url=url, previous_price=price - price_change)
+                       for url, crawl_run, started_at, price, price_change in rows]
+            for location, rows in drops.items()}})
+    return Response(body, media_type="application/json")
+
+
+@app.get("/api/price-history", response_class=Response,
+         responses={200: {"model": schemas.PriceHistory, "content": {"application/json": {}}}})
+async def read_price_history(request: Request,
+                             url: str = Query(..., description="The url of the listing"),
+                             db_session: Session = Depends(get_db),
+                             ):
+    """
+    It returns the prices of the listing seen by the crawl runs, from the oldest one.
+    A new entry is recorded only when the price of the listing changes.
+    """
+    return await _conditional(request, db_session, _price_history,
+                              db_session=db_session,
+                              url=url)
+
+
+@app.get("/api/price-drops", response_class=Response,
+         responses={200: {"model": schemas.PriceDrops, "content": {"application/json": {}}}})
+async def read_price_drops(location: Optional[constants.AdLocation] = None,
+                           days: int = Query(30, ge=1, description="Only the drops of the crawl "
+                                                                   "runs of the last days"),
+                           limit: int = Query(20, ge=1, le=100,
+                                              description="The amount of drops per location"),
+                           db_session: Session = Depends(get_db),
+                           ):
+    """
+    It returns the biggest recent price drops per location, of all locations by default.
+    """
+    locations = (location.value,) if location is not None else \
+        tuple(member.value for member in constants.AdLocation)
+    # Not conditional, the period moves on even when the data does not change
+    return await run_in_db_executor(_price_drops, db_session, locations, days, limit)
+
+
+@app.get("/api/locations", response_class=Response,
+         responses={200: {"model": schemas.LocationMatches,
+                          "content": {"application/json": {}}}})
+async def search_locations(q: str = Query(..., min_length=1, max_length=100,
+                                          description="Free text, in Cyrillic or Latin letters"),
+                           limit: int = Query(10, ge=1, le=50),
+                           ):
     """
-    my_ads = _read_ads(source_name, price, location, home_size,
-                       home_type, limit, db_session, only_new_ads=True)
-    return _save_to_csv(my_ads)
+    It returns the locations matching the text, the best matches first. The locations are
+    matched in memory, without a database query.
+    """
+    matches = location_index().search(q, limit)
+    return Response(dump_json({"query": q, "locations": [
+        {"location": location, "score": score} for location, score in matches]}),
+        media_type="application/json")
+
+
+def _data_page(request, db_session):
+    """
+    It renders the market statistics precomputed by the last refresh
+    """
+    stats = _cached(db_session, ("statistics",),
+                    lambda: statistics.get_statistics(db_session),
+                    lambda stats: len(stats["market"]) + len(stats["trend"]) + 1)
+    with phase("render"):
+        return templates.TemplateResponse("data.html", {"request": request, **stats})
 
 
 @app.get("/data", response_class=HTMLResponse)
-async def read_additional_data(request: Request):
+async def read_additional_data(request: Request, db_session: Session = Depends(get_db)):
     """
-    It returns a template response with the template data.html and the request object
+    It returns a template response with the template data.html, showing the market statistics
+    (price per square meter percentiles per location and home type, listings per source and
+    the trend of the latest crawl runs) which are refreshed once per crawl run
 
     :param request: The request object
     :type request: Request
     :return: a TemplateResponse object.
     """
-    return templates.TemplateResponse("data.html", {"request": request})
+    return await _conditional(request, db_session, _data_page,
+                              request=request,
+                              db_session=db_session)
 
 
-def run():
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    """
+    It returns the request and cache metrics in the Prometheus text format
+    """
+    cache_stats = query_cache.stats()
+    cache_metrics = [(f"imot_query_cache_{name}_total", "counter", cache_stats[name])
+                     for name in ("hits", "misses", "evictions", "invalidations")]
+    cache_metrics += [("imot_query_cache_entries", "gauge", cache_stats["entries"]),
+                      ("imot_query_cache_rows", "gauge", cache_stats["weight"])]
+    card_stats = card_renderer.stats()
+    cache_metrics += [("imot_card_cache_hits_total", "counter", card_stats["hits"]),
+                      ("imot_card_cache_misses_total", "counter", card_stats["misses"]),
+                      ("imot_card_cache_entries", "gauge", card_stats["entries"])]
+    return PlainTextResponse(METRICS.render(cache_metrics),
+                             media_type="text/plain; version=0.0.4")
+
+
+def _available(module, fallback) -> str:
+    """
+    It returns the name of the module when it is installed, else the fallback
+    """
+    return module if importlib.util.find_spec(module) is not None else fallback
+
+
+def _parse_server_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve the imot tracker.")
+    parser.add_argument("--dev", action="store_true",
+                        help="a single process reloading on the changes of the code")
+    parser.add_argument("--host", default=constants.HOST)
+    parser.add_argument("--port", type=int, default=constants.PORT)
+    parser.add_argument("--workers", type=int, default=constants.WORKERS)
+    parser.add_argument("--backlog", type=int, default=constants.BACKLOG)
+    parser.add_argument("--keep-alive", type=int, default=constants.KEEP_ALIVE)
+    parser.add_argument("--limit-concurrency", type=int, default=constants.LIMIT_CONCURRENCY)
+    return parser.parse_args(argv)
+
+
+def _server_options(args) -> dict:
+    """
+    It returns the keyword arguments of uvicorn.run for the parsed command line
+    """
+    options = {"host": args.host, "port": args.port, "log_level": "info",
+               "backlog": args.backlog, "timeout_keep_alive": args.keep_alive,
+               "limit_concurrency": args.limit_concurrency,
+               # uvloop and httptools are optional speedups of the event loop and HTTP parsing
+               "loop": _available("uvloop", "asyncio"),
+               "http": _available("httptools", "h11")}
+    if args.dev:
+        options["reload"] = True
+    else:
+        options["workers"] = max(1, args.workers)
+    return options
+
+
+def run(argv=None):
     """
     It starts a server on port 8000, and when you go to the URL http://localhost:8000/docs,
-    it will show you the documentation for the API
+    it will show you the documentation for the API.
+    By default it serves with IMOT_WORKERS processes (the CPU count), --dev serves with
+    a single process reloading on the changes of the code.
     """
-    config = uvicorn.Config("app:app", port=8000, log_level="info")
-    server = uvicorn.Server(config)
-    server.run()
+    import uvicorn # pylint: disable=C0415
+    options = _server_options(_parse_server_args(argv))
+    # The database is upgraded (and its first snapshot published) once, before the workers
+    # start, they only open connections.
+    # SQLite coordinates the connections of the processes.
+    prepare_database()
+    prepare_snapshot()
+    os.environ["IMOT_MIGRATE_ON_STARTUP"] = "0"
+    engine.dispose()
+    if options.get("workers") == 1:
+        # Served by this process, without importing the module once more
+        uvicorn.run(app, **options)
+    else:
+        uvicorn.run("app:app", **options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,3 @@
+"""
+Benchmarks and load tests for the app. They are not part of the regular pytest run.
+"""
@@ -0,0 +1,115 @@
+"""
+Benchmarks of the app helpers, the template rendering and the endpoints.
+"""
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.conftest import EXPORT_LIMIT
+from db_utils import crud
+from utils.templating import CardRenderer
+import app as main_app
+
+
+ENDPOINTS = ["/all-ads?limit=100",
+             "/all-ads?location=Младост 1A&home_type=Двустаен&price=150000&limit=100",
+             "/new-ads?limit=100",
+             "/new-ads?source_name=era&home_size=60&limit=100",
+             "/api/ads?limit=100",
+             "/api/ads?limit=100&fields=id,price,url",
+             f"/download-all-ads?limit={EXPORT_LIMIT}",
+             "/download-new-ads?location=Младост 1A"]
+
+
+@pytest.fixture(name="bench_client")
+def fixture_bench_client(bench_engine):
+    """
+    Client of the app reading the benchmarked database
+    """
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=bench_engine)
+
+    def _get_db():
+        session = session_factory()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    main_app.app.dependency_overrides[main_app.get_db] = _get_db
+    yield TestClient(main_app.app)
+    main_app.app.dependency_overrides.pop(main_app.get_db)
+
+
+class BenchHelpers:
+    """
+    Latency and memory of the steps building the responses.
+    """
+
+    def bench_build_summary_dict(self, measure, bench_session):
+        """
+        Completion of the per source counts
+        """
+        source_counts = crud.count_ads_by_source(bench_session, only_new_ads=True)
+        measure(main_app._build_summary_dict, source_counts) # pylint: disable=W0212
+
+    @pytest.mark.parametrize("amount", [100, 1000, 10000])
+    def bench_render_ads_page(self, measure, bench_session, amount):
+        """
+        Rendering of ads.html with the summary, the cards rendered for every call
+        """
+        template = main_app.templates.get_template("ads.html")
+        ads = crud.get_ordered_ads(bench_session, limit=amount)
+        renderer = CardRenderer(main_app.templates.env, "_card.html", max_entries=0)
+        context = {"request": None, "ad_list": ads,
+                   "show_summary": True, "next_url": "/new-ads?cursor=next",
+                   "next_fragment_url": "/new-ads/cards?cursor=next",
+                   "summary_data": main_app._build_summary_dict( # pylint: disable=W0212
+                       crud.count_ads_by_source(bench_session, only_new_ads=True))}
+        # The static files links need the request
+        template.globals = dict(template.globals, static_url=lambda path: f"/static/{path}")
+        measure(lambda: template.render(context, cards=renderer.render(ads)))
+
+    @pytest.mark.parametrize("kept", [False, True], ids=["rendered", "kept"])
+    @pytest.mark.parametrize("amount", [100, 1000, 10000])
+    def bench_render_cards(self, measure, bench_session, amount, kept):
+        """
+        Rendering of the cards alone, all of them rendered or all of them kept from
+        a previous page of the same data version
+        """
+        ads = crud.get_ordered_ads(bench_session, limit=amount)
+        renderer = CardRenderer(main_app.templates.env, "_card.html",
+                                max_entries=amount if kept else 0)
+        renderer.render(ads, version=1)
+        measure(renderer.render, ads, version=1)
+
+    def bench_save_to_csv(self, measure, bench_client):
+        """
+        Streamed CSV export response of up to IMOT_BENCH_EXPORT_LIMIT ads
+        """
+        def _download():
+            with bench_client.stream("GET", f"/download-all-ads?limit={EXPORT_LIMIT}",
+                                     headers={"Accept-Encoding": "identity"}) as response:
+                return sum(len(chunk) for chunk in response.iter_raw())
+        measure(_download)
+
+
+class BenchEndpoints: # pylint: disable=R0903
+    """
+    Latency and memory of whole requests, with and without the query cache.
+    """
+
+    @pytest.mark.parametrize("cached", [False, True], ids=["uncached", "cached"])
+    @pytest.mark.parametrize("url", ENDPOINTS)
+    def bench_endpoint(self, measure, bench_client, monkeypatch, url, cached):
+        """
+        Request of the endpoint by a client without a cached copy
+        """
+        main_app.query_cache.clear()
+        if not cached:
+            monkeypatch.setattr(main_app.query_cache, "max_entries", 0)
+
+        def _request():
+            response = bench_client.get(url)
+            assert response.status_code == 200
+            return response
+        measure(_request)
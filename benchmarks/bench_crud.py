@@ -0,0 +1,79 @@
+"""
+Benchmarks of the crud queries for every combination of the filters.
+"""
+import pytest
+
+from benchmarks.conftest import EXPORT_LIMIT, shape_id
+from db_utils import crud
+from generate_test_db import FILTER_SHAPES, filters_of
+import app as main_app
+
+
+SEEK_SHAPES = [(), ("location",), ("price",), ("source_name", "home_type")]
+
+
+def _export(session, **filters):
+    """
+    It writes the export of the filtered ads to CSV text, chunk by chunk like the endpoint does
+    """
+    rows = crud.stream_ads(session, limit=EXPORT_LIMIT, **filters)
+    size = 0
+    while True:
+        chunk = main_app._csv_chunk(rows) # pylint: disable=W0212
+        if not chunk:
+            return size
+        size += len(chunk)
+
+
+class BenchQueries:
+    """
+    Latency and memory of the queries behind the ads endpoints.
+    """
+
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids=shape_id)
+    def bench_filtered_page(self, measure, bench_session, shape):
+        """
+        First page of 100 ads of /all-ads
+        """
+        measure(crud.get_filtered_ads, bench_session, limit=100, **filters_of(shape))
+
+    @pytest.mark.parametrize("shape", SEEK_SHAPES, ids=shape_id)
+    def bench_next_page(self, measure, bench_session, shape):
+        """
+        A page of 100 ads taken with the cursor of the page before
+        """
+        filters = filters_of(shape)
+        first_page = crud.get_filtered_ads(bench_session, limit=100, **filters)
+        if not first_page:
+            pytest.skip("No ads match the filters")
+        after = crud.decode_cursor(crud.encode_cursor(first_page[-1]))
+        measure(crud.get_filtered_ads, bench_session, limit=100, after=after, **filters)
+
+    def bench_ordered_page(self, measure, bench_session):
+        """
+        First page of 100 ads without filters
+        """
+        measure(crud.get_ordered_ads, bench_session, limit=100)
+
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids=shape_id)
+    def bench_rows_page(self, measure, bench_session, shape):
+        """
+        Page of 1000 ads of the JSON API
+        """
+        measure(crud.get_ads_rows, bench_session, crud.EXPORT_COLUMNS, limit=1000,
+                **filters_of(shape))
+
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids=shape_id)
+    def bench_summary(self, measure, bench_session, shape):
+        """
+        Per source summary of /new-ads
+        """
+        measure(crud.count_ads_by_source, bench_session, only_new_ads=True,
+                **filters_of(shape))
+
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids=shape_id)
+    def bench_csv_export(self, measure, bench_session, shape):
+        """
+        CSV export of up to IMOT_BENCH_EXPORT_LIMIT ads
+        """
+        measure(_export, bench_session, **filters_of(shape))
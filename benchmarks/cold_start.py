@@ -0,0 +1,88 @@
+"""
+Benchmark of the cold start of the app: the import time and the time to the first response.
+
+The import of the app module is measured with `python -X importtime` (the modules taking the
+longest are listed), the time to the first response from the start of `python app.py` to the
+first successful request of the given path. Every measure is the median of the runs.
+
+Usage: python -m benchmarks.cold_start --runs 5 --database data/listings_data.db
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.load_test import ROOT_DIR, _free_port
+
+
+def import_times(env) -> dict:
+    """
+    It returns the cumulative import time in microseconds of every module imported by the app
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=ROOT_DIR, env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def time_to_first_response(env, path) -> float:
+    """
+    It returns the seconds from the start of the server until it answered the path
+    """
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(  # pylint: disable=R1732
+        [sys.executable, "app.py", "--workers", "1", "--port", str(port)],
+        cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # A single client, building one per attempt would take the CPU from the server
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=10) as client:
+            while True:
+                try:
+                    if client.get(path).is_success:
+                        return time.perf_counter() - start
+                except httpx.TransportError:
+                    time.sleep(0.01)
+                if process.poll() is not None:
+                    raise RuntimeError("The server stopped")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    """
+    Entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--path", default="/all-ads")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.database:
+        env["IMOT_DATABASE"] = os.path.abspath(args.database)
+    runs = [import_times(env) for _ in range(args.runs)]
+    medians = {name: statistics.median(run.get(name, 0) for run in runs) for name in runs[0]}
+    print(f"import app: {medians['app'] / 1000:.1f} ms")
+    for name, micros in sorted(medians.items(), key=lambda item: -item[1])[1:args.top + 1]:
+        print(f"  {name:<40} {micros / 1000:7.1f} ms")
+    first_responses = [time_to_first_response(env, args.path) for _ in range(args.runs)]
+    print(f"time to the first response of {args.path}: "
+          f"{statistics.median(first_responses) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
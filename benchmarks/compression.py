@@ -0,0 +1,66 @@
+"""
+Benchmark of the wire size and the latency of the compressed responses.
+
+It seeds a temporary database, starts the app in a separate uvicorn process and requests
+a 1000 ads page, a CSV export and the static files without and with compression.
+Run `python -m utils.static` before, so the static files have their precompressed variants.
+
+Usage: python -m benchmarks.compression --rows 20000 --requests 50
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_test import percentile, running_server, seed_database
+
+
+ENDPOINTS = ("/new-ads?limit=1000", "/api/new-ads?limit=1000", "/download-new-ads?limit=1000",
+             "/static/styles.css", "/static/button_scripts.js")
+ENCODINGS = ("identity", "gzip", "br")
+
+
+def measure(client, url, encoding, requests_count):
+    """
+    It returns the bytes on the wire and the latencies of the requests
+    """
+    latencies = []
+    wire_size = 0
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        with client.stream("GET", url, headers={"Accept-Encoding": encoding}) as response:
+            # Raw bytes, as they were sent by the server
+            wire_size = sum(len(chunk) for chunk in response.iter_raw())
+            content_encoding = response.headers.get("content-encoding", "identity")
+        latencies.append(time.perf_counter() - start)
+    return wire_size, content_encoding, latencies
+
+
+def main():
+    """
+    Entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "compression.db")
+        seed_database(db_file, args.rows)
+        with running_server(db_file) as port, \
+                httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            for url in ENDPOINTS:
+                for encoding in ENCODINGS:
+                    size, used, latencies = measure(client, url, encoding, args.requests)
+                    print(f"{url:<30} accept={encoding:<9} sent={used:<9}"
+                          f" bytes={size:>9}"
+                          f"  p50={statistics.median(latencies) * 1000:7.2f} ms"
+                          f"  p95={percentile(latencies, 0.95) * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
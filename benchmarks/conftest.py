@@ -0,0 +1,85 @@
+"""
+Fixtures of the benchmark suite.
+
+The databases are seeded once with the bulk generator and kept between the runs
+in IMOT_BENCH_DATA_DIR (benchmarks/.data by default).
+The sizes are chosen with IMOT_BENCH_SIZES, ex. IMOT_BENCH_SIZES=10000,1000000,5000000
+"""
+import os
+import sys
+import tracemalloc
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+# Own imports
+import generate_test_db # pylint: disable=C0413
+from db_utils import database, migrations # pylint: disable=C0413
+
+
+SIZES = [int(size) for size in os.environ.get("IMOT_BENCH_SIZES", "10000").split(",")]
+DATA_DIR = os.environ.get("IMOT_BENCH_DATA_DIR", os.path.join(ROOT_DIR, "benchmarks", ".data"))
+SEED = 42
+# Amount of ads exported by the CSV export benchmarks
+EXPORT_LIMIT = int(os.environ.get("IMOT_BENCH_EXPORT_LIMIT", 100_000))
+
+
+def shape_id(shape) -> str:
+    """
+    Readable id of the filter shape
+    """
+    return "+".join(shape) or "no_filters"
+
+
+@pytest.fixture(name="bench_engine", scope="session", params=SIZES, ids=lambda size: f"{size}rows")
+def fixture_bench_engine(request):
+    """
+    Engine of a database seeded with the requested amount of ads, with the app indexes
+    """
+    rows = request.param
+    os.makedirs(DATA_DIR, exist_ok=True)
+    db_file = os.path.join(DATA_DIR, f"bench_{rows}_{SEED}.db")
+    if not os.path.exists(db_file):
+        conn = generate_test_db.create_connection(f"{db_file}.partial")
+        # Every generated ad is also a new one, so both queries have the benchmarked size
+        generate_test_db.bulk_generate(conn, rows, rows, batch_size=200_000, seed=SEED,
+                                       use_numpy=generate_test_db.np is not None)
+        conn.close()
+        os.replace(f"{db_file}.partial", db_file)
+    engine = database.create_sqlite_engine(f"sqlite:///{db_file}")
+    migrations.migrate(engine)
+    engine.rows = rows
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(name="bench_session")
+def fixture_bench_session(bench_engine):
+    """
+    Session of the benchmarked database
+    """
+    session = sessionmaker(autocommit=False, autoflush=False, bind=bench_engine)()
+    yield session
+    session.close()
+
+
+@pytest.fixture(name="measure")
+def fixture_measure(benchmark, bench_engine):
+    """
+    It benchmarks the function and records the peak of the memory allocated by one extra call
+    """
+    def _measure(func, *args, **kwargs):
+        result = benchmark(func, *args, **kwargs)
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["rows"] = bench_engine.rows
+        benchmark.extra_info["peak_memory_kib"] = round(peak / 1024, 1)
+        return result
+    return _measure
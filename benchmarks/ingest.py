@@ -0,0 +1,93 @@
+"""
+Benchmark of the crawler ingest throughput and of the latency of the reads served meanwhile.
+
+It seeds a temporary database, starts the app in a separate uvicorn process and posts
+generated listings to `/api/ingest` as NDJSON, while `/` and `/all-ads` keep being requested.
+The same body is posted a second time, when every listing is already stored and unchanged.
+With --snapshot the app serves the reads from snapshots, published at the end of every ingest.
+
+Usage: python -m benchmarks.ingest --rows 200000 --ingest 100000 [--snapshot]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+import orjson
+
+import generate_test_db
+from benchmarks.load_test import _probe, report, running_server, seed_database
+from db_utils import crud
+
+
+ADMIN_TOKEN = "benchmark"
+CHUNK_SIZE = 1 << 16
+
+
+def build_body(amount, seed) -> bytes:
+    """
+    It returns the NDJSON body with the given amount of generated listings
+    """
+    lines = [orjson.dumps(dict(zip(crud.INGEST_COLUMNS, entry))) # pylint: disable=E1101
+             for batch in generate_test_db.generate_batches(amount, seed=seed,
+                                                            first_id=100_000_000)
+             for entry in batch]
+    return b"\n".join(lines) + b"\n"
+
+
+async def _post(client, body):
+    async def chunks():
+        for start in range(0, len(body), CHUNK_SIZE):
+            yield body[start:start + CHUNK_SIZE]
+
+    start = time.perf_counter()
+    response = await client.post("/api/ingest", content=chunks(),
+                                 headers={"Content-Type": "application/x-ndjson",
+                                          "X-Admin-Token": ADMIN_TOKEN})
+    response.raise_for_status()
+    return time.perf_counter() - start, response.json()["totals"]
+
+
+async def run_ingest(port, body, requests_count):
+    """
+    It posts the body while probing the light endpoints
+    """
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=600) as client:
+        ingest_task = asyncio.create_task(_post(client, body))
+        latencies = await _probe(client, requests_count, ingest_task)
+        return latencies, await ingest_task
+
+
+def main():
+    """
+    Entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--ingest", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--snapshot", action="store_true",
+                        help="serve the reads from the snapshots of the database")
+    args = parser.parse_args()
+
+    body = build_body(args.ingest, seed=7)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "ingest.db")
+        seed_database(db_file, args.rows)
+        os.environ["IMOT_ADMIN_TOKEN"] = ADMIN_TOKEN
+        if args.snapshot:
+            os.environ["IMOT_SNAPSHOT_MODE"] = "1"
+            os.environ["IMOT_SNAPSHOT_DIR"] = os.path.join(tmp_dir, "snapshots")
+        with running_server(db_file) as port:
+            for title in ("New listings:", "Unchanged listings:"):
+                latencies, (seconds, totals) = asyncio.run(
+                    run_ingest(port, body, args.requests))
+                report(title, latencies, None)
+                print(f"  ingested {totals['lines']} lines in {seconds:.2f} s "
+                      f"({totals['lines'] / seconds:,.0f} ads/s): {totals}")
+
+
+if __name__ == "__main__":
+    main()
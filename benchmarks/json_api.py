@@ -0,0 +1,84 @@
+"""
+Benchmark of the JSON serialization of the ads pages.
+
+It compares building ORM objects, validating them with the pydantic schema and encoding them
+with the standard json module (what a response_model endpoint does) with selecting plain rows
+of only the needed columns and serializing them with utils.dump_json.
+
+Usage: python -m benchmarks.json_api --rows 100000 --page-size 1000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.load_test import seed_database
+from db_utils import crud, database, migrations, schemas
+from utils import dump_json
+
+
+def orm_pages(session, page_size, pages):
+    """
+    It serializes the pages the way the response_model endpoints do
+    """
+    size = 0
+    for _ in range(pages):
+        ads = crud.get_filtered_ads(session, limit=page_size)
+        items = [schemas.Ads.from_orm(ad) for ad in ads]
+        size += len(json.dumps(jsonable_encoder({"items": items})).encode())
+    return size
+
+
+def row_pages(session, page_size, pages, fields=crud.EXPORT_COLUMNS):
+    """
+    It serializes the pages the way the /api endpoints do
+    """
+    size = 0
+    for _ in range(pages):
+        rows = crud.get_ads_rows(session, fields, limit=page_size)
+        size += len(dump_json({"items": [dict(zip(fields, row)) for row in rows]}))
+    return size
+
+
+def measure(name, func, *args):
+    """
+    It runs the serialization and prints the throughput
+    """
+    page_size, pages = args[1], args[2]
+    start = time.perf_counter()
+    size = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} rows/s={page_size * pages / elapsed:11.1f}"
+          f"  bytes/page={size // pages}")
+
+
+def main():
+    """
+    Entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--pages", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "json_api.db")
+        seed_database(db_file, args.rows)
+        engine = database.create_sqlite_engine(f"sqlite:///{db_file}")
+        migrations.migrate(engine)
+        session = sessionmaker(bind=engine)()
+        measure("orm + pydantic + json", orm_pages, session, args.page_size, args.pages)
+        measure("rows + dump_json", row_pages, session, args.page_size, args.pages)
+        measure("rows(id,price,url)", row_pages, session, args.page_size, args.pages,
+                ("id", "price", "url"))
+        session.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
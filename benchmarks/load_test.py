@@ -0,0 +1,155 @@
+"""
+Load test measuring the latency of the light endpoints while a large CSV export is running.
+
+It seeds a temporary database, starts the app in a separate uvicorn process and
+keeps requesting `/` and `/all-ads` while `/download-all-ads` streams the whole table.
+
+Usage: python -m benchmarks.load_test --rows 200000 --requests 200
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import generate_test_db
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBED_ENDPOINTS = ("/", "/all-ads?limit=100")
+
+
+def seed_database(db_file, rows):
+    """
+    It creates the ads tables in the given database file and fills them with random rows,
+    all of them new
+    """
+    conn = generate_test_db.create_connection(db_file)
+    generate_test_db.bulk_generate(conn, rows, rows)
+    conn.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(db_file, port, command=None):
+    """
+    It starts the app in a uvicorn subprocess using the given database and waits until it responds
+
+    :param command: the command starting the server on the port, a single uvicorn process
+                    by default
+    """
+    env = dict(os.environ, IMOT_DATABASE=db_file)
+    command = command or [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+                          "--log-level", "warning"]
+    process = subprocess.Popen(command, cwd=ROOT_DIR, env=env)  # pylint: disable=R1732
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The server did not start in time")
+
+
+@contextlib.contextmanager
+def running_server(db_file):
+    """
+    It runs the app on a free port with the given database until the end of the block
+    and yields the port
+    """
+    port = _free_port()
+    server = start_server(db_file, port)
+    try:
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def percentile(samples, fraction):
+    """
+    It returns the value below which the given fraction of the sorted samples falls
+    """
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def _probe(client, requests_count, background_task=None):
+    latencies = {endpoint: [] for endpoint in PROBED_ENDPOINTS}
+    sent = 0
+    # keep probing for as long as the background download is running
+    while sent < requests_count or (background_task and not background_task.done()):
+        sent += 1
+        for endpoint in PROBED_ENDPOINTS:
+            start = time.perf_counter()
+            response = await client.get(endpoint)
+            response.raise_for_status()
+            latencies[endpoint].append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def _download(client):
+    start = time.perf_counter()
+    size = 0
+    async with client.stream("GET", "/download-all-ads") as response:
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+    return time.perf_counter() - start, size
+
+
+async def run_scenario(port, requests_count, with_download):
+    """
+    It probes the light endpoints, optionally while a full CSV export is downloaded in parallel
+    """
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120) as client:
+        download_task = asyncio.create_task(_download(client)) if with_download else None
+        latencies = await _probe(client, requests_count, download_task)
+        download = await download_task if download_task else None
+    return latencies, download
+
+
+def report(title, latencies, download):
+    """
+    It prints the p50/p99/max latencies of every probed endpoint
+    """
+    print(title)
+    for endpoint, samples in latencies.items():
+        print(f"  {endpoint:<22} n={len(samples):<5} p50={percentile(samples, 0.5):8.1f} ms"
+              f"  p99={percentile(samples, 0.99):8.1f} ms  max={max(samples):8.1f} ms")
+    if download:
+        print(f"  /download-all-ads took {download[0]:.2f} s for {download[1] / 1e6:.1f} MB")
+
+
+def main():
+    """
+    Entry point of the load test.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "load_test.db")
+        seed_database(db_file, args.rows)
+        with running_server(db_file) as port:
+            report("Idle server:", *asyncio.run(run_scenario(port, args.requests, False)))
+            report("During /download-all-ads:",
+                   *asyncio.run(run_scenario(port, args.requests, True)))
+
+
+if __name__ == "__main__":
+    main()
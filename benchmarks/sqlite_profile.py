@@ -0,0 +1,124 @@
+"""
+Benchmark of the read throughput while a concurrent writer (the crawler) inserts ads.
+
+It compares the plain engine the app used to create (rollback journal, no pooling)
+with the tuned connection profile of db_utils.database.create_sqlite_engine.
+The writer runs in a separate process, just like the crawler does.
+
+Usage: python -m benchmarks.sqlite_profile --rows 200000 --readers 4 --duration 10
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import generate_test_db
+from benchmarks.load_test import seed_database
+from db_utils import crud, database, migrations
+from utils import constants
+
+
+INSERT_SQL = """INSERT INTO ads
+                (source_name, url, price, home_type, home_size, location, image, scraping_date)
+                VALUES(?,?,?,?,?,?,?,?);"""
+
+
+def _writer(db_file, journal_mode, stop_event, counter, batch_size):
+    """
+    It keeps inserting batches of ads in separate transactions until it is stopped
+    """
+    connection = sqlite3.connect(db_file, timeout=30)
+    connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+    if journal_mode == "WAL":
+        connection.execute("PRAGMA synchronous = NORMAL")
+    while not stop_event.is_set():
+        batch = generate_test_db.build_dataset(batch_size)
+        with connection:
+            connection.executemany(INSERT_SQL, batch)
+        with counter.get_lock():
+            counter.value += batch_size
+    connection.close()
+
+
+def _reader(session_factory, deadline, results):
+    """
+    It keeps reading random filtered pages until the deadline
+    """
+    locations = list(constants.AdLocation)
+    reads = errors = 0
+    while time.monotonic() < deadline:
+        session = session_factory()
+        try:
+            crud.get_filtered_ads(session, location=random.choice(locations), limit=50)
+            reads += 1
+        except OperationalError:
+            errors += 1
+        finally:
+            session.close()
+    results.append((reads, errors))
+
+
+def run_profile(name, engine, db_file, journal_mode, args):
+    """
+    It runs the readers against the engine while the writer process inserts ads
+    """
+    stop_event = multiprocessing.Event()
+    counter = multiprocessing.Value("i", 0)
+    writer = multiprocessing.Process(target=_writer,
+                                     args=(db_file, journal_mode, stop_event, counter,
+                                           args.batch_size))
+    writer.start()
+    session_factory = sessionmaker(bind=engine)
+    results = []
+    deadline = time.monotonic() + args.duration
+    readers = [threading.Thread(target=_reader, args=(session_factory, deadline, results))
+               for _ in range(args.readers)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    stop_event.set()
+    writer.join()
+    reads = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    print(f"{name:<8} reads/s={reads / args.duration:9.1f}  read errors={errors:<5}"
+          f" inserted rows/s={counter.value / args.duration:9.1f}")
+
+
+def main():
+    """
+    Entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ("default", "tuned"):
+            db_file = os.path.join(tmp_dir, f"{name}.db")
+            seed_database(db_file, args.rows)
+            url = f"sqlite:///{db_file}"
+            if name == "default":
+                engine = create_engine(url, connect_args={"check_same_thread": False})
+                journal_mode = "DELETE"
+            else:
+                engine = database.create_sqlite_engine(url)
+                journal_mode = "WAL"
+            migrations.migrate(engine)
+            run_profile(name, engine, db_file, journal_mode, args)
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
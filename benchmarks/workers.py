@@ -0,0 +1,86 @@
+"""
+Benchmark of the throughput of the production server with 1 to N worker processes.
+
+It seeds a temporary database, starts the app with `python app.py --workers N` for every
+amount of workers and keeps the given amount of concurrent clients requesting the pages and
+the JSON API for a fixed time, then reports the requests per second and the latencies.
+
+Usage: python -m benchmarks.workers --rows 200000 --workers 1,2,4 --clients 32 --seconds 10
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.load_test import _free_port, percentile, seed_database, start_server
+
+
+ENDPOINTS = ("/all-ads?limit=48",
+             "/new-ads?location_search=mladost&limit=48",
+             "/api/ads?limit=100",
+             "/api/ads?min_price=100000&max_price=150000&limit=100")
+
+
+async def _client(client, deadline, endpoints, latencies):
+    while time.monotonic() < deadline:
+        endpoint = next(endpoints)
+        start = time.perf_counter()
+        response = await client.get(endpoint)
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run_load(port, clients, seconds) -> list:
+    """
+    It returns the latencies of the requests sent by the concurrent clients until the time is up
+    """
+    latencies = []
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60,
+                                 limits=limits) as client:
+        # Warm up the caches of the workers, the measured run is their steady state
+        await asyncio.gather(*[client.get(endpoint) for endpoint in ENDPOINTS * clients])
+        deadline = time.monotonic() + seconds
+        endpoints = itertools.cycle(ENDPOINTS)
+        await asyncio.gather(*[_client(client, deadline, endpoints, latencies)
+                               for _ in range(clients)])
+    return latencies
+
+
+def main():
+    """
+    Entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--workers", default=",".join(
+        str(amount) for amount in sorted({1, 2, os.cpu_count() or 1})))
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} concurrent clients, {args.seconds:g} s per run")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "workers.db")
+        seed_database(db_file, args.rows)
+        for workers in (int(amount) for amount in args.workers.split(",")):
+            port = _free_port()
+            server = start_server(db_file, port, [sys.executable, "app.py", "--port", str(port),
+                                                  "--workers", str(workers)])
+            try:
+                latencies = asyncio.run(run_load(port, args.clients, args.seconds))
+            finally:
+                server.terminate()
+                server.wait()
+            print(f"  {workers} workers: {len(latencies) / args.seconds:8.1f} req/s"
+                  f"  p50={percentile(latencies, 0.5):7.1f} ms"
+                  f"  p99={percentile(latencies, 0.99):7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,488 @@
 """
 Module for basic CRUD operations.
 """
+import base64
+import binascii
+import json
+import operator
+import threading
+from datetime import datetime
+
+from sqlalchemy import and_, func, literal_column, or_, select, tuple_
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+from utils import constants
 from . import models
+from .database import begin_immediate
+from .slow_query import log_slow_iteration, log_slow_queries
+
 
+# Column order used for the exported rows
+EXPORT_COLUMNS = ("id", "source_name", "price", "location", "home_size",
+                  "home_type", "url", "image", "scraping_date")
+ORDER_PRECEDENCE = models.SORT_KEY_COLUMNS
+# The id makes the sort key unique, so the pages are stable even with equal values
+SORT_KEY = ORDER_PRECEDENCE + ("id",)
+_SORT_KEY_TYPES = (int, str, int, str, str, int)
+# The sort key columns of the listings may be empty, only the id never is
+_NULLABLE_SORT_KEY = tuple(column != "id" for column in SORT_KEY)
+# Column order of the ingested rows
+INGEST_COLUMNS = ("source_name", "url", "price", "home_type", "home_size", "location",
+                  "image", "scraping_date")
+_UPDATED_COLUMNS = tuple(column for column in INGEST_COLUMNS if column != "url")
+# The bulk writes of the process are serialized, SQLite has a single writer anyway.
+# The ones of other processes wait for the write lock taken by the transaction.
+_WRITE_LOCK = threading.Lock()
+_INGEST_SORT_KEY = operator.itemgetter(*[INGEST_COLUMNS.index(column)
+                                        for column in ORDER_PRECEDENCE])
+# The listings are identified by their url. A listing seen again keeps the run which found it
+# first, its row is only written when some of its values have changed.
+UPSERT_SQL = (
+    f"INSERT INTO ads ({', '.join(INGEST_COLUMNS)}, first_seen_run) "
+    f"VALUES ({', '.join('?' * (len(INGEST_COLUMNS) + 1))}) "
+    f"ON CONFLICT (url) DO UPDATE SET "
+    f"{', '.join(f'{column} = excluded.{column}' for column in _UPDATED_COLUMNS)} "
+    f"WHERE ({', '.join(f'ads.{column}' for column in _UPDATED_COLUMNS)}) IS NOT "
+    f"({', '.join(f'excluded.{column}' for column in _UPDATED_COLUMNS)})")
+_URL_INDEX = INGEST_COLUMNS.index("url")
+_PRICE_INDEX = INGEST_COLUMNS.index("price")
+_LOCATION_INDEX = INGEST_COLUMNS.index("location")
+# Below the default limit of the bound parameters of a SQLite statement
+_LOOKUP_CHUNK_SIZE = 500
+# A crawl run keeps a single entry per listing, with the change since the previous run
+PRICE_HISTORY_SQL = (
+    "INSERT INTO price_history (url, crawl_run, price, location, price_change) "
+    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (url, crawl_run) DO UPDATE SET "
+    "price = excluded.price, location = excluded.location, "
+    "price_change = price_history.price_change + excluded.price_change")
 
-def get_filtered_ads(db_session: Session, #pylint: disable=R0913
-                     source_name: str = None,
-                     price: int = None,
-                     location: str = None,
-                     home_size: int = None,
-                     home_type: str = None,
-                     limit: int = 10000,
-                     only_new_ads: bool = False):
+
+def encode_cursor(ad) -> str:
     """
-    Retrieve all ads based on the filters passed.
+    Build the opaque pagination cursor pointing right after the given ad.
     Params:
-    db: the database session
-    source_name(Optional): The name of which the ad list will be filtered by:
-              (these are the spider names)
-    price(Optional): The price less than which the ad list will be filtered by:
+    ad: the last ad (ORM object or row) of the page
+    """
+    values = [getattr(ad, column) for column in SORT_KEY]
+    raw = json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
 
-    location(Optional): The location of which the ad list will be filtered by
-    home_size(Optional): The home_size more than which the ad list will be filtered by
-    home_type(Optional): The home type of which the ad list will be filtered by
-    limit(Optional): The amount of entries to be shown
-    only_new_ads: Flag to indicate whether all ads will be displayed or only the new ones
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Decode a cursor produced by encode_cursor back to the sort key values.
+    Raises ValueError when the cursor is malformed.
+    Params:
+    cursor: the opaque cursor string
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(values, list) or len(values) != len(SORT_KEY):
+        raise ValueError("Invalid cursor")
+    for value, expected_type, nullable in zip(values, _SORT_KEY_TYPES, _NULLABLE_SORT_KEY):
+        if value is None and nullable:
+            continue
+        if not isinstance(value, expected_type) or isinstance(value, bool):
+            raise ValueError("Invalid cursor")
+    return tuple(values)
+
+
+def _filter_values(value) -> tuple:
+    """
+    The sorted distinct values of an equality filter given as a single value or a list of them,
+    the enumeration members are replaced by their values. Empty for no filter.
+    """
+    if value is None:
+        return ()
+    values = value if isinstance(value, (list, tuple, set, frozenset)) else (value,)
+    return tuple(sorted({getattr(item, "value", item) for item in values}))
+
+
+def _seek_column(source_name=None, location=None, home_type=None, **_ranges):
+    """
+    Name of the equality filtered column whose index is used for the query.
+    When several of them are filtered, the most selective one leads.
+    """
+    filters = {"source_name": source_name, "location": location, "home_type": home_type}
+    for column in models.EQUALITY_FILTER_COLUMNS:
+        if _filter_values(filters[column]):
+            return column
+    return None
+
+
+def _fixed_column(**filters):
+    """
+    Name of the seek column when it is filtered by a single value. The index entries of the
+    query then all have the same value in it, the next columns alone give their order.
+    """
+    seek_column = _seek_column(**filters)
+    if seek_column is not None and len(_filter_values(filters[seek_column])) == 1:
+        return seek_column
+    return None
+
+
+def _not_seekable(column):
+    """
+    Wrap the column in a unary plus, which keeps SQLite from using it in the index lookup.
+    Without it SQLite treats every equality filtered column as constant and fails to see
+    that the index of the seek column already returns the rows in the requested order.
+    """
+    return UnaryExpression(column, operator=operators.custom_op("+"))
+
+
+def _select_generation(query, only_new_ads):
     """
-    model_ads = models.NewAds if only_new_ads else models.Ads
+    Keep only the listings first seen by the latest finished crawl run when only the new
+    ones are requested. The latest run is a scalar subquery answered from the partial index
+    of the finished runs, so the listings are a range seek in the indexes leading with the run.
+    """
+    if not only_new_ads:
+        return query
+    latest_run = select(func.max(models.CrawlRuns.id)) \
+        .where(models.CrawlRuns.finished_at.isnot(None)).scalar_subquery()
+    return query.filter(models.Ads.first_seen_run == latest_run)
+
 
-    output = db_session.query(model_ads)
-    if source_name is not None:
-        output = output.filter(model_ads.source_name == source_name.value)
-    if location is not None:
-        output = output.filter(model_ads.location == location.value)
-    if home_type is not None:
-        output = output.filter(model_ads.home_type == home_type.value)
+def _apply_filters(query, model_ads, # pylint: disable=R0913,R0914
+                   source_name=None, location=None, home_type=None, price=None, home_size=None,
+                   min_price=None, max_price=None, min_size=None, max_size=None,
+                   min_price_per_m2=None, max_price_per_m2=None):
+    """
+    Narrow down the query with every filter that was passed, all of them in a single statement.
+    The equality filters take a single value or a list of them (an IN list). Every other filter
+    is a range of the price and the home size, which are part of every listing index, so all
+    of them are checked on the index entries.
+    """
+    seek_column = _seek_column(source_name, location, home_type)
+    for column, value in (("source_name", source_name), ("location", location),
+                          ("home_type", home_type)):
+        values = _filter_values(value)
+        if not values:
+            continue
+        model_column = getattr(model_ads, column)
+        if column != seek_column:
+            model_column = _not_seekable(model_column)
+        if len(values) == 1:
+            query = query.filter(model_column == values[0])
+        else:
+            # SQLite seeks every value of the list in the index of the seek column
+            query = query.filter(model_column.in_(values))
     if price is not None:
-        output = output.filter(
-            model_ads.price < price)
+        query = query.filter(model_ads.price < price)
     if home_size is not None:
-        output = output.filter(
-            model_ads.home_size > home_size)
-    return output.limit(limit).all()
+        query = query.filter(model_ads.home_size > home_size)
+    for column, lower, upper in ((model_ads.price, min_price, max_price),
+                                 (model_ads.home_size, min_size, max_size)):
+        if lower is not None:
+            query = query.filter(column >= lower)
+        if upper is not None:
+            query = query.filter(column <= upper)
+    # Multiplied out, so the bounds hold without a division for every entry
+    if min_price_per_m2 is not None:
+        query = query.filter(model_ads.price >= model_ads.home_size * min_price_per_m2)
+    if max_price_per_m2 is not None:
+        query = query.filter(model_ads.price <= model_ads.home_size * max_price_per_m2)
+    return query
+
+
+def _after_key(columns, values):
+    """
+    Condition of the rows sorted after the given key values. SQLite sorts the NULLs first,
+    so a row value comparison is exact as long as the key has no NULL: a row with a NULL
+    where the key has a value sorts before it and the comparison leaves it out.
+    A NULL of the key is compared on its own, the rows with a value there all sort after it.
+    """
+    if None not in values:
+        if len(columns) == 1:
+            return columns[0] > values[0]
+        return tuple_(*columns) > tuple_(*values)
+    position = values.index(None)
+    same = [column == value for column, value in zip(columns[:position], values[:position])]
+    column = columns[position]
+    following = column.isnot(None)
+    if position + 1 < len(columns):
+        following = or_(following, and_(column.is_(None),
+                                        _after_key(columns[position + 1:],
+                                                   values[position + 1:])))
+    if not same:
+        return following
+    return or_(_after_key(columns[:position], values[:position]), and_(*same, following))
+
+
+def _apply_order(query, model_ads, after, fixed_column=None):
+    """
+    Order the query by the sort key and continue right after the given key values.
+    The keyset condition lets the database seek directly to the page instead of skipping rows.
+    The column filtered by a single value in the index seek is left out of the condition,
+    so that the rest of it follows the column order of the index leading with it.
+    """
+    sort_columns = [getattr(model_ads, column) for column in SORT_KEY]
+    if after is not None:
+        seek = [(column, value) for column, value in zip(SORT_KEY, after)
+                if column != fixed_column]
+        query = query.filter(_after_key([getattr(model_ads, column) for column, _ in seek],
+                                        [value for _, value in seek]))
+    return query.order_by(*sort_columns)
+
+
+@log_slow_queries
+def get_filtered_ads(db_session: Session, limit: int = 10000, only_new_ads: bool = False,
+                     after: tuple = None, **filters):
+    """
+    Retrieve all ads based on the filters passed, ordered by the sort key.
+    Params:
+    db: the database session
+    limit(Optional): The amount of entries to be shown
+    only_new_ads: Flag to indicate whether all ads will be displayed or only the new ones
+    after(Optional): Sort key values (see decode_cursor) after which the entries start
+    filters(Optional):
+        source_name: The name or list of names of the sources (these are the spider names)
+        location: The location or list of locations of the ads
+        home_type: The home type or list of home types of the ads
+        price: The price less than which the ad list will be filtered by
+        home_size: The home_size more than which the ad list will be filtered by
+        min_price, max_price: The inclusive bounds of the price
+        min_size, max_size: The inclusive bounds of the home_size
+        min_price_per_m2, max_price_per_m2: The inclusive bounds of the price per square meter
+    """
+    model_ads = models.Ads
+
+    output = _select_generation(db_session.query(model_ads), only_new_ads)
+    output = _apply_filters(output, model_ads, **filters)
+    return _apply_order(output, model_ads, after, _fixed_column(**filters)).limit(limit).all()
+
+
+@log_slow_queries
+def get_ads_rows(db_session: Session, columns, limit: int = 10000, only_new_ads: bool = False,
+                 after: tuple = None, **filters):
+    """
+    Retrieve only the given columns of the ads as plain rows, ordered by the sort key.
+    No ORM objects are built, the rows can be accessed both by position and by column name.
+    Params:
+    db_session: the database session
+    columns: names of the ads columns to be selected
+    limit(Optional): The amount of entries to be returned
+    only_new_ads: Flag to indicate whether all ads will be returned or only the new ones
+    after(Optional): Sort key values (see decode_cursor) after which the entries start
+    filters(Optional): the same filters as in get_filtered_ads
+    """
+    model_ads = models.Ads
+    output = _select_generation(
+        db_session.query(*[getattr(model_ads, column) for column in columns]), only_new_ads)
+    output = _apply_filters(output, model_ads, **filters)
+    return _apply_order(output, model_ads, after, _fixed_column(**filters)).limit(limit).all()
+
+
+@log_slow_queries
+def count_ads_by_source(db_session: Session, only_new_ads: bool = False, **filters) -> dict:
+    """
+    Count the ads matching the filters per source with a single GROUP BY query.
+    Without filters it is answered from the source_name index alone.
+    Params:
+    db_session: the database session
+    only_new_ads: Flag to indicate whether all ads will be counted or only the new ones
+    filters(Optional): the same filters as in get_filtered_ads
+    Returns a dictionary with the source names that have ads and their number of ads.
+    """
+    model_ads = models.Ads
+    output = _select_generation(db_session.query(model_ads.source_name, func.count()),
+                                only_new_ads)
+    output = _apply_filters(output, model_ads, **filters)
+    return dict(output.group_by(model_ads.source_name).all())
 
 
-def get_ordered_ads(db_session: Session, limit: int = 10000, only_new_ads: bool = False):
+@log_slow_queries
+def get_ordered_ads(db_session: Session, limit: int = 10000, only_new_ads: bool = False,
+                    after: tuple = None):
     """
     Retrieve all ads ordered by price - location - home-size - source_name - home-type.
     Params:
     db_session: the database session
     limit(Optional): The amount of entries to be shown
     only_new_ads: Flag to indicate whether all ads will be displayed or only the new ones
+    after(Optional): Sort key values (see decode_cursor) after which the entries start
+    """
+    model_ads = models.Ads
+    output = _select_generation(db_session.query(model_ads), only_new_ads)
+    return _apply_order(output, model_ads, after).limit(limit).all()
+
+
+@log_slow_iteration
+def stream_ads(db_session: Session, limit: int = None, only_new_ads: bool = False,
+               chunk_size: int = 1000, **filters):
+    """
+    Retrieve the ads as an iterator of plain row tuples holding the EXPORT_COLUMNS,
+    ordered by the sort key.
+    The rows are fetched from the cursor chunk_size at a time instead of being loaded at once.
+    Params:
+    db_session: the database session
+    limit(Optional): The amount of entries to be returned
+    only_new_ads: Flag to indicate whether all ads will be returned or only the new ones
+    chunk_size(Optional): The amount of rows fetched from the cursor at once
+    filters(Optional): the same filters as in get_filtered_ads
+    """
+    model_ads = models.Ads
+    columns = [getattr(model_ads, name) for name in EXPORT_COLUMNS]
+    output = _select_generation(db_session.query(*columns), only_new_ads)
+    output = _apply_filters(output, model_ads, **filters)
+    output = _apply_order(output, model_ads, None)
+    return iter(output.limit(limit).yield_per(chunk_size))
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def start_crawl_run(db_session: Session) -> int:
+    """
+    Add a new, not yet finished crawl run.
+    Params:
+    db_session: the database session
+    Returns the id of the crawl run.
+    """
+    crawl_run = models.CrawlRuns(started_at=_now())
+    db_session.add(crawl_run)
+    db_session.commit()
+    return crawl_run.id
+
+
+def get_crawl_run(db_session: Session, crawl_run: int):
+    """
+    Retrieve the crawl run with the given id, None when there is no such run.
+    Params:
+    db_session: the database session
+    crawl_run: the id of the crawl run
+    """
+    return db_session.get(models.CrawlRuns, crawl_run)
+
+
+def finish_crawl_run(db_session: Session, crawl_run: int):
+    """
+    Mark the crawl run as finished, its listings become the new ones.
+    Params:
+    db_session: the database session
+    crawl_run: the id of the crawl run
+    """
+    db_session.query(models.CrawlRuns).filter(models.CrawlRuns.id == crawl_run) \
+        .update({models.CrawlRuns.finished_at: _now()}, synchronize_session=False)
+    db_session.commit()
+
+
+def upsert_ads(db_session: Session, rows, crawl_run: int) -> dict:
+    """
+    Insert the listings or update the stored ones with the same url, in a single transaction.
+    Params:
+    db_session: the database session
+    rows: tuples of the INGEST_COLUMNS values
+    crawl_run: the id of the crawl run which found the listings
+    Returns the amount of the inserted, updated and unchanged listings.
+    """
+    with _WRITE_LOCK:
+        connection = db_session.connection()
+        # The ids and the prices read first have to stay current until the commit
+        begin_immediate(connection)
+        # The listing indexes do not fit in the default page cache of a connection, every
+        # random insert into them would read its pages again
+        connection.exec_driver_sql(f"PRAGMA cache_size = {int(constants.INGEST_CACHE_SIZE)}")
+        try:
+            # The new rows get ids after the current maximum
+            last_id = connection.exec_driver_sql("SELECT MAX(id) FROM ads").scalar() or 0
+            # In the order of the sort key the inserts into its index land on the same pages
+            rows = sorted(rows, key=_INGEST_SORT_KEY)
+            history = _price_history_entries(connection, rows, crawl_run)
+            changes_before = connection.connection.total_changes
+            connection.exec_driver_sql(UPSERT_SQL, [row + (crawl_run,) for row in rows])
+            changed = connection.connection.total_changes - changes_before
+            if history:
+                connection.exec_driver_sql(PRICE_HISTORY_SQL, history)
+            inserted = connection.exec_driver_sql("SELECT COUNT(*) FROM ads WHERE id > ?",
+                                                  (last_id,)).scalar()
+        finally:
+            connection.exec_driver_sql(
+                f"PRAGMA cache_size = {int(constants.SQLITE_PRAGMAS['cache_size'])}")
+        db_session.commit()
+    return {"inserted": inserted, "updated": changed - inserted,
+            "unchanged": len(rows) - changed}
+
+
+def _price_history_entries(connection, rows, crawl_run) -> list:
+    """
+    It returns the price history entries of the listings which are new or have a new price,
+    comparing the rows to the prices stored before the upsert.
+    """
+    prices = {}
+    urls = list({row[_URL_INDEX] for row in rows})
+    for start in range(0, len(urls), _LOOKUP_CHUNK_SIZE):
+        chunk = urls[start:start + _LOOKUP_CHUNK_SIZE]
+        prices.update(connection.exec_driver_sql(
+            f"SELECT url, price FROM ads WHERE url IN ({', '.join('?' * len(chunk))})",
+            tuple(chunk)).fetchall())
+    entries = []
+    for row in rows:
+        url, price = row[_URL_INDEX], row[_PRICE_INDEX]
+        previous = prices.get(url)
+        if previous != price:
+            entries.append((url, crawl_run, price, row[_LOCATION_INDEX],
+                            None if previous is None else price - previous))
+            # A listing repeated in the batch is compared to its price set by the upsert
+            prices[url] = price
+    return entries
+
+
+@log_slow_queries
+def get_price_history(db_session: Session, url: str) -> list:
+    """
+    Retrieve the price history of the listing with the given url, from the oldest entry.
+    Params:
+    db_session: the database session
+    url: the url of the listing
+    Returns rows with the crawl_run, its started_at date, the price and the price_change.
+    """
+    model_history = models.PriceHistory
+    model_runs = models.CrawlRuns
+    return db_session.query(model_history.crawl_run, model_runs.started_at,
+                            model_history.price, model_history.price_change) \
+        .join(model_runs, model_runs.id == model_history.crawl_run) \
+        .filter(model_history.url == url) \
+        .order_by(model_history.crawl_run).all()
+
+
+def first_crawl_run_since(db_session: Session, since: str):
+    """
+    Retrieve the id of the first crawl run started at the given time or later.
+    Params:
+    db_session: the database session
+    since: ISO formatted date or time
+    Returns None when no crawl run started since then.
+    """
+    return db_session.query(func.min(models.CrawlRuns.id)) \
+        .filter(models.CrawlRuns.started_at >= since).scalar()
+
+
+@log_slow_queries
+def get_price_drops(db_session: Session, location: str, since_run: int, limit: int = 20) -> list:
+    """
+    Retrieve the biggest price drops of the listings in the location, starting from a crawl run.
+    Params:
+    db_session: the database session
+    location: the location of the listings
+    since_run: the id of the first crawl run whose drops are included
+    limit(Optional): The amount of drops to be returned
+    Returns rows with the url, the crawl_run, its started_at date, the price and
+    the (negative) price_change, the biggest drop first.
     """
-    model_ads = models.NewAds if only_new_ads else models.Ads
-    order_precedence = ("price", "location", "home_size",
-                        "source_name", "home_type")
-    output = db_session.query(model_ads)
-    return output.order_by(*order_precedence).limit(limit).all()
+    model_history = models.PriceHistory
+    model_runs = models.CrawlRuns
+    # The condition of the partial drops index has to be a literal for SQLite to use it
+    return db_session.query(model_history.url, model_history.crawl_run, model_runs.started_at,
+                            model_history.price, model_history.price_change) \
+        .join(model_runs, model_runs.id == model_history.crawl_run) \
+        .filter(model_history.location == location,
+                model_history.crawl_run >= since_run,
+                model_history.price_change < literal_column("0")) \
+        .order_by(model_history.price_change, model_history.crawl_run.desc()) \
+        .limit(limit).all()
@@ -1,18 +1,294 @@
 """
 Module for initial sqlalchemy configuration.
 """
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from utils import constants
+from utils.instrumentation import record_query
+from .slow_query import capture_statement
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///data/listings_data.db"
 
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{constants.DATABASE}"
+_PRAGMA_VALUE = re.compile(r"-?\w+")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    """
+    It executes the PRAGMA statements of the connection profile on a new DBAPI connection
+
+    :param dbapi_connection: the sqlite3 connection
+    :param pragmas: dictionary of pragma names and values
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            if not _PRAGMA_VALUE.fullmatch(str(value)):
+                raise ValueError(f"Invalid value for PRAGMA {name}: {value!r}")
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, _cursor, statement, parameters, _context, _executemany):
+    capture_statement(statement, parameters)
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    # Every statement of every engine is timed for the instrumentation of the current request
+    record_query(time.perf_counter() - conn.info["query_start"].pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # The failed statements are timed too, their start would be left behind otherwise
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        record_query(time.perf_counter() - starts.pop())
+
+
+def create_sqlite_engine(url, pragmas=None, pool_size=constants.DB_WORKERS,
+                         max_overflow=constants.DB_MAX_OVERFLOW, creator=None):
+    """
+    It creates an engine for a SQLite file applying the connection profile to every connection.
+    The connections are pooled (sqlalchemy uses a NullPool for SQLite files by default), so the
+    profile, the page cache and the memory map are set up once per connection and not once per
+    request. The pool size matches the database thread pool, so every worker thread can hold
+    a connection.
+
+    :param url: the sqlalchemy database URL
+    :param pragmas: the connection profile, defaults to constants.SQLITE_PRAGMAS
+    :param pool_size: the amount of connections kept open
+    :param max_overflow: the amount of extra connections opened under load
+    :param creator: function opening the DBAPI connections, instead of opening the url
+    :return: the Engine object.
+    """
+    pragmas = constants.SQLITE_PRAGMAS if pragmas is None else pragmas
+    options = {"creator": creator} if creator is not None else {}
+    new_engine = create_engine(url, connect_args={"check_same_thread": False},
+                               poolclass=QueuePool, pool_size=pool_size,
+                               max_overflow=max_overflow, **options)
+
+    @event.listens_for(new_engine, "connect")
+    def _on_connect(dbapi_connection, _connection_record):
+        apply_sqlite_pragmas(dbapi_connection, pragmas)
+
+    return new_engine
+
+
+def create_snapshot_engine(path, pragmas=None):
+    """
+    It creates an engine reading an immutable copy of the database. The connections are opened
+    read-only with immutable=1, so SQLite takes no locks and never checks the file for changes
+    made by other connections. The file must not be written while the engine is in use.
+
+    :param path: the path of the database file
+    :param pragmas: the connection profile, defaults to constants.SNAPSHOT_PRAGMAS
+    :return: the Engine object.
+    """
+    path = os.path.abspath(path)
+    uri = f"{pathlib.Path(path).as_uri()}?mode=ro&immutable=1"
+    new_engine = create_sqlite_engine(
+        f"sqlite:///{path}", constants.SNAPSHOT_PRAGMAS if pragmas is None else pragmas,
+        creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False))
+    # The inode of a deleted snapshot may be reused by a newer one, its file name is unique
+    _SNAPSHOT_VERSIONS[path] = (os.path.basename(path),)
+    return new_engine
+
+
+def forget_snapshot(path):
+    """
+    It drops the data version of a snapshot which is not read anymore
+
+    :param path: the path of the database file of the snapshot engine
+    """
+    _SNAPSHOT_VERSIONS.pop(os.path.abspath(path), None)
+
+
+def begin_immediate(connection):
+    """
+    It starts the transaction of the connection by taking the write lock of the database,
+    waiting for the writers of the other processes (the workers of the server, the crawler)
+    up to the busy timeout. The reads of the transaction then see the data it writes over,
+    a deferred transaction reading first would fail on its first write once another process
+    had written meanwhile. The readers are not blocked in WAL mode.
+    Nothing is done when the connection is already in a transaction.
+
+    :param connection: the sqlalchemy connection of the transaction
+    """
+    if not connection.connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+class _DataVersionProbe:
+    """
+    Dedicated connection used only to ask SQLite whether the database file has changed.
+    PRAGMA data_version returns a different value whenever another connection or process
+    (the crawler) has committed changes since the previous call on the same connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._file_id = None
+        self._fingerprint = None
+
+    def read(self):
+        """
+        It returns the current version of the data in the database file
+        """
+        stat = os.stat(self.path)
+        file_id = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            if self._file_id != file_id:
+                # The file was created again, the old connection would not see its changes
+                if self._connection is not None:
+                    self._connection.close()
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._file_id = file_id
+            version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        return file_id + (version,)
+
+    def fingerprint(self):
+        """
+        It returns the fingerprint of the data in the database file, computed again only
+        when the data version has changed
+        """
+        version = self.read()
+        with self._lock:
+            if self._fingerprint is None or self._fingerprint[0] != version:
+                try:
+                    latest_ids = self._connection.execute(LATEST_IDS_SQL).fetchone()
+                except sqlite3.OperationalError:
+                    # Not upgraded yet, the tables are missing
+                    latest_ids = None
+                self._fingerprint = (version, version[:2] + (latest_ids,)
+                                     + _file_marks(self.path))
+            return self._fingerprint[1]
+
+
+def _file_marks(path) -> tuple:
+    """
+    It returns the values of the database file and of its write ahead log that change with
+    their content: their size, their modification time and the change counter of the database
+    header or the salts of the log header, which are new after every reset of the log
+    """
+    marks = []
+    for name, header in ((path, slice(24, 28)), (f"{path}-wal", slice(16, 24))):
+        try:
+            with open(name, "rb") as file:
+                stat = os.fstat(file.fileno())
+                marks.append((stat.st_size, stat.st_mtime_ns, file.read(header.stop)[header]))
+        except FileNotFoundError:
+            marks.append(None)
+    return tuple(marks)
+
+
+def _database_path(bind):
+    """
+    It returns the absolute path of the SQLite database file or None when there is no file
+    """
+    url = bind.engine.url
+    path = url.database
+    if url.get_backend_name() != "sqlite" or not path or path == ":memory:":
+        return None
+    return os.path.abspath(path)
+
+
+_DATA_VERSION_PROBES = {}
+_PROBES_LOCK = threading.Lock()
+# Both answered from the end of the primary key, the latest crawl run and stored listing
+LATEST_IDS_SQL = "SELECT (SELECT MAX(id) FROM crawl_runs), (SELECT MAX(id) FROM ads)"
+# The data of the snapshot files never changes, their version is known without asking SQLite
+_SNAPSHOT_VERSIONS = {}
+
+
+def data_version(bind):
+    """
+    It returns a value that changes whenever the data of the bound SQLite database changes,
+    so the results computed for an older value can be discarded.
+
+    :param bind: the engine (or connection) of the database
+    :return: the data version or None for in-memory and non SQLite databases.
+    """
+    path = _database_path(bind)
+    if path is None:
+        return None
+    version = _SNAPSHOT_VERSIONS.get(path)
+    if version is not None:
+        return version
+    try:
+        return _probe(path).read()
+    except OSError:
+        return None
+
+
+def data_fingerprint(bind):
+    """
+    It returns a value identifying the data of the bound SQLite database in every process.
+    The data version only compares within the connection which read it, another worker or
+    the process after a restart may read the same one for different data. The fingerprint
+    is made of the identity of the file, the latest crawl run and listing ids and the marks
+    of the database file and of its write ahead log, so the entity tags built from it stay
+    valid across the processes. A snapshot is identified by its unique file.
+
+    :param bind: the engine (or connection) of the database
+    :return: the fingerprint or None for in-memory and non SQLite databases.
+    """
+    path = _database_path(bind)
+    if path is None:
+        return None
+    version = _SNAPSHOT_VERSIONS.get(path)
+    if version is not None:
+        return version
+    try:
+        return _probe(path).fingerprint()
+    except OSError:
+        return None
+
+
+def _probe(path):
+    with _PROBES_LOCK:
+        probe = _DATA_VERSION_PROBES.get(path)
+        if probe is None:
+            probe = _DATA_VERSION_PROBES[path] = _DataVersionProbe(path)
+    return probe
+
+
+def data_last_modified(bind):
+    """
+    It returns the time of the last write to the SQLite database file or its write ahead log.
+
+    :param bind: the engine (or connection) of the database
+    :return: the modification timestamp or None for in-memory and non SQLite databases.
+    """
+    path = _database_path(bind)
+    if path is None:
+        return None
+    mtimes = []
+    for name in (path, f"{path}-wal"):
+        try:
+            mtimes.append(os.stat(name).st_mtime)
+        except OSError:
+            continue
+    return max(mtimes, default=None)
+
+
+engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
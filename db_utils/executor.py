@@ -0,0 +1,43 @@
+"""
+Module holding the bounded thread pool used for the blocking database work.
+
+SQLAlchemy sessions and the SQLite driver are synchronous, so running them directly
+inside the `async def` endpoints would block the event loop for every other request.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import constants
+from utils.profiling import current_profiler
+
+
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=constants.DB_WORKERS,
+                                 thread_name_prefix="imot-db")
+
+
+def _call(func):
+    """
+    It calls the function, sampled by the profiler of the request when it is profiled
+    """
+    profiler = current_profiler()
+    if profiler is None:
+        return func()
+    with profiler.track_current_thread():
+        return func()
+
+
+async def run_in_db_executor(func, *args, **kwargs):
+    """
+    It runs the given blocking function in the database thread pool and waits for its result
+    without blocking the event loop.
+    The function runs in a copy of the caller's context, so it sees the request instrumentation.
+
+    :param func: the blocking callable (a crud query, the template rendering, the CSV builder)
+    :return: the value returned by the callable
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(DB_EXECUTOR, context.run, _call,
+                                      functools.partial(func, *args, **kwargs))
@@ -0,0 +1,192 @@
+"""
+Module bringing existing databases up to date with the models.
+
+`Base.metadata.create_all` only creates the missing tables, so the columns and the indexes
+of the tables that already exist in data/listings_data.db have to be synchronized separately.
+The new_ads table of the old layout (a copy of the listings of the last crawl run) is folded
+into the ads table as a crawl run of its own and the listings stored more than once (with the
+same url) are merged before their url gets a unique index. A new price history starts with the
+current prices of the listings.
+
+Usage: python -m db_utils.migrations
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from . import models
+from .database import Base, engine
+
+
+LEGACY_NEW_ADS_TABLE = "new_ads"
+LISTING_COLUMNS = ("source_name", "url", "price", "home_type", "home_size", "location", "image",
+                   "scraping_date")
+
+
+def add_missing_columns(bind) -> bool:
+    """
+    It adds the columns declared in the models that the existing tables do not have yet.
+    The added columns are empty (NULL) for the existing rows.
+
+    :param bind: the engine or connection of the database to be upgraded
+    :return: True when any column was added.
+    """
+    inspector = inspect(bind)
+    changed = False
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    definition = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {definition}'))
+                    changed = True
+    return changed
+
+
+def fold_legacy_new_ads(bind) -> int:
+    """
+    It moves the listings of the old new_ads table to a finished crawl run and drops the table.
+    The listings which are in the ads table already (with the same url) are marked as first
+    seen by that run, the other ones are appended to the ads table.
+
+    :param bind: the engine or connection of the database to be upgraded
+    :return: the amount of the new listings, 0 when there was no new_ads table.
+    """
+    if not inspect(bind).has_table(LEGACY_NEW_ADS_TABLE):
+        return 0
+    columns = ", ".join(LISTING_COLUMNS)
+    now = datetime.now().isoformat(timespec="seconds")
+    with bind.begin() as connection:
+        run = connection.execute(
+            text("INSERT INTO crawl_runs (started_at, finished_at) VALUES (:now, :now)"),
+            {"now": now}).lastrowid
+        connection.execute(
+            text(f"UPDATE ads SET first_seen_run = :run "
+                 f"WHERE url IN (SELECT url FROM {LEGACY_NEW_ADS_TABLE})"), {"run": run})
+        connection.execute(
+            text(f"INSERT OR IGNORE INTO ads ({columns}, first_seen_run) "
+                 f"SELECT {columns}, :run FROM {LEGACY_NEW_ADS_TABLE} "
+                 f"WHERE url NOT IN (SELECT url FROM ads WHERE first_seen_run = :run) "
+                 f"ORDER BY id"), {"run": run})
+        amount = connection.execute(
+            text(f"SELECT COUNT(*) FROM {LEGACY_NEW_ADS_TABLE}")).scalar()
+        connection.execute(text(f"DROP TABLE {LEGACY_NEW_ADS_TABLE}"))
+    return amount
+
+
+def merge_duplicate_urls(bind) -> int:
+    """
+    It keeps only the latest row of every listing (url) stored more than once, so the unique
+    url index can be built. The kept row is marked as first seen by the run of the earliest one.
+
+    :param bind: the engine or connection of the database to be upgraded
+    :return: the amount of the deleted rows.
+    """
+    inspector = inspect(bind)
+    # The url index of the old layout exists already, but it is not unique
+    if not inspector.has_table("ads") or any(
+            index["name"] == "ix_ads_url" and index["unique"]
+            for index in inspector.get_indexes("ads")):
+        return 0
+    with bind.begin() as connection:
+        connection.execute(text("CREATE TEMP TABLE url_duplicates "
+                                "(last_id INTEGER PRIMARY KEY, first_id INTEGER NOT NULL)"))
+        try:
+            connection.execute(text("INSERT INTO url_duplicates SELECT MAX(id), MIN(id) "
+                                    "FROM ads GROUP BY url HAVING COUNT(*) > 1"))
+            connection.execute(text(
+                "UPDATE ads SET first_seen_run = (SELECT first.first_seen_run "
+                "FROM url_duplicates JOIN ads AS first ON first.id = url_duplicates.first_id "
+                "WHERE url_duplicates.last_id = ads.id) "
+                "WHERE id IN (SELECT last_id FROM url_duplicates)"))
+            deleted = connection.execute(text(
+                "DELETE FROM ads WHERE id NOT IN (SELECT last_id FROM url_duplicates) "
+                "AND url IN (SELECT url FROM ads WHERE id IN "
+                "(SELECT last_id FROM url_duplicates))")).rowcount
+        finally:
+            connection.execute(text("DROP TABLE temp.url_duplicates"))
+    return deleted
+
+
+def seed_price_history(bind) -> int:
+    """
+    It records the current price of every listing with a crawl run as its first history entry,
+    at the run which first saw the listing. The listings of the old layout without a crawl run
+    get their history from the next crawl run which sees them.
+
+    :param bind: the engine or connection of the database to be upgraded
+    :return: the amount of the recorded entries.
+    """
+    with bind.begin() as connection:
+        return connection.execute(text(
+            "INSERT OR IGNORE INTO price_history (url, crawl_run, price, location) "
+            "SELECT url, first_seen_run, price, location FROM ads "
+            "WHERE first_seen_run IS NOT NULL AND price IS NOT NULL "
+            "AND location IS NOT NULL AND url IS NOT NULL")).rowcount
+
+
+def upgrade_indexes(bind) -> bool:
+    """
+    It drops the indexes that are no longer declared in the models and creates the missing ones.
+    The declared indexes existing with another uniqueness are rebuilt.
+    Only the indexes following the sqlalchemy "ix_<table>_" naming are touched.
+
+    :param bind: the engine or connection of the database to be upgraded
+    :return: True when any index was changed.
+    """
+    inspector = inspect(bind)
+    changed = False
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index["name"]: bool(index["unique"])
+                        for index in inspector.get_indexes(table.name)}
+            declared = {index.name for index in table.indexes}
+            for name in sorted(existing.keys() - declared):
+                if name.startswith(f"ix_{table.name}_"):
+                    connection.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+                    changed = True
+            for index in table.indexes:
+                if index.name in existing and existing[index.name] != bool(index.unique):
+                    connection.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+                    del existing[index.name]
+                if index.name not in existing:
+                    index.create(connection)
+                    changed = True
+        if changed:
+            # Refresh the planner statistics for the new indexes
+            connection.execute(text("ANALYZE"))
+    return changed
+
+
+def migrate(bind=engine):
+    """
+    It creates the missing tables, adds the missing columns and synchronizes the indexes of
+    the existing ones, folds the new_ads table of the old layout into the ads table and
+    merges the listings stored more than once.
+
+    :param bind: the engine of the database, defaults to the app database
+    """
+    new_price_history = not inspect(bind).has_table(models.PriceHistory.__tablename__)
+    Base.metadata.create_all(bind=bind)
+    add_missing_columns(bind)
+    # Folded before building the indexes, so the planner statistics see the crawl runs
+    folded = inspect(bind).has_table(LEGACY_NEW_ADS_TABLE)
+    fold_legacy_new_ads(bind)
+    merge_duplicate_urls(bind)
+    if new_price_history:
+        seed_price_history(bind)
+    if not upgrade_indexes(bind) and folded:
+        with bind.begin() as connection:
+            connection.execute(text("ANALYZE"))
+
+
+if __name__ == "__main__":
+    from utils import create_db_folder
+    create_db_folder()
+    migrate()
@@ -1,38 +1,161 @@
 """
 Module containing SQLAlchemy models.
 """
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String, text
 from .database import Base
 
 
+# The crud queries always order by this key (with the id as a tie breaker)
+SORT_KEY_COLUMNS = ("price", "location", "home_size", "source_name", "home_type")
+# Columns filtered by equality, from the most to the least selective one
+EQUALITY_FILTER_COLUMNS = ("location", "source_name", "home_type")
+# Column holding the crawl run which found the listing first, the new listings are the ones
+# first seen by the latest finished run
+GENERATION_COLUMN = "first_seen_run"
+
+
+def _listing_indexes(table_name):
+    """
+    It builds the composite indexes matching the filter and sort shapes of the crud queries.
+    There is one index for the unfiltered (or only price/home_size filtered) order and one per
+    equality filter column, leading with it. The rest of every index is the remaining sort key
+    (the rowid is appended implicitly), so the rows come out already ordered and the keyset
+    condition of the next page is a range seek. The other filters are checked on the index
+    entries, without reading the table.
+    The same indexes exist once more leading with the crawl run, so the new listings are
+    a range of the latest run in them.
+    """
+    indexes = []
+    for prefix, leading in (("", ()), ("run_", (GENERATION_COLUMN,))):
+        indexes.append(Index(f"ix_{table_name}_{prefix}sort", *leading, *SORT_KEY_COLUMNS))
+        for column in EQUALITY_FILTER_COLUMNS:
+            rest = [other for other in SORT_KEY_COLUMNS if other != column]
+            indexes.append(Index(f"ix_{table_name}_{prefix}{column}_sort",
+                                 *leading, column, *rest))
+    return tuple(indexes)
+
+
+class CrawlRuns(Base): # pylint: disable=R0903
+    """
+    The database model for the table with the runs of the crawler.
+    A run is finished once all of its listings were stored.
+    """
+    __tablename__ = "crawl_runs"
+    # The latest finished run is looked up in this index
+    __table_args__ = (Index("ix_crawl_runs_finished", "id",
+                            sqlite_where=text("finished_at IS NOT NULL")),)
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(String, unique=False)
+    finished_at = Column(String, unique=False, nullable=True)
+
+
+class PriceHistory(Base): # pylint: disable=R0903
+    """
+    The database model for the table with the price history of the listings.
+    An entry is appended when a crawl run sees a listing for the first time or with a new price.
+    The table is clustered by its primary key, the history of a listing is a single range of it.
+    """
+    __tablename__ = "price_history"
+    # The recent drops of a location are a range of this index, which holds all the values
+    # needed for them (the primary key is part of every index of the table)
+    __table_args__ = (Index(f"ix_{__tablename__}_drops", "location", "crawl_run", "price_change",
+                            "price", sqlite_where=text("price_change < 0")),
+                      {"sqlite_with_rowid": False})
+
+    url = Column(String, primary_key=True)
+    crawl_run = Column(Integer, ForeignKey("crawl_runs.id"), primary_key=True)
+    price = Column(Integer, nullable=False)
+    location = Column(String, nullable=False)
+    # The difference to the previous price of the listing, empty for its first entry
+    price_change = Column(Integer, nullable=True)
+
+
 class Ads(Base): # pylint: disable=R0903
     """
     The database model for the table  with all the listings.
     """
     __tablename__ = "ads"
+    # The url identifies the listing, the crawler ingest upserts by it
+    __table_args__ = _listing_indexes(__tablename__) + (
+        Index(f"ix_{__tablename__}_url", "url", unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    source_name = Column(String, unique=False)
+    url = Column(String, unique=False)
+    price = Column(Integer, unique=False)
+    home_type = Column(String, unique=False)
+    home_size = Column(Integer, unique=False)
+    location = Column(String, unique=False)
+    image = Column(String, unique=False)
+    scraping_date = Column(String, unique=False)
+    first_seen_run = Column(Integer, ForeignKey("crawl_runs.id"), nullable=True)
+
+
+class PriceHistogram(Base): # pylint: disable=R0903
+    """
+    The database model for the statistics table with the amount of listings per location,
+    home type and price per square meter bucket.
+    """
+    __tablename__ = "stats_price_histogram"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    location = Column(String, primary_key=True)
+    home_type = Column(String, primary_key=True)
+    # The price per square meter divided by the bucket width
+    bucket = Column(Integer, primary_key=True)
+    listings = Column(Integer, nullable=False)
+
+
+class MarketStats(Base): # pylint: disable=R0903
+    """
+    The database model for the statistics table with the price per square meter percentiles
+    per location and home type, computed out of the histogram.
+    """
+    __tablename__ = "stats_market"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    location = Column(String, primary_key=True)
+    home_type = Column(String, primary_key=True)
+    listings = Column(Integer, nullable=False)
+    p25 = Column(Integer, nullable=False)
+    median = Column(Integer, nullable=False)
+    p75 = Column(Integer, nullable=False)
+
+
+class SourceStats(Base): # pylint: disable=R0903
+    """
+    The database model for the statistics table with the amount of listings per source.
+    """
+    __tablename__ = "stats_sources"
+
+    source_name = Column(String, primary_key=True)
+    listings = Column(Integer, nullable=False)
+
+
+class CrawlRunStats(Base): # pylint: disable=R0903
+    """
+    The database model for the statistics table with the listings first seen by every crawl run,
+    the trend of the market over time.
+    """
+    __tablename__ = "stats_crawl_runs"
+
+    crawl_run = Column(Integer, ForeignKey("crawl_runs.id"), primary_key=True)
+    listings = Column(Integer, nullable=False)
+    # Sum of the prices per square meter of the listings, for their average
+    price_per_m2_sum = Column(Float, nullable=False)
+
+
+class StatsRefreshes(Base): # pylint: disable=R0903
+    """
+    The database model for the log of the statistics refreshes. Every refresh folds the listings
+    stored after the last listing of the previous one into the statistics.
+    """
+    __tablename__ = "stats_refreshes"
 
-    id = Column(Integer, primary_key=True, index=True)
-    source_name = Column(String, unique=False, index=True)
-    url = Column(String, unique=False, index=True)
-    price = Column(Integer, unique=False, index=True)
-    home_type = Column(String, unique=False, index=True)
-    home_size = Column(Integer, unique=False, index=True)
-    location = Column(String, unique=False, index=True)
-    image = Column(String, unique=False, index=True)
-    scraping_date = Column(String, unique=False, index=True)
-
-
-class NewAds(Base): # pylint: disable=R0903
-    """
-    Table containing only the new listings that have been collected.
-    """
-    __tablename__ = "new_ads"
-    id = Column(Integer, primary_key=True, index=True)
-    source_name = Column(String, unique=False, index=True)
-    url = Column(String, unique=False, index=True)
-    price = Column(Integer, unique=False, index=True)
-    home_type = Column(String, unique=False, index=True)
-    home_size = Column(Integer, unique=False, index=True)
-    location = Column(String, unique=False, index=True)
-    image = Column(String, unique=False, index=True)
-    scraping_date = Column(String, unique=False, index=True)
+    id = Column(Integer, primary_key=True)
+    last_ad_id = Column(Integer, nullable=False)
+    refreshed_at = Column(String, nullable=False)
+    folded = Column(Integer, nullable=False)
+    # The histogram is rebuilt when the configured bucket width changes
+    bucket_width = Column(Integer, nullable=False)
@@ -1,6 +1,7 @@
 """
 Module containing the Pydantic models.
 """
+from typing import Dict, List, Optional
 import pydantic
 
 
@@ -32,5 +33,66 @@ class Ads(pydantic.BaseModel): # pylint: disable=R0903
 
 class NewAds(Ads): # pylint: disable=R0903
     """
-    Pydantic model for the new ads table.
+    Pydantic model for the new ads, the ones first seen by the latest crawl run.
     """
+
+
+class AdsPage(pydantic.BaseModel): # pylint: disable=R0903,E1101
+    """
+    Pydantic model for a single page of ads.
+    The next_cursor/next values are empty on the last page.
+    """
+    items: List[Ads]
+    next_cursor: Optional[str] = None
+    next: Optional[str] = None
+
+
+class PriceHistoryEntry(pydantic.BaseModel): # pylint: disable=R0903,E1101
+    """
+    Pydantic model for the price of a listing seen by a crawl run.
+    The price_change is empty for the first entry of the listing.
+    """
+    crawl_run: int
+    date: str
+    price: int
+    price_change: Optional[int] = None
+
+
+class PriceHistory(pydantic.BaseModel): # pylint: disable=R0903,E1101
+    """
+    Pydantic model for the price history of a listing, from the oldest entry.
+    """
+    url: str
+    history: List[PriceHistoryEntry]
+
+
+class PriceDrop(PriceHistoryEntry): # pylint: disable=R0903
+    """
+    Pydantic model for a price drop of a listing.
+    """
+    url: str
+    previous_price: int
+
+
+class PriceDrops(pydantic.BaseModel): # pylint: disable=R0903,E1101
+    """
+    Pydantic model for the biggest recent price drops per location.
+    """
+    since: str
+    locations: Dict[str, List[PriceDrop]]
+
+
+class LocationMatch(pydantic.BaseModel): # pylint: disable=R0903,E1101
+    """
+    Pydantic model for a location matching a searched text, the score is 1 for an exact match.
+    """
+    location: str
+    score: float
+
+
+class LocationMatches(pydantic.BaseModel): # pylint: disable=R0903,E1101
+    """
+    Pydantic model for the locations matching a searched text, the best matches first.
+    """
+    query: str
+    locations: List[LocationMatch]
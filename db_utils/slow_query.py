@@ -0,0 +1,108 @@
+"""
+Module logging the crud queries slower than the configured threshold along with their
+filters and the EXPLAIN QUERY PLAN of the statements they executed.
+"""
+import contextvars
+import functools
+import logging
+import sqlite3
+import time
+
+from utils import constants
+
+
+logger = logging.getLogger("imot.slow_query")
+_CAPTURED_STATEMENTS = contextvars.ContextVar("imot_captured_statements", default=None)
+_EXHAUSTED = object()
+
+
+def capture_statement(statement, parameters):
+    """
+    It keeps the executed statement when a slow query check is running in the current context.
+    Called by the engine hooks for every statement.
+    """
+    captured = _CAPTURED_STATEMENTS.get()
+    if captured is not None:
+        captured.append((statement, parameters))
+
+
+def explain(db_session, statement, parameters) -> list:
+    """
+    It returns the steps of the query plan of the statement.
+    The plan is read on a raw DBAPI cursor, so the engine hooks neither count nor capture it.
+    """
+    cursor = db_session.connection().connection.cursor()
+    try:
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+    finally:
+        cursor.close()
+    return [row[-1] for row in rows]
+
+
+def _report(db_session, name, filters, duration, statements):
+    """
+    It logs the query when it took longer than the threshold
+    """
+    threshold = constants.SLOW_QUERY_MS
+    if threshold < 0 or duration * 1000 < threshold:
+        return
+    plans = []
+    for statement, parameters in statements:
+        if statement.lstrip().upper().startswith("SELECT"):
+            # The request succeeded already, a failed EXPLAIN only loses the plan
+            try:
+                plans.append(" | ".join(explain(db_session, statement, parameters)))
+            except sqlite3.Error as exc:
+                logger.error("EXPLAIN of the slow query %s failed: %s", name, exc)
+    logger.warning("Slow query %s took %.1f ms, filters: %s, plan: %s",
+                   name, duration * 1000, filters, " || ".join(plans) or "-")
+
+
+def _run_captured(captured, func, *args, **kwargs):
+    token = _CAPTURED_STATEMENTS.set(captured)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _CAPTURED_STATEMENTS.reset(token)
+
+
+def log_slow_queries(func):
+    """
+    Decorator of the crud functions, measuring them and logging the slow ones.
+    The filters are the keyword arguments of the call.
+    """
+    @functools.wraps(func)
+    def wrapper(db_session, *args, **kwargs):
+        if constants.SLOW_QUERY_MS < 0:
+            return func(db_session, *args, **kwargs)
+        captured = []
+        start = time.perf_counter()
+        result = _run_captured(captured, func, db_session, *args, **kwargs)
+        _report(db_session, func.__name__, kwargs, time.perf_counter() - start, captured)
+        return result
+    return wrapper
+
+
+def log_slow_iteration(func):
+    """
+    Decorator of the crud functions returning lazily fetched rows (the exports).
+    The query is measured from the start of the call until the last row was fetched.
+    """
+    @functools.wraps(func)
+    def wrapper(db_session, *args, **kwargs):
+        if constants.SLOW_QUERY_MS < 0:
+            return func(db_session, *args, **kwargs)
+        captured = []
+        start = time.perf_counter()
+        rows = _run_captured(captured, func, db_session, *args, **kwargs)
+
+        def _timed_rows():
+            iterator = iter(rows)
+            # The statement runs on the first fetch, in the context of the consumer
+            first_row = _run_captured(captured, next, iterator, _EXHAUSTED)
+            if first_row is not _EXHAUSTED:
+                yield first_row
+                yield from iterator
+            _report(db_session, func.__name__, kwargs, time.perf_counter() - start, captured)
+        return _timed_rows()
+    return wrapper
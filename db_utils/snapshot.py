@@ -0,0 +1,151 @@
+"""
+Module serving the reads from read-only snapshots of the database.
+
+In the snapshot mode the ingest keeps writing the live database while the pages are read from
+a copy of it, taken once per crawl run. The copy is written by VACUUM INTO, so it is compacted
+with all the indexes, then analyzed for the query planner and opened with immutable=1: SQLite
+takes no locks on it and the readers never contend with the writer.
+A snapshot is published by atomically replacing the pointer file of the directory. Every
+process switches to the new snapshot on its next request, the requests already running finish
+on their connections to the previous one, which is deleted only once the next one is published.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import closing
+
+from utils import constants
+from . import database
+
+__all__ = ["SnapshotStore"]
+
+
+POINTER_NAME = "CURRENT"
+SNAPSHOT_PREFIX = "snapshot-"
+SNAPSHOT_SUFFIX = ".db"
+
+
+class SnapshotStore: # pylint: disable=R0902
+    """
+    Directory of the snapshots of the database, with the engine of the published one.
+    """
+
+    def __init__(self, directory: str, pragmas: dict = None, keep: int = 2):
+        """
+        :param directory: the directory of the snapshot files and of their pointer
+        :param pragmas: the connection profile of the snapshots, defaults to
+                        constants.SNAPSHOT_PRAGMAS
+        :param keep: the amount of snapshot files kept, at least the published one
+        """
+        self.directory = directory
+        self.pragmas = pragmas
+        self.keep = max(1, keep)
+        self._pointer = os.path.join(directory, POINTER_NAME)
+        self._pointer_id = None
+        self._current = None
+        self._retired = deque()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def published(self):
+        """
+        It returns the path of the published snapshot or None when there is none
+        """
+        try:
+            with open(self._pointer, encoding="utf-8") as pointer:
+                name = pointer.read().strip()
+        except FileNotFoundError:
+            return None
+        return os.path.join(self.directory, name) if name else None
+
+    def engine(self):
+        """
+        It returns the engine of the published snapshot, switching to a newer one published
+        by any process since the previous call. Returns None when there is no snapshot yet.
+        The engine of the previous snapshot is disposed, its connections still in use are
+        closed once they are returned.
+        """
+        try:
+            stat = os.stat(self._pointer)
+        except FileNotFoundError:
+            return None
+        pointer_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if pointer_id != self._pointer_id:
+            with self._lock:
+                if pointer_id != self._pointer_id:
+                    self._switch(pointer_id)
+        return self._current[1] if self._current is not None else None
+
+    def _switch(self, pointer_id):
+        path = self.published()
+        if path is not None and (self._current is None or self._current[0] != path):
+            previous = self._current
+            self._current = (path, database.create_snapshot_engine(path, self.pragmas))
+            if previous is not None:
+                previous[1].dispose()
+                self._retired.append(previous[0])
+                # The versions of the deleted snapshots are not needed anymore
+                while len(self._retired) >= self.keep:
+                    database.forget_snapshot(self._retired.popleft())
+        self._pointer_id = pointer_id
+
+    def build(self, bind) -> str:
+        """
+        It copies the database into a new snapshot, analyzes it, publishes it and deletes
+        the oldest snapshots. The copy is a single read transaction of the database, so it
+        neither blocks nor is blocked by the writers in WAL mode.
+        Returns the path of the new snapshot.
+
+        :param bind: the engine of the live database
+        """
+        with self._build_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            # Unique across the processes, the names sort by their creation time
+            name = f"{SNAPSHOT_PREFIX}{time.time_ns()}-{os.getpid()}{SNAPSHOT_SUFFIX}"
+            path = os.path.join(self.directory, name)
+            partial = f"{path}.partial"
+            with bind.connect() as connection:
+                connection.exec_driver_sql("VACUUM INTO ?", (partial,))
+            with closing(sqlite3.connect(partial)) as snapshot:
+                # The planner statistics of the compacted tables and indexes
+                snapshot.execute("ANALYZE")
+                snapshot.commit()
+            os.replace(partial, path)
+            self._publish(name)
+            self._prune(name)
+        return path
+
+    def _publish(self, name):
+        """
+        It points the directory to the snapshot, the pointer is replaced in a single step
+        """
+        partial = f"{self._pointer}.{os.getpid()}.partial"
+        with open(partial, "w", encoding="utf-8") as pointer:
+            pointer.write(name)
+            pointer.flush()
+            os.fsync(pointer.fileno())
+        os.replace(partial, self._pointer)
+
+    def _prune(self, published):
+        """
+        It deletes the snapshots older than the kept ones, never the published one
+        """
+        names = sorted((name for name in os.listdir(self.directory)
+                        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)),
+                       reverse=True)
+        for name in names[self.keep:]:
+            if name != published:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+
+
+if __name__ == "__main__":
+    # Run by the crawler after writing the database directly, instead of through the ingest
+    from . import migrations # pylint: disable=C0415
+    migrations.migrate()
+    store = SnapshotStore(constants.SNAPSHOT_DIR, keep=constants.SNAPSHOT_KEEP)
+    print(f"Published {store.build(database.engine)}")
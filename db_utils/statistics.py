@@ -0,0 +1,200 @@
+"""
+Module materializing the market statistics of the data page into summary tables.
+
+The statistics are refreshed once per crawl run. Only the listings stored after the last
+listing folded by the previous refresh (by their id) are read, in column batches. pandas
+aggregates each batch, and the result is added to the counts of the summary tables. The
+percentiles of the price per square meter come from a histogram of it, so they are updated
+without reading the listings that were folded before. The listings that are updated later
+keep the values they were folded with until the statistics are rebuilt.
+
+Usage: python -m db_utils.statistics [--rebuild]
+"""
+import argparse
+import threading
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from utils import constants
+from . import models
+from .database import begin_immediate, engine
+
+
+PERCENTILES = {"p25": 0.25, "median": 0.5, "p75": 0.75}
+STATS_TABLES = ("stats_price_histogram", "stats_market", "stats_sources", "stats_crawl_runs",
+                "stats_refreshes")
+_LISTING_COLUMNS = ("id", "source_name", "location", "home_type", "price", "home_size",
+                    "first_seen_run")
+_NEW_LISTINGS_SQL = (f"SELECT {', '.join(_LISTING_COLUMNS)} FROM ads WHERE id > ? "
+                     f"ORDER BY id LIMIT ?")
+_ADD_SOURCES_SQL = (
+    "INSERT INTO stats_sources (source_name, listings) VALUES (?, ?) "
+    "ON CONFLICT (source_name) DO UPDATE SET listings = listings + excluded.listings")
+_ADD_HISTOGRAM_SQL = (
+    "INSERT INTO stats_price_histogram (location, home_type, bucket, listings) "
+    "VALUES (?, ?, ?, ?) ON CONFLICT (location, home_type, bucket) "
+    "DO UPDATE SET listings = listings + excluded.listings")
+_ADD_CRAWL_RUNS_SQL = (
+    "INSERT INTO stats_crawl_runs (crawl_run, listings, price_per_m2_sum) VALUES (?, ?, ?) "
+    "ON CONFLICT (crawl_run) DO UPDATE SET listings = listings + excluded.listings, "
+    "price_per_m2_sum = price_per_m2_sum + excluded.price_per_m2_sum")
+# The refreshes of the process are serialized, the ones of other processes wait for
+# the write lock taken by every batch, which then reads the refresh log they left
+_REFRESH_LOCK = threading.Lock()
+
+
+def _last_refresh(connection):
+    return connection.exec_driver_sql(
+        "SELECT last_ad_id, bucket_width FROM stats_refreshes ORDER BY id DESC LIMIT 1").fetchone()
+
+
+def _fetch_all(connection, statement, parameters=()) -> list:
+    """
+    It fetches the rows as plain tuples from the DBAPI cursor, pandas does not need the
+    sqlalchemy row objects
+    """
+    cursor = connection.connection.cursor()
+    try:
+        return cursor.execute(statement, parameters).fetchall()
+    finally:
+        cursor.close()
+
+
+def _fold(connection, frame, bucket_width):
+    """
+    It adds the counts of the listings of the frame to the summary tables
+    """
+    sources = frame.groupby("source_name").size()
+    connection.exec_driver_sql(_ADD_SOURCES_SQL, [(source_name, int(listings))
+                                                  for source_name, listings in sources.items()])
+    priced = frame[(frame["price"] > 0) & (frame["home_size"] > 0)]
+    priced = priced.assign(price_per_m2=priced["price"] / priced["home_size"])
+    priced = priced.assign(bucket=(priced["price_per_m2"] // bucket_width).astype("int64"))
+    histogram = priced.groupby(["location", "home_type", "bucket"]).size()
+    connection.exec_driver_sql(_ADD_HISTOGRAM_SQL, [
+        (location, home_type, int(bucket), int(listings))
+        for (location, home_type, bucket), listings in histogram.items()])
+    crawl_runs = priced.dropna(subset=["first_seen_run"]) \
+        .groupby("first_seen_run")["price_per_m2"].agg(["size", "sum"])
+    connection.exec_driver_sql(_ADD_CRAWL_RUNS_SQL, [
+        (int(crawl_run), int(listings), float(price_per_m2_sum))
+        for crawl_run, (listings, price_per_m2_sum) in crawl_runs.iterrows()])
+
+
+def _update_percentiles(connection, bucket_width):
+    """
+    It computes the percentiles of every location and home type out of the histogram,
+    as the middle of the bucket holding them
+    """
+    import pandas as pd # pylint: disable=C0415
+    keys = ["location", "home_type"]
+    histogram = pd.DataFrame.from_records(_fetch_all(
+        connection, "SELECT location, home_type, bucket, listings FROM stats_price_histogram "
+                    "ORDER BY location, home_type, bucket"),
+        columns=keys + ["bucket", "listings"])
+    connection.exec_driver_sql("DELETE FROM stats_market")
+    if histogram.empty:
+        return
+    groups = histogram.groupby(keys, sort=False)["listings"]
+    cumulative = groups.cumsum()
+    total = groups.transform("sum")
+    market = histogram.groupby(keys, sort=False)["listings"].sum().rename("listings").to_frame()
+    for name, fraction in PERCENTILES.items():
+        # The first bucket where the cumulative amount of listings reaches the percentile
+        buckets = histogram[cumulative >= fraction * total].groupby(keys, sort=False)["bucket"]
+        market[name] = ((buckets.first() + 0.5) * bucket_width).round().astype("int64")
+    connection.exec_driver_sql(
+        "INSERT INTO stats_market (location, home_type, listings, p25, median, p75) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(location, home_type, int(listings), int(p25), int(median), int(p75))
+         for (location, home_type), (listings, p25, median, p75)
+         in market[["listings"] + list(PERCENTILES)].iterrows()])
+
+
+def refresh_statistics(bind=engine, batch_size: int = None, rebuild: bool = False) -> int:
+    """
+    It folds the listings stored since the previous refresh into the statistics.
+    Each batch of listings is folded in a transaction of its own together with the refresh log,
+    so an interrupted refresh continues where it stopped. The percentiles are computed again
+    with the last batch.
+
+    :param bind: the engine of the database, defaults to the app database
+    :param batch_size: the amount of listings per batch, defaults to IMOT_STATS_BATCH_SIZE
+    :param rebuild: whether to drop the statistics and fold all the listings again
+    :return: the amount of the folded listings.
+    """
+    # pandas is only needed here, importing it would slow down the startup of the app
+    import pandas as pd # pylint: disable=C0415
+    bucket_width = constants.STATS_BUCKET_WIDTH
+    batch_size = batch_size or constants.STATS_BATCH_SIZE
+    folded = 0
+    with _REFRESH_LOCK:
+        with bind.begin() as connection:
+            begin_immediate(connection)
+            last_refresh = _last_refresh(connection)
+            if rebuild or (last_refresh is not None and last_refresh.bucket_width != bucket_width):
+                for table in STATS_TABLES:
+                    connection.exec_driver_sql(f"DELETE FROM {table}")
+        while True:
+            with bind.begin() as connection:
+                begin_immediate(connection)
+                # Read again in the transaction, the refreshes of other processes may have
+                # moved it meanwhile
+                last_refresh = _last_refresh(connection)
+                last_ad_id = last_refresh.last_ad_id if last_refresh is not None else 0
+                rows = _fetch_all(connection, _NEW_LISTINGS_SQL, (last_ad_id, batch_size))
+                if not rows:
+                    if folded:
+                        _update_percentiles(connection, bucket_width)
+                    break
+                frame = pd.DataFrame.from_records(rows, columns=_LISTING_COLUMNS)
+                _fold(connection, frame, bucket_width)
+                if len(rows) < batch_size:
+                    _update_percentiles(connection, bucket_width)
+                connection.exec_driver_sql(
+                    "INSERT INTO stats_refreshes (last_ad_id, refreshed_at, folded, bucket_width) "
+                    "VALUES (?, ?, ?, ?)",
+                    (int(frame["id"].iloc[-1]), datetime.now().isoformat(timespec="seconds"),
+                     len(frame), bucket_width))
+            folded += len(rows)
+            if len(rows) < batch_size:
+                break
+    return folded
+
+
+def get_statistics(db_session: Session, trend_runs: int = 30) -> dict:
+    """
+    It reads the precomputed statistics of the data page.
+
+    :param db_session: the database session
+    :param trend_runs: the amount of the latest crawl runs in the trend
+    :return: dictionary with the market percentiles per location and home type, the listings
+        per source, the trend per crawl run (the latest first) and the time of the last refresh.
+    """
+    model_market = models.MarketStats
+    model_runs = models.CrawlRunStats
+    market = db_session.query(model_market.location, model_market.home_type,
+                              model_market.listings, model_market.p25, model_market.median,
+                              model_market.p75) \
+        .order_by(model_market.location, model_market.home_type).all()
+    sources = db_session.query(models.SourceStats.source_name, models.SourceStats.listings) \
+        .order_by(models.SourceStats.listings.desc()).all()
+    trend = db_session.query(model_runs.crawl_run, models.CrawlRuns.started_at,
+                             model_runs.listings,
+                             model_runs.price_per_m2_sum / model_runs.listings) \
+        .join(models.CrawlRuns, models.CrawlRuns.id == model_runs.crawl_run) \
+        .order_by(model_runs.crawl_run.desc()).limit(trend_runs).all()
+    refreshed_at = db_session.query(models.StatsRefreshes.refreshed_at) \
+        .order_by(models.StatsRefreshes.id.desc()).limit(1).scalar()
+    return {"market": market, "sources": sources, "trend": trend, "refreshed_at": refreshed_at}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the statistics of the data page")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="drop the statistics and fold all the listings again")
+    args = parser.parse_args()
+    from . import migrations # pylint: disable=C0415
+    migrations.migrate()
+    print(f"Folded {refresh_statistics(rebuild=args.rebuild)} listings into the statistics")
@@ -2,16 +2,61 @@
 Utility script to quickly populate the tables with data.
 
 Needs to be executed only once.
+The bulk mode writes production sized tables for load testing, for example:
+python generate_test_db.py --rows 5000000 --new-rows 250000 --numpy
 """
+import argparse
 import enum
+import itertools
+import math
 import random
 import sqlite3
+import time
+import uuid
 from sqlite3 import Error
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import utils
 
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is only needed for the vectorized generation
+    np = None
+
 EXAMPLE_IMG = "https://www.treidplas.bg/wp-content/uploads/2014/06/default-placeholder.png"
+INSERT_SQL = """INSERT INTO {table}
+              (source_name, url, price, home_type, home_size, location, image, scraping_date,
+               first_seen_run)
+              VALUES(?,?,?,?,?,?,?,?,?);"""
+# Share of the listings, mean and standard deviation of the size in sq.m. per home type
+HOME_TYPE_PROFILE = {
+    utils.HomeType.DVISTAEN.value: (0.36, 68, 12),
+    utils.HomeType.TRISTAEN.value: (0.28, 98, 18),
+    utils.HomeType.EDNOSTAEN.value: (0.17, 45, 10),
+    utils.HomeType.MEZONET.value: (0.07, 170, 40),
+    utils.HomeType.MNOGOSTAEN.value: (0.07, 150, 35),
+    utils.HomeType.STUDIO.value: (0.05, 32, 7),
+}
+MIN_HOME_SIZE, MAX_HOME_SIZE = 15, 500
+# Median price per sq.m. in EUR and its spread between the listings of the same location
+MEDIAN_PRICE_PER_SQM = 1900
+PRICE_PER_SQM_SIGMA = 0.2
+# Zipf exponents of the popularity of the locations and the sources
+LOCATION_SKEW = 1.0
+SOURCE_SKEW = 0.9
+# The generated ads are scraped during the last days
+SCRAPING_DAYS = 30
+# Values of the filters of the ads endpoints found in the generated data, used by the tests
+# and the benchmarks of the queries
+FILTER_VALUES = {"source_name": utils.AdSource.ERA,
+                 "location": utils.AdLocation("Младост 1A"),
+                 "home_type": utils.HomeType.DVISTAEN,
+                 "price": 150000,
+                 "home_size": 60}
+# Every combination of the filters that the ads endpoints accept
+FILTER_SHAPES = [combination
+                 for size in range(len(FILTER_VALUES) + 1)
+                 for combination in itertools.combinations(FILTER_VALUES, size)]
 
 
 class Tables(enum.Enum):
@@ -19,10 +64,19 @@ class Tables(enum.Enum):
     Helper enumeration class.
     """
     ADS = "ads"
-    NEW_ADS = "new_ads"
+    CRAWL_RUNS = "crawl_runs"
     SUMMARY = "summary"
 
 
+def filters_of(shape) -> dict:
+    """
+    It returns the filter keyword arguments of the shape, the missing ones set to None
+    """
+    filters = dict.fromkeys(FILTER_VALUES)
+    filters.update({name: FILTER_VALUES[name] for name in shape})
+    return filters
+
+
 def create_connection(db_file):
     """
     Create a database connection to the SQLite database
@@ -91,14 +145,13 @@ def get_home_type():
 
 def build_data_entry():
     """
-    It generates a random entry for a real estate website
-    :return: A tuple of 9 elements.
+    It generates a random entry for a real estate website, its url is unique
+    :return: A tuple of 8 elements.
     """
 
     source_name = get_random_source()
-    url = "https://" + \
-        "/".join([".".join([source_name, "bg"]),
-                 str(random.choice(range(100)))])
+    # The url of a listing is unique in the ads table, also across the runs of the script
+    url = f"https://{source_name}.bg/{uuid.uuid4().hex}"
     price = get_random_price()
     home_type = get_home_type()
     home_size = get_random_home_size()
@@ -119,9 +172,204 @@ def build_dataset(amount) -> list:
     return [build_data_entry() for _ in range(amount)]
 
 
+def _zipf_weights(values, skew, rng) -> list:
+    """
+    It gives the values weights following Zipf's law, in a random (seeded) order of popularity
+    """
+    ranked = list(values)
+    rng.shuffle(ranked)
+    return ranked, [1 / (rank ** skew) for rank in range(1, len(ranked) + 1)]
+
+
+def build_profile(seed: int) -> dict:
+    """
+    It builds the distributions of the generated data, fixed for the given seed.
+    A few locations and sources get most of the listings and every location gets its own
+    price level, like in the real data.
+
+    :param seed: the seed of the random generator
+    :return: A dictionary with the values and weights of each column.
+    """
+    rng = random.Random(seed)
+    locations, location_weights = _zipf_weights(
+        [loc.value for loc in utils.AdLocation], LOCATION_SKEW, rng)
+    sources, source_weights = _zipf_weights(
+        [source.value for source in utils.AdSource], SOURCE_SKEW, rng)
+    today = datetime.now()
+    return {
+        "locations": locations,
+        "location_weights": location_weights,
+        # Price level of the location relative to the median of the city
+        "location_factors": [rng.lognormvariate(0, 0.25) for _ in locations],
+        "sources": sources,
+        "source_weights": source_weights,
+        "home_types": list(HOME_TYPE_PROFILE),
+        "home_type_weights": [weight for weight, _, _ in HOME_TYPE_PROFILE.values()],
+        "dates": [datetime.strftime(today - timedelta(days=day), '%d-%m-%y')
+                  for day in range(SCRAPING_DAYS)],
+    }
+
+
+def generate_batches(amount, batch_size=50_000, seed=42, first_id=1): # pylint: disable=R0914
+    """
+    It generates the data entries batch by batch with the distributions of build_profile.
+    The same seed always generates the same entries.
+
+    :param amount: The amount of data entries to generate
+    :param batch_size: The amount of data entries per batch
+    :param seed: the seed of the random generator
+    :param first_id: the number used in the URL of the first entry
+    :return: A generator of lists of data entries.
+    """
+    profile = build_profile(seed)
+    rng = random.Random(seed)
+    factors = dict(zip(profile["locations"], profile["location_factors"]))
+    mu = math.log(MEDIAN_PRICE_PER_SQM)
+    for start in range(0, amount, batch_size):
+        count = min(batch_size, amount - start)
+        sources = rng.choices(profile["sources"], profile["source_weights"], k=count)
+        locations = rng.choices(profile["locations"], profile["location_weights"], k=count)
+        home_types = rng.choices(profile["home_types"], profile["home_type_weights"], k=count)
+        dates = rng.choices(profile["dates"], k=count)
+        batch = []
+        for number, source_name, location, home_type, scraping_date in zip(
+                itertools.count(first_id + start), sources, locations, home_types, dates):
+            _, mean_size, size_sigma = HOME_TYPE_PROFILE[home_type]
+            home_size = min(max(int(rng.gauss(mean_size, size_sigma)), MIN_HOME_SIZE),
+                            MAX_HOME_SIZE)
+            price_per_sqm = factors[location] * rng.lognormvariate(mu, PRICE_PER_SQM_SIGMA)
+            batch.append((source_name, f"https://{source_name}.bg/{number}",
+                          int(round(home_size * price_per_sqm, -2)), home_type, home_size,
+                          location, EXAMPLE_IMG, scraping_date))
+        yield batch
+
+
+def generate_batches_numpy(amount, batch_size=200_000, seed=42, # pylint: disable=R0914
+                           first_id=1):
+    """
+    Vectorized variant of generate_batches with the same distributions, using numpy.
+    The generated entries differ from the ones of generate_batches for the same seed.
+    """
+    if np is None:
+        raise RuntimeError("The vectorized generation needs numpy to be installed")
+    profile = build_profile(seed)
+    rng = np.random.default_rng(seed)
+
+    def _probabilities(weights):
+        weights = np.asarray(weights, dtype=float)
+        return weights / weights.sum()
+
+    sources = np.array(profile["sources"], dtype=object)
+    locations = np.array(profile["locations"], dtype=object)
+    home_types = np.array(profile["home_types"], dtype=object)
+    dates = np.array(profile["dates"], dtype=object)
+    factors = np.array(profile["location_factors"])
+    mean_sizes = np.array([mean for _, mean, _ in HOME_TYPE_PROFILE.values()], dtype=float)
+    size_sigmas = np.array([sigma for _, _, sigma in HOME_TYPE_PROFILE.values()], dtype=float)
+    for start in range(0, amount, batch_size):
+        count = min(batch_size, amount - start)
+        source_idx = rng.choice(len(sources), count, p=_probabilities(profile["source_weights"]))
+        location_idx = rng.choice(len(locations), count,
+                                  p=_probabilities(profile["location_weights"]))
+        type_idx = rng.choice(len(home_types), count,
+                              p=_probabilities(profile["home_type_weights"]))
+        home_sizes = rng.normal(mean_sizes[type_idx], size_sigmas[type_idx])
+        home_sizes = home_sizes.clip(MIN_HOME_SIZE, MAX_HOME_SIZE).astype(np.int64)
+        price_per_sqm = factors[location_idx] * rng.lognormal(
+            math.log(MEDIAN_PRICE_PER_SQM), PRICE_PER_SQM_SIGMA, count)
+        prices = np.round(home_sizes * price_per_sqm, -2).astype(np.int64)
+        source_names = sources[source_idx].tolist()
+        urls = [f"https://{source_name}.bg/{number}"
+                for number, source_name in enumerate(source_names, first_id + start)]
+        yield list(zip(source_names, urls, prices.tolist(), home_types[type_idx].tolist(),
+                       home_sizes.tolist(), locations[location_idx].tolist(),
+                       itertools.repeat(EXAMPLE_IMG),
+                       dates[rng.integers(0, len(dates), count)].tolist()))
+
+
+def insert_batches(connection, table, batches, crawl_run=None) -> int:
+    """
+    It inserts every batch of data entries with executemany in a transaction of its own.
+
+    :param connection: the database connection
+    :param table: the name of the table
+    :param batches: iterable of lists of data entries
+    :param crawl_run: the id of the crawl run which found the entries
+    :return: The amount of inserted entries.
+    """
+    sql = INSERT_SQL.format(table=table)
+    inserted = 0
+    for batch in batches:
+        with connection:
+            connection.executemany(sql, [entry + (crawl_run,) for entry in batch])
+        inserted += len(batch)
+    return inserted
+
+
+def add_crawl_run(connection) -> int:
+    """
+    It adds a finished crawl run.
+
+    :param connection: the database connection
+    :return: the id of the crawl run
+    """
+    now = datetime.now().isoformat(timespec="seconds")
+    cur = connection.execute(
+        f"INSERT INTO {Tables.CRAWL_RUNS.value} (started_at, finished_at) VALUES (?, ?)",
+        (now, now))
+    connection.commit()
+    return cur.lastrowid
+
+
+def bulk_generate(connection, amount, new_amount, batch_size=50_000, # pylint: disable=R0913
+                  seed=42, use_numpy=False):
+    """
+    It fills the ads table with the given amount of generated entries found by a crawl run,
+    the last new_amount of them are found by a second (the latest) crawl run.
+    The tables are created when missing, their indexes are built by the app migrations.
+
+    :param connection: the database connection
+    :param amount: The amount of ads to generate
+    :param new_amount: The amount of the ads that are new
+    :param batch_size: The amount of entries inserted per transaction
+    :param seed: the seed of the random generator
+    :param use_numpy: whether to use the vectorized generation
+    :return: The amount of inserted ads.
+    """
+    # Nothing to lose if the generation is interrupted, the data can be generated again
+    connection.execute("PRAGMA synchronous = OFF")
+    generate_tables(connection)
+    connection.commit()
+    first_id = (connection.execute(f"SELECT MAX(id) FROM {Tables.ADS.value}").fetchone()[0]
+                or 0) + 1
+    generator = generate_batches_numpy if use_numpy else generate_batches
+    inserted = insert_batches(connection, Tables.ADS.value,
+                              generator(amount, batch_size, seed, first_id),
+                              add_crawl_run(connection))
+    latest_run = add_crawl_run(connection)
+    with connection:
+        connection.execute(f"UPDATE {Tables.ADS.value} SET first_seen_run = ? WHERE id >= ?",
+                           (latest_run, first_id + max(inserted - new_amount, 0)))
+    return inserted
+
+
+def create_crawl_runs_table(connection):
+    """
+    Inital creation of the crawl runs table.
+    """
+    sql = f'''
+    CREATE TABLE IF NOT EXISTS {Tables.CRAWL_RUNS.value} (
+    id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT
+);
+    '''
+    connection.execute(sql)
+
+
 def create_ads_table(connection, table_name):
     """
-    Inital creation of the ads tables.
+    Inital creation of the ads table.
     """
     sql = f'''
     CREATE TABLE IF NOT EXISTS {table_name} (
@@ -133,7 +381,8 @@ def create_ads_table(connection, table_name):
 	home_size INTEGER NOT NULL,
     location TEXT NOT NULL,
     image TEXT NOT NULL,
-    scraping_date TEXT NOT NULL
+    scraping_date TEXT NOT NULL,
+    first_seen_run INTEGER REFERENCES {Tables.CRAWL_RUNS.value} (id)
 );
     '''
     cur = connection.cursor()
@@ -142,52 +391,88 @@ def create_ads_table(connection, table_name):
 
 def generate_tables(connection):
     """
-    Creates all needed tables - both ads tables and the summary table
+    Creates all needed tables - the crawl runs and the ads table
     """
+    create_crawl_runs_table(connection)
     create_ads_table(connection, Tables.ADS.value)
-    create_ads_table(connection, Tables.NEW_ADS.value)
 
 
-def add_entry(connection, table, db_entry):
+def add_entry(connection, table, db_entry, crawl_run=None):
     """
     Add entry into the ads table.
     :param connection:
     :param table:
     :param entry:
+    :param crawl_run: id of the crawl run which found the entry
     :return: entry id
     """
-    sql = f'''INSERT INTO {table}
-              (source_name, url, price, home_type, home_size, location, image, scraping_date)
-              VALUES(?,?,?,?,?,?,?,?);'''
     cur = connection.cursor()
-    cur.execute(sql, db_entry)
+    cur.execute(INSERT_SQL.format(table=table), db_entry + (crawl_run,))
     connection.commit()
     return cur.lastrowid
 
 
-def show(connection, table):
+def show(connection, table, crawl_run=None):
     """
-    Visualize all entries in the ads table.
+    Visualize all entries in the ads table or only the ones found by the given crawl run.
     """
     cur = connection.cursor()
-    cur.execute(f"SELECT * FROM {table};")
+    if crawl_run is None:
+        cur.execute(f"SELECT * FROM {table};")
+    else:
+        cur.execute(f"SELECT * FROM {table} WHERE first_seen_run = ?;", (crawl_run,))
     rows = cur.fetchall()
     for row in rows:
         print(row)
 
 
-if __name__ == "__main__":
+def main():
+    """
+    Entry point of the script.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=utils.DATABASE)
+    parser.add_argument("--rows", type=int, default=None,
+                        help="bulk mode: amount of ads to generate")
+    parser.add_argument("--new-rows", type=int, default=None,
+                        help="bulk mode: amount of the generated ads that are new (5%% by default)")
+    parser.add_argument("--batch-size", type=int, default=50_000,
+                        help="bulk mode: amount of ads inserted per transaction")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--numpy", action="store_true",
+                        help="bulk mode: use the vectorized numpy generation")
+    args = parser.parse_args()
+
     utils.create_db_folder()
-    conn = create_connection(utils.DATABASE)
+    conn = create_connection(args.database)
+    if args.rows is not None:
+        new_rows = args.rows // 20 if args.new_rows is None else args.new_rows
+        start = time.perf_counter()
+        inserted = bulk_generate(conn, args.rows, new_rows, args.batch_size, args.seed,
+                                 args.numpy)
+        print(f"Inserted {inserted} ads ({min(new_rows, inserted)} new) "
+              f"in {time.perf_counter() - start:.1f}s")
+        conn.close()
+        return
+
+    random.seed(args.seed)
     # Generate the needed data
     ads_data = build_dataset(100)
     new_ads_data = build_dataset(25)
 
     with conn:
-        # Generate the tables and add the needed entries
+        # Generate the tables and add the entries of two crawl runs, the second one found
+        # the new entries
         generate_tables(conn)
+        first_run = add_crawl_run(conn)
         for entry in ads_data:
-            add_entry(conn, Tables.ADS.value, entry)
+            add_entry(conn, Tables.ADS.value, entry, first_run)
+        latest_run = add_crawl_run(conn)
         for new_entry in new_ads_data:
-            add_entry(conn, Tables.NEW_ADS.value, new_entry)
-        show(conn, Tables.NEW_ADS.value)
+            add_entry(conn, Tables.ADS.value, new_entry, latest_run)
+        show(conn, Tables.ADS.value, latest_run)
+
+
+if __name__ == "__main__":
+    main()
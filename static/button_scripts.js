@@ -1,28 +1,34 @@
 
 $ (document).ready(function(){
 
-function collectData() {
-    let filters_arr = [];
-    let loc = $("#locations-id").val();
-    let source = $("#source-id").val();
-    let home_type = $("#apartment-type-id").val();
-    let size = $("#size-id").val();
-    let price = $("#price-id").val();
-
-    if (loc) {
-    filters_arr.push(`location=${loc}`);
-    }
-    if (source) {
-    filters_arr.push(`source_name=${source}`);
+// The text inputs may hold several values separated by commas, every one of them
+// becomes a repeated query parameter
+function addValues(filters_arr, name, value) {
+    for (let item of value.split(",")) {
+    item = item.trim();
+    if (item) {
+        filters_arr.push(`${name}=${encodeURIComponent(item)}`);
     }
-    if (home_type) {
-    filters_arr.push(`home_type=${home_type}`);
     }
-    if (size) {
-    filters_arr.push(`home_size=${size}`);
+}
+
+function collectData() {
+    let filters_arr = [];
+    // The typed locations are matched by the server, prefixes, Latin letters and typos included
+    addValues(filters_arr, "location_search", $("#locations-id").val());
+    addValues(filters_arr, "source_name", $("#source-id").val());
+    addValues(filters_arr, "home_type", $("#apartment-type-id").val());
+    let bounds = {
+    "home_size": $("#size-id").val(),
+    "max_size": $("#max-size-id").val(),
+    "price": $("#price-id").val(),
+    "min_price": $("#min-price-id").val(),
+    "max_price_per_m2": $("#price-per-m2-id").val(),
+    };
+    for (let [name, value] of Object.entries(bounds)) {
+    if (value) {
+        filters_arr.push(`${name}=${encodeURIComponent(value.trim())}`);
     }
-    if (price) {
-    filters_arr.push(`price=${price}`);
     }
     return filters_arr;
 }
@@ -47,4 +53,29 @@ $("#download-btn").on("click", function(){
     location.href = generatedURL;
 });
 
+// The cards of the next page are appended when the end of the page gets close,
+// the fragment holds the cards and the holder of the page after them
+function observeNextPage() {
+    let holder = document.querySelector(".next-page-holder[data-fragment-url]");
+    if (!holder || !("IntersectionObserver" in window)) {
+    return;
+    }
+    let observer = new IntersectionObserver(function(entries) {
+    if (!entries.some(entry => entry.isIntersecting)) {
+        return;
+    }
+    observer.disconnect();
+    $.get(holder.dataset.fragmentUrl).done(function(cards) {
+        $(holder).replaceWith(cards);
+        observeNextPage();
+    }).fail(function() {
+        // The link to the next page stays as the fallback
+        holder.removeAttribute("data-fragment-url");
+    });
+    }, {rootMargin: "800px"});
+    observer.observe(holder);
+}
+
+observeNextPage();
+
 });
\ No newline at end of file
@@ -1,18 +1,28 @@
 """
 Module providing testcases for the app endpoints.
 """
+# pylint: disable=C0302
 # Built in or third party modules
+import html
 import os
+import re
+import sqlite3
+import subprocess
 import sys
+import threading
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import sessionmaker
 sys.path.append(os.getcwd())
 
 # Own imports
-from db_utils.database import Base # pylint: disable=C0413
-from utils import create_db_folder # pylint: disable=C0413
+from db_utils import crud, migrations # pylint: disable=C0413
+from db_utils.database import Base, create_sqlite_engine # pylint: disable=C0413
+from utils import constants, create_db_folder # pylint: disable=C0413
+from utils.instrumentation import filter_shape # pylint: disable=C0413
+from utils.profiling import ProfilingMiddleware # pylint: disable=C0413
+import app as main_app # pylint: disable=C0413
 from app import app, get_db # pylint: disable=C0413
 import generate_test_db # pylint: disable=C0413
 
@@ -113,12 +123,11 @@ def populate_test_db():
     """
     conn = generate_test_db.create_connection(TEST_DB_URL)
     with conn:
-        # Add entries
+        # Add entries, all of them are new
+        crawl_run = generate_test_db.add_crawl_run(conn)
         for entry in DB_TEST_ENTRIES:
             generate_test_db.add_entry(
-                conn, generate_test_db.Tables.NEW_ADS.value, entry)
-            generate_test_db.add_entry(
-                conn, generate_test_db.Tables.ADS.value, entry)
+                conn, generate_test_db.Tables.ADS.value, entry, crawl_run)
 
 
 # Module level setup and teardown, executed once at the beginnning and end of the module
@@ -195,11 +204,44 @@ class TestBasicAppEndpoints():
             # Should not have such an attribute
             response.template.name  # pylint: disable=W0104
 
+    def test_locations_search_endpoint(self):
+        """
+        Test that the locations search endpoint ranks the matching locations
+        """
+        response = client.get("/api/locations", params={"q": "mladost 1", "limit": 2})
+        assert response.is_success
+        assert response.json() == {"query": "mladost 1", "locations": [
+            {"location": "Младост 1", "score": 1.0}, {"location": "Младост 1A", "score": 0.863}]}
+        assert client.get("/api/locations", params={"q": "qwxz"}).json()["locations"] == []
+        assert client.get("/api/locations").status_code == 422
+
+    @pytest.mark.parametrize("endpoint, query_name", [("/all-ads", "get_ordered_ads"),
+                                                      ("/new-ads", "get_ordered_ads"),
+                                                      ("/download-all-ads", "stream_ads"),
+                                                      ("/download-new-ads", "stream_ads")])
+    def test_queries_run_off_event_loop(self, endpoint, query_name, monkeypatch):
+        """
+        Test that the blocking database work is executed in the database thread pool
+        """
+        original_query = getattr(crud, query_name)
+        thread_names = []
+
+        def _recording_query(*args, **kwargs):
+            thread_names.append(threading.current_thread().name)
+            return original_query(*args, **kwargs)
+
+        monkeypatch.setattr(crud, query_name, _recording_query)
+        main_app.query_cache.clear()
+        response = client.get(endpoint)
+        assert response.is_success
+        assert len(thread_names) == 1
+        assert thread_names[0].startswith("imot-db")
+
 
 # The all-ads and new-ads endpoind behave the same way as their download counterparts.
 # They just show the content in an HTML response format instead of csv
 # basic tests will be enough to show the correct numbers and behavior is present
-class TestNewAds:
+class TestNewAds: # pylint: disable=R0904
     """
     Test cases covering the behaviour of the new-ads end point
     """
@@ -212,9 +254,10 @@ class TestNewAds:
         """
         cls.endpoint = "new-ads"
 
-    def _verify_endpoint(self, response, expected_listings):
+    def _verify_endpoint(self, response, expected_listings, expected_total=None):
         """
-        Utility method to perform the needed assertions
+        Utility method to perform the needed assertions.
+        The summary counts all matching listings (expected_total), even if not all are shown.
         """
         ad_list_len = len(response.context['ad_list'])
         show_summary = response.context['show_summary']
@@ -222,7 +265,9 @@ class TestNewAds:
         assert response.is_success
         assert show_summary
         assert ad_list_len == expected_listings
-        assert sum(summary_data.values()) == ad_list_len
+        if expected_total is None:
+            expected_total = ad_list_len
+        assert sum(summary_data.values()) == expected_total
 
     def _verify_invalid_endpoint_params(self, response):
         """
@@ -246,7 +291,21 @@ class TestNewAds:
         Test data filtering based on the limit query parameter
         """
         response = client.get(f"/{self.endpoint}?limit=2")
-        self._verify_endpoint(response, expected_listings=2)
+        self._verify_endpoint(response, expected_listings=2,
+                              expected_total=len(DB_TEST_ENTRIES))
+
+    def test_summary_with_filters_and_limit(self):
+        """
+        The summary should count every listing matching the filters per source
+        """
+        response = client.get(f"/{self.endpoint}?price=250000&limit=3")
+        self._verify_endpoint(response, expected_listings=3, expected_total=21)
+        if self.endpoint == "new-ads":
+            summary_data = response.context['summary_data']
+            assert summary_data["bezkomisiona"] == 3
+            assert summary_data["home2u"] == 2
+            assert summary_data["yavlena"] == 0
+            assert len(summary_data) == len(constants.AdSource)
 
     def test_location_filter(self):
         """
@@ -300,6 +359,50 @@ class TestNewAds:
             f"/{self.endpoint}?source_name=bezkomisiona&{other_params}")
         self._verify_endpoint(response, expected_listings=1)
 
+    def test_repeated_filters(self):
+        """
+        Test data filtering based on several values of the same query parameter
+        """
+        response = client.get(
+            f"/{self.endpoint}?location=Люлин 3&location=Младост 4&location=Света троица")
+        self._verify_endpoint(response, expected_listings=4)
+        response = client.get(f"/{self.endpoint}?source_name=home2u&source_name=era"
+                              f"&home_type=Двустаен&home_type=Мезонет")
+        self._verify_endpoint(response, expected_listings=3)
+
+    def test_location_search_filter(self):
+        """
+        Test data filtering based on the free text locations, which match like the locations
+        """
+        for params in ("location_search=lulin 3&location_search=Младост 4"
+                       "&location_search=sveta troica",
+                       "location_search=lyulin 3&location=Младост 4&location_search=Света Троица",
+                       "location_search=Люлин 3&location_search=mladots 4"
+                       "&location=Света троица"):
+            response = client.get(f"/{self.endpoint}?{params}")
+            self._verify_endpoint(response, expected_listings=4)
+
+    def test_range_filters(self):
+        """
+        Test data filtering based on the inclusive bounds of the price and the home size
+        """
+        response = client.get(f"/{self.endpoint}?min_price=100000&max_price=180000")
+        self._verify_endpoint(response, expected_listings=5)
+        response = client.get(f"/{self.endpoint}?min_size=60&max_size=80")
+        self._verify_endpoint(response, expected_listings=4)
+
+    def test_price_per_m2_filters(self):
+        """
+        Test data filtering based on the bounds of the price per square meter
+        """
+        response = client.get(f"/{self.endpoint}?max_price_per_m2=1000")
+        self._verify_endpoint(response, expected_listings=8)
+        response = client.get(f"/{self.endpoint}?min_price_per_m2=1000&max_price_per_m2=2000")
+        self._verify_endpoint(response, expected_listings=11)
+        response = client.get(f"/{self.endpoint}?location=Люлин 3&location=Младост 4"
+                              f"&location=Света троица&max_price_per_m2=1500")
+        self._verify_endpoint(response, expected_listings=2)
+
     # Bad weather testcases
     def test_invalid_query_parameter(self):
         """
@@ -308,6 +411,13 @@ class TestNewAds:
         response = client.get(f"/{self.endpoint}?locc=Младост 1D")
         self._verify_endpoint(response, expected_listings=len(DB_TEST_ENTRIES))
 
+    def test_invalid_bounds(self):
+        """
+        A lower bound bigger than the upper one should return an error and invalid response
+        """
+        response = client.get(f"/{self.endpoint}?min_price=200000&max_price=100000")
+        self._verify_invalid_endpoint_params(response)
+
     def test_invalid_location_filter(self):
         """
         Invalid location filter passed should return an error and invalid response
@@ -315,6 +425,13 @@ class TestNewAds:
         response = client.get(f"/{self.endpoint}?location=Младост 1D")
         self._verify_invalid_endpoint_params(response)
 
+    def test_invalid_location_search_filter(self):
+        """
+        A free text location matching no location should return an error and invalid response
+        """
+        response = client.get(f"/{self.endpoint}?location_search=qwxz")
+        self._verify_invalid_endpoint_params(response)
+
     def test_invalid_source_filter(self):
         """
         Invalid source filter passed should return an error and invalid response
@@ -368,7 +485,7 @@ class TestAllAds(TestNewAds):
         """
         cls.endpoint = "all-ads"
 
-    def _verify_endpoint(self, response, expected_listings):
+    def _verify_endpoint(self, response, expected_listings, expected_total=None):
         """
         Utility method to perform the needed assertions
         """
@@ -435,6 +552,17 @@ id,Свалено от,Цена,Квартал,Големина в кв.м.,Ти
 """
         assert response.text.replace("\r", "").strip() == expected.strip()
 
+    def test_read_in_chunks(self, monkeypatch):
+        """
+        Streaming the rows in small chunks should produce the same file as a single chunk
+        """
+        single_chunk = client.get(f"/{self.endpoint}").text
+        monkeypatch.setattr(main_app, "CSV_CHUNK_SIZE", 4)
+        response = client.get(f"/{self.endpoint}")
+        assert response.is_success
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.text == single_chunk
+
     def test_read_with_limit(self):
         """
         Test data filtering based on the limit query parameter
@@ -480,25 +608,25 @@ id,Свалено от,Цена,Квартал,Големина в кв.м.,Ти
         response = client.get(f"/{self.endpoint}?home_size=100")
         expected = """
 id,Свалено от,Цена,Квартал,Големина в кв.м.,Тип на имота,URL,Снимка,Намерено на дата
+4,addressbg,57644,Младост 4,142,Едностаен,https://addressbg.bg/66,some_image,SOME_DATE
+6,superimoti,61497,Илинден,193,Студио,https://superimoti.bg/66,some_image,SOME_DATE
 29,imotbg,98807,Белите Брези,106,Едностаен,https://imotbg.bg/87,some_image,SOME_DATE
-30,novdom1,255456,Зона Б-5-3,111,Мезонет,https://novdom1.bg/74,some_image,SOME_DATE
-25,yavlena,299179,Дървеница,120,Мезонет,https://yavlena.bg/11,some_image,SOME_DATE
 18,superimoti,98964,Димитър Миленков,123,Многостаен,https://superimoti.bg/77,some_image,SOME_DATE
-23,bulgarianproperties,193864,Света троица,123,Мезонет,https://bulgarianproperties.bg/10,some_image,SOME_DATE
-5,avista,216479,Младост 2,125,Двустаен,https://avista.bg/96,some_image,SOME_DATE
-20,era,242059,Стрелбище,127,Едностаен,https://era.bg/30,some_image,SOME_DATE
-4,addressbg,57644,Младост 4,142,Едностаен,https://addressbg.bg/66,some_image,SOME_DATE
-12,mirelabg,232870,Левски,155,Мезонет,https://mirelabg.bg/76,some_image,SOME_DATE
-28,home2u,240912,Експериментален,156,Мезонет,https://home2u.bg/20,some_image,SOME_DATE
 9,era,131733,Света троица,163,Мезонет,https://era.bg/69,some_image,SOME_DATE
-26,luximmo,192682,Банишора,166,Едностаен,https://luximmo.bg/45,some_image,SOME_DATE
-21,galardo,215036,Дружба 2,172,Едностаен,https://galardo.bg/49,some_image,SOME_DATE
 2,bezkomisiona,170294,Слатина,185,Мезонет,https://bezkomisiona.bg/61,some_image,SOME_DATE
 10,ues,177669,Обеля 2,192,Мезонет,https://ues.bg/80,some_image,SOME_DATE
-6,superimoti,61497,Илинден,193,Студио,https://superimoti.bg/66,some_image,SOME_DATE
-15,bezkomisiona,280778,Младост 1A,193,Многостаен,https://bezkomisiona.bg/46,some_image,SOME_DATE
+26,luximmo,192682,Банишора,166,Едностаен,https://luximmo.bg/45,some_image,SOME_DATE
+23,bulgarianproperties,193864,Света троица,123,Мезонет,https://bulgarianproperties.bg/10,some_image,SOME_DATE
 3,superimoti,210395,Горубляне,195,Двустаен,https://superimoti.bg/64,some_image,SOME_DATE
+21,galardo,215036,Дружба 2,172,Едностаен,https://galardo.bg/49,some_image,SOME_DATE
+5,avista,216479,Младост 2,125,Двустаен,https://avista.bg/96,some_image,SOME_DATE
+12,mirelabg,232870,Левски,155,Мезонет,https://mirelabg.bg/76,some_image,SOME_DATE
+28,home2u,240912,Експериментален,156,Мезонет,https://home2u.bg/20,some_image,SOME_DATE
+20,era,242059,Стрелбище,127,Едностаен,https://era.bg/30,some_image,SOME_DATE
+30,novdom1,255456,Зона Б-5-3,111,Мезонет,https://novdom1.bg/74,some_image,SOME_DATE
 27,home2u,268885,Градина,199,Двустаен,https://home2u.bg/83,some_image,SOME_DATE
+15,bezkomisiona,280778,Младост 1A,193,Многостаен,https://bezkomisiona.bg/46,some_image,SOME_DATE
+25,yavlena,299179,Дървеница,120,Мезонет,https://yavlena.bg/11,some_image,SOME_DATE
 """
         assert response.text.replace("\r", "").strip() == expected.strip()
 
@@ -509,11 +637,11 @@ id,Свалено от,Цена,Квартал,Големина в кв.м.,Ти
         response = client.get(f"/{self.endpoint}?source_name=bezkomisiona")
         expected = """
 id,Свалено от,Цена,Квартал,Големина в кв.м.,Тип на имота,URL,Снимка,Намерено на дата
-2,bezkomisiona,170294,Слатина,185,Мезонет,https://bezkomisiona.bg/61,some_image,SOME_DATE
 7,bezkomisiona,98228,Овча купел 2,99,Тристаен,https://bezkomisiona.bg/30,some_image,SOME_DATE
-8,bezkomisiona,289343,Люлин,68,Студио,https://bezkomisiona.bg/57,some_image,SOME_DATE
-15,bezkomisiona,280778,Младост 1A,193,Многостаен,https://bezkomisiona.bg/46,some_image,SOME_DATE
+2,bezkomisiona,170294,Слатина,185,Мезонет,https://bezkomisiona.bg/61,some_image,SOME_DATE
 24,bezkomisiona,237987,Люлин 6,72,Многостаен,https://bezkomisiona.bg/29,some_image,SOME_DATE
+15,bezkomisiona,280778,Младост 1A,193,Многостаен,https://bezkomisiona.bg/46,some_image,SOME_DATE
+8,bezkomisiona,289343,Люлин,68,Студио,https://bezkomisiona.bg/57,some_image,SOME_DATE
 """
         assert response.text.replace("\r", "").strip() == expected.strip()
 
@@ -524,10 +652,10 @@ id,Свалено от,Цена,Квартал,Големина в кв.м.,Ти
         response = client.get(f"/{self.endpoint}?home_type=Двустаен")
         expected = """
 id,Свалено от,Цена,Квартал,Големина в кв.м.,Тип на имота,URL,Снимка,Намерено на дата
-1,luximmo,246483,Люлин 3,84,Двустаен,https://luximmo.bg/23,some_image,SOME_DATE
 3,superimoti,210395,Горубляне,195,Двустаен,https://superimoti.bg/64,some_image,SOME_DATE
 5,avista,216479,Младост 2,125,Двустаен,https://avista.bg/96,some_image,SOME_DATE
 11,arcoreal,234161,Връбница 2,81,Двустаен,https://arcoreal.bg/25,some_image,SOME_DATE
+1,luximmo,246483,Люлин 3,84,Двустаен,https://luximmo.bg/23,some_image,SOME_DATE
 27,home2u,268885,Градина,199,Двустаен,https://home2u.bg/83,some_image,SOME_DATE
 """
         assert response.text.replace("\r", "").strip() == expected.strip()
@@ -656,3 +784,653 @@ class TestDownloadAllAds(TestDownloadNewAds):
         usually contains tests).
         """
         cls.endpoint = "download-all-ads"
+
+
+class TestQueryCache:
+    """
+    Testing the cache of the ads query results.
+    """
+
+    def setup_method(self):
+        """
+        Every test starts with an empty cache
+        """
+        main_app.query_cache.clear()
+
+    @pytest.mark.parametrize("url", ["/all-ads?location=Люлин 3", "/new-ads?limit=5",
+                                     "/api/ads?home_type=Мезонет&limit=3"])
+    def test_repeated_queries_hit_the_cache(self, url, monkeypatch):
+        """
+        The same filters should be read from the database only once
+        """
+        first = client.get(url)
+        stats = main_app.query_cache.stats()
+        monkeypatch.setattr(crud, "get_filtered_ads", None)
+        monkeypatch.setattr(crud, "get_ordered_ads", None)
+        monkeypatch.setattr(crud, "get_ads_rows", None)
+        monkeypatch.setattr(crud, "count_ads_by_source", None)
+        second = client.get(url)
+        assert second.text == first.text
+        assert main_app.query_cache.stats()["hits"] == stats["hits"] + stats["entries"]
+
+    def test_new_data_invalidates_the_cache(self):
+        """
+        A change committed by another connection (the crawler) should be visible right away
+        """
+        cheapest = client.get("/api/ads?limit=1").json()["items"][0]
+        conn = generate_test_db.create_connection(TEST_DB_URL)
+        try:
+            with conn:
+                conn.execute("UPDATE ads SET price = price - 1 WHERE id = ?", (cheapest["id"],))
+            updated = client.get("/api/ads?limit=1").json()["items"][0]
+            assert updated["price"] == cheapest["price"] - 1
+            assert main_app.query_cache.stats()["invalidations"] >= 1
+        finally:
+            with conn:
+                conn.execute("UPDATE ads SET price = ? WHERE id = ?",
+                             (cheapest["price"], cheapest["id"]))
+            conn.close()
+
+
+class TestConditionalRequests:
+    """
+    Testing the ETag and Last-Modified validators of the ads endpoints.
+    """
+    ENDPOINTS = ["/all-ads?location=Люлин 3", "/new-ads?limit=5", "/api/ads?limit=3",
+                 "/api/new-ads", "/download-all-ads?price=100000", "/download-new-ads"]
+
+    @pytest.mark.parametrize("url", ENDPOINTS)
+    def test_not_modified(self, url, monkeypatch):
+        """
+        A client sending the current ETag should get 304 without any query being run
+        """
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert etag.startswith('W/"')
+        assert response.headers["cache-control"] == "no-cache"
+        assert response.headers["last-modified"].endswith("GMT")
+        for query_name in ("get_filtered_ads", "get_ordered_ads", "get_ads_rows",
+                           "count_ads_by_source", "stream_ads"):
+            monkeypatch.setattr(crud, query_name, None)
+        main_app.query_cache.clear()
+        response = client.get(url, headers={"If-None-Match": f'"other", {etag}'})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+        response = client.get(url, headers={"If-Modified-Since":
+                                            response.headers["last-modified"]})
+        assert response.status_code == 304
+
+    def test_validators_depend_on_the_query(self):
+        """
+        Different filters or endpoints should never share an ETag
+        """
+        etags = {client.get(url).headers["etag"] for url in self.ENDPOINTS}
+        assert len(etags) == len(self.ENDPOINTS)
+        response = client.get("/all-ads?location=Люлин 3",
+                              headers={"If-None-Match": client.get("/all-ads").headers["etag"]})
+        assert response.status_code == 200
+
+    def test_new_data_changes_the_etag(self):
+        """
+        After the crawler has changed the data the full response should be sent again
+        """
+        etag = client.get("/api/ads?limit=1").headers["etag"]
+        conn = generate_test_db.create_connection(TEST_DB_URL)
+        try:
+            with conn:
+                conn.execute("UPDATE ads SET home_size = home_size WHERE id = 1")
+            response = client.get("/api/ads?limit=1", headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+        finally:
+            conn.close()
+
+
+    def test_etag_across_processes(self, tmp_path, monkeypatch):
+        """
+        The ETag should follow the data, not the data version counter of the process:
+        another process (an engine with probes of its own) should tag the same data the same
+        way and answer the ETag of the previous data with the full response
+        """
+        db_file = str(tmp_path / "etag.db")
+        engines = []
+
+        def _serve(url, **headers):
+            # Every engine stands for a process of its own, with fresh data version probes
+            monkeypatch.setattr("db_utils.database._DATA_VERSION_PROBES", {})
+            engines.append(create_sqlite_engine(f"sqlite:///{db_file}"))
+            session_local = sessionmaker(bind=engines[-1])
+
+            def _get_db():
+                session = session_local()
+                try:
+                    yield session
+                finally:
+                    session.close()
+
+            monkeypatch.setitem(app.dependency_overrides, get_db, _get_db)
+            main_app.query_cache.clear()
+            return client.get(url, headers=headers)
+
+        try:
+            engines.append(create_sqlite_engine(f"sqlite:///{db_file}"))
+            migrations.migrate(engines[0])
+            conn = generate_test_db.create_connection(db_file)
+            with conn:
+                crawl_run = generate_test_db.add_crawl_run(conn)
+                generate_test_db.add_entry(conn, generate_test_db.Tables.ADS.value,
+                                           DB_TEST_ENTRIES[0], crawl_run)
+            first = _serve("/api/ads")
+            assert [item["id"] for item in first.json()["items"]] == [1]
+            etag = first.headers["etag"]
+            assert _serve("/api/ads", **{"If-None-Match": etag}).status_code == 304
+
+            with conn:
+                generate_test_db.add_entry(conn, generate_test_db.Tables.ADS.value,
+                                           DB_TEST_ENTRIES[3], crawl_run)
+            conn.close()
+            response = _serve("/api/ads", **{"If-None-Match": etag})
+            assert response.status_code == 200
+            assert [item["id"] for item in response.json()["items"]] == [2, 1]
+            assert response.headers["etag"] != etag
+            assert _serve("/api/ads").headers["etag"] == response.headers["etag"]
+        finally:
+            for process_engine in engines:
+                process_engine.dispose()
+
+
+class TestCompression:
+    """
+    Testing the compression of the dynamic responses and the links to the static files.
+    """
+
+    @pytest.mark.parametrize("url", ["/all-ads", "/download-all-ads", "/api/ads"])
+    def test_compressed(self, url):
+        """
+        Big responses should be compressed when the client accepts it
+        """
+        compressed = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert compressed.headers["content-encoding"] == "gzip"
+        assert "Accept-Encoding" in compressed.headers["vary"]
+        plain = client.get(url, headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in plain.headers
+        assert compressed.content == plain.content
+        assert int(compressed.headers.get("content-length", 0)) < len(plain.content)
+
+    def test_small_response_not_compressed(self):
+        """
+        Responses below the size threshold are not worth compressing
+        """
+        response = client.get("/api/ads?limit=1&fields=id", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+
+    def test_static_links_hashed(self):
+        """
+        The pages should link the static files with the hash of their content
+        """
+        response = client.get("/")
+        version = main_app.static_files.content_hash("styles.css")
+        assert f"/static/styles.css?v={version}" in response.text
+        assert "/static/button_scripts.js?v=" in response.text
+
+
+class TestInstrumentation:
+    """
+    Testing the Server-Timing header and the metrics endpoint.
+    """
+
+    @staticmethod
+    def _server_timing(response):
+        """
+        Utility method parsing the Server-Timing header to a dictionary of metric parameters
+        """
+        metrics = {}
+        for metric in re.split(r", (?=\w+;)", response.headers["server-timing"]):
+            name, *params = metric.split(";")
+            metrics[name] = dict(param.split("=", 1) for param in params)
+        return metrics
+
+    def test_server_timing(self):
+        """
+        The phases of the request should be timed and the queries and rows counted
+        """
+        main_app.query_cache.clear()
+        timing = self._server_timing(client.get("/new-ads?limit=5&home_size=100"))
+        assert timing["db"]["desc"] == '"2 queries, 6 rows"'
+        for name in ("db", "hydrate", "render", "total"):
+            assert float(timing[name]["dur"]) > 0
+        assert "serialize" not in timing
+        timing = self._server_timing(client.get("/api/new-ads?limit=5&home_size=100"))
+        assert float(timing["serialize"]["dur"]) > 0
+        assert "render" not in timing
+
+    def test_cached_request_timing(self):
+        """
+        A request served from the query cache should not run any query
+        """
+        client.get("/all-ads?limit=3")
+        timing = self._server_timing(client.get("/all-ads?limit=3"))
+        assert timing["db"]["desc"] == '"0 queries, 0 rows"'
+
+    def test_metrics(self):
+        """
+        The requests should be aggregated per route and filter shape
+        """
+        def _count(text, labels):
+            line = next(line for line in text.splitlines()
+                        if line.startswith(f"imot_request_duration_seconds_count{{{labels}}}"))
+            return int(line.split()[-1])
+
+        labels = 'route="/all-ads",filter_shape="location+home_type"'
+        client.get("/all-ads?home_type=Двустаен&location=Люлин 3")
+        before = _count(client.get("/metrics").text, labels)
+        client.get("/all-ads?location=Люлин 3&home_type=Двустаен&limit=2")
+        response = client.get("/metrics")
+        assert response.headers["content-type"].startswith("text/plain")
+        assert _count(response.text, labels) == before + 1
+        assert f'imot_request_duration_seconds_bucket{{{labels},le="+Inf"}}' in response.text
+        assert 'imot_request_phase_seconds_total{route="/all-ads",phase="render"}' \
+            in response.text
+        assert 'imot_db_queries_total{route="/download-all-ads"}' in response.text
+        assert "imot_query_cache_hits_total " in response.text
+        assert "imot_card_cache_entries " in response.text
+
+    @pytest.mark.parametrize("query, shape", [
+        (b"", "none"),
+        (b"limit=2&cursor=abc", "none"),
+        (b"location=x&home_type=y", "location+home_type"),
+        (b"location_search=mladost", "location_search"),
+        (b"max_price=200000&min_price=100000", "min_price+max_price"),
+        (b"min_size=50&max_size=90", "min_size+max_size"),
+        (b"max_price_per_m2=2000&min_price_per_m2=1000&location=x",
+         "location+min_price_per_m2+max_price_per_m2"),
+    ])
+    def test_filter_shape(self, query, shape):
+        """
+        Every filter parameter should be part of the shape of the request, in a fixed order
+        """
+        assert filter_shape(query) == shape
+
+    def test_metrics_new_filters(self):
+        """
+        The requests using only the range and free text filters should not be labelled none
+        """
+        client.get("/all-ads?min_price=100000&max_price_per_m2=3000&location_search=lulin")
+        labels = 'route="/all-ads",filter_shape="location_search+min_price+max_price_per_m2"'
+        assert f"imot_request_duration_seconds_count{{{labels}}}" in client.get("/metrics").text
+
+
+class TestSlowQueryLog:
+    """
+    Testing the log of the slow crud queries.
+    """
+
+    def setup_method(self):
+        """
+        Every query has to be executed
+        """
+        main_app.query_cache.clear()
+
+    def test_slow_queries_logged(self, monkeypatch, caplog):
+        """
+        The queries over the threshold should be logged with their filters and query plan
+        """
+        monkeypatch.setattr(constants, "SLOW_QUERY_MS", 0)
+        with caplog.at_level("WARNING", logger="imot.slow_query"):
+            client.get("/all-ads?location=Люлин 3&limit=5")
+            client.get("/download-new-ads?home_type=Мезонет")
+        messages = [record.getMessage() for record in caplog.records]
+        assert any(message.startswith("Slow query get_filtered_ads")
+                   and "'location': ('Люлин 3',)" in message
+                   and "USING INDEX ix_ads_location_sort" in message for message in messages)
+        assert any(message.startswith("Slow query stream_ads")
+                   and "'only_new_ads': True" in message
+                   and "USING INDEX ix_ads_run_home_type_sort" in message for message in messages)
+
+    def test_plan_not_instrumented(self, monkeypatch, caplog):
+        """
+        The EXPLAIN of a slow query should not go through the engine hooks
+        """
+        monkeypatch.setattr(constants, "SLOW_QUERY_MS", 0)
+        statements = []
+
+        def _record(_conn, _cursor, statement, _params, _context, _many):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", _record)
+        try:
+            with caplog.at_level("WARNING", logger="imot.slow_query"):
+                response = client.get("/all-ads?location=Люлин 3&limit=5")
+        finally:
+            event.remove(engine, "before_cursor_execute", _record)
+        assert response.status_code == 200
+        assert any("USING INDEX" in record.getMessage() for record in caplog.records)
+        assert statements
+        assert not any(statement.startswith("EXPLAIN") for statement in statements)
+
+    def test_failed_plan(self, monkeypatch, caplog):
+        """
+        A failed EXPLAIN should be logged without failing the request
+        """
+        def _explain(_db_session, _statement, _parameters):
+            raise sqlite3.OperationalError("database is locked")
+        monkeypatch.setattr(constants, "SLOW_QUERY_MS", 0)
+        monkeypatch.setattr("db_utils.slow_query.explain", _explain)
+        with caplog.at_level("WARNING", logger="imot.slow_query"):
+            response = client.get("/all-ads?location=Люлин 3&limit=5")
+        assert response.status_code == 200
+        messages = [record.getMessage() for record in caplog.records]
+        assert any("database is locked" in message for message in messages)
+        assert any(message.startswith("Slow query get_filtered_ads") for message in messages)
+
+    @pytest.mark.parametrize("threshold", [-1, 60000])
+    def test_fast_queries_not_logged(self, monkeypatch, caplog, threshold):
+        """
+        Nothing should be logged below the threshold or with the log disabled
+        """
+        monkeypatch.setattr(constants, "SLOW_QUERY_MS", threshold)
+        with caplog.at_level("WARNING", logger="imot.slow_query"):
+            client.get("/all-ads?location=Люлин 3&limit=5")
+            client.get("/download-new-ads")
+        assert not caplog.records
+
+
+class TestProfiling:
+    """
+    Testing the on-demand profiling of single requests.
+    """
+
+    @pytest.mark.parametrize("url", ["/new-ads?__profile=1", "/download-all-ads?__profile=1"])
+    def test_profile(self, url):
+        """
+        An admin should get the sampled stacks of the request instead of its response
+        """
+        main_app.query_cache.clear()
+        profiled = TestClient(ProfilingMiddleware(app, admin_token="secret", interval=0.0001))
+        response = profiled.get(url, headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        lines = response.text.splitlines()
+        assert lines[0] == "# response status 200"
+        assert lines[1].startswith("# ")
+        for line in lines[2:]:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+            assert "_call (executor.py" in stack
+
+    @pytest.mark.parametrize("admin_token, headers", [
+        (None, {}),
+        (None, {"X-Admin-Token": ""}),
+        ("secret", {}),
+        ("secret", {"X-Admin-Token": "guess"}),
+        ("secret", {"X-Admin-Token": "sécret".encode()}),
+        ("sécret", {"X-Admin-Token": "secret"}),
+    ])
+    def test_profile_forbidden(self, admin_token, headers):
+        """
+        Profiling should be refused without the configured admin token
+        """
+        profiled = TestClient(ProfilingMiddleware(app, admin_token=admin_token))
+        response = profiled.get("/all-ads?__profile=1", headers=headers)
+        assert response.status_code == 403
+
+    def test_non_ascii_token(self):
+        """
+        A non ASCII admin token should be compared as the UTF-8 bytes of the header
+        """
+        main_app.query_cache.clear()
+        profiled = TestClient(ProfilingMiddleware(app, admin_token="sécret"))
+        response = profiled.get("/all-ads?__profile=1",
+                                headers={"X-Admin-Token": "sécret".encode()})
+        assert response.status_code == 200
+
+    def test_parameter_not_passed(self):
+        """
+        The next page links of a profiled request should not profile again
+        """
+        profiled = TestClient(ProfilingMiddleware(app, admin_token="secret"))
+        response = profiled.get("/all-ads?limit=2&__profile=", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 200
+        assert "__profile" not in response.text
+
+
+class TestPagination:
+    """
+    Testing the cursor based pagination of the ads endpoints.
+    """
+
+    @staticmethod
+    def _collect_pages(url):
+        """
+        Utility method following the next links and collecting the ids of all pages
+        """
+        ids = []
+        pages = 0
+        while url:
+            response = client.get(url)
+            assert response.is_success
+            body = response.json()
+            ids.extend(item["id"] for item in body["items"])
+            url = body["next"]
+            pages += 1
+        return ids, pages
+
+    @pytest.mark.parametrize("endpoint", ["api/ads", "api/new-ads"])
+    def test_pages_cover_all_ads(self, endpoint):
+        """
+        Following the next links should return every ad exactly once in the unpaged order
+        """
+        unpaged = [item["id"] for item in client.get(f"/{endpoint}").json()["items"]]
+        ids, pages = self._collect_pages(f"/{endpoint}?limit=7")
+        assert ids == unpaged
+        assert len(ids) == len(DB_TEST_ENTRIES)
+        assert pages == 5
+
+    def test_filtered_pages(self):
+        """
+        The cursor should keep the filters of the first page
+        """
+        ids, pages = self._collect_pages("/api/new-ads?home_size=100&limit=4")
+        assert len(ids) == 19
+        assert len(set(ids)) == 19
+        assert pages == 5
+
+    def test_repeated_filter_pages(self):
+        """
+        The pages of several locations should follow the sort key across the locations
+        """
+        url = "/api/ads?location=Света троица&location=Люлин 3&location=Младост 4"
+        unpaged = [item["id"] for item in client.get(url).json()["items"]]
+        ids, pages = self._collect_pages(f"{url}&limit=1")
+        assert ids == unpaged
+        assert len(ids) == 4
+        assert pages == 4
+
+    def test_json_page_fields(self):
+        """
+        A page should contain the full ads, the next cursor and the Link header
+        """
+        response = client.get("/api/ads?limit=2")
+        body = response.json()
+        assert [item["price"] for item in body["items"]] == [57644, 61497]
+        assert body["next_cursor"]
+        assert body["next_cursor"] in body["next"]
+        assert response.headers["link"] == f'<{body["next"]}>; rel="next"'
+
+    def test_json_items_have_all_fields(self):
+        """
+        Without the fields parameter every column of the ads should be returned
+        """
+        body = client.get("/api/new-ads?limit=3").json()
+        assert all(list(item) == list(crud.EXPORT_COLUMNS) for item in body["items"])
+
+    @pytest.mark.parametrize("endpoint", ["api/ads", "api/new-ads"])
+    def test_fields_projection(self, endpoint):
+        """
+        Only the requested fields should be returned and the pages should still be linked
+        """
+        full_page = client.get(f"/{endpoint}?limit=5").json()
+        response = client.get(f"/{endpoint}?limit=5&fields=url, price")
+        body = response.json()
+        assert body["items"] == [{"url": item["url"], "price": item["price"]}
+                                 for item in full_page["items"]]
+        assert body["next_cursor"] == full_page["next_cursor"]
+        assert "fields=" in body["next"]
+        next_page = client.get(body["next"]).json()
+        assert all(list(item) == ["url", "price"] for item in next_page["items"])
+
+    @pytest.mark.parametrize("endpoint", ["api/ads", "api/new-ads"])
+    def test_page_size_bounded(self, endpoint):
+        """
+        The pages should be limited to the default page size and the limit should be capped
+        """
+        body = client.get(f"/{endpoint}?fields=id").json()
+        assert len(body["items"]) == min(len(DB_TEST_ENTRIES), constants.ADS_PAGE_SIZE)
+        response = client.get(f"/{endpoint}?limit={constants.ADS_MAX_PAGE_SIZE + 1}")
+        assert response.status_code == 422
+
+    @pytest.mark.parametrize("fields", ["password", "price,unknown", ","])
+    def test_invalid_fields(self, fields):
+        """
+        Unknown fields should be rejected with an invalid response
+        """
+        response = client.get(f"/api/ads?fields={fields}")
+        assert response.status_code == 422
+
+    def test_html_next_link(self):
+        """
+        The rendered page should link to the next page until the last one
+        """
+        response = client.get("/all-ads?limit=20")
+        next_url = response.context["next_url"]
+        assert "cursor=" in next_url
+        assert html.escape(next_url) in response.text
+        last_page = client.get(next_url)
+        assert len(last_page.context["ad_list"]) == 10
+        assert last_page.context["next_url"] is None
+        assert "link" not in last_page.headers
+
+    @pytest.mark.parametrize("endpoint, api_endpoint", [("all-ads", "api/ads"),
+                                                        ("new-ads", "api/new-ads")])
+    def test_card_fragments(self, endpoint, api_endpoint):
+        """
+        The page should render only its first cards, the fragments linked from it should
+        hold the rest of the ads once, without the rest of the page
+        """
+        response = client.get(f"/{endpoint}?limit=8&home_size=50")
+        assert response.template.name == "ads.html"
+        ids = [ad.id for ad in response.context["ad_list"]]
+        fragment_url = response.context["next_fragment_url"]
+        assert fragment_url.startswith(f"http://testserver/{endpoint}/cards?")
+        assert html.escape(fragment_url) in response.text
+        while fragment_url:
+            fragment = client.get(fragment_url)
+            assert fragment.template.name == "_cards.html"
+            assert "<form>" not in fragment.text
+            assert fragment.text.count('loading="lazy"') == len(fragment.context["ad_list"])
+            ids += [ad.id for ad in fragment.context["ad_list"]]
+            fragment_url = fragment.context["next_fragment_url"]
+            if fragment_url:
+                # The fallback link of a fragment leads to the full page
+                assert fragment.context["next_url"].startswith(f"http://testserver/{endpoint}?")
+        unpaged = client.get(f"/{api_endpoint}?home_size=50").json()["items"]
+        assert len(unpaged) > 16
+        assert ids == [item["id"] for item in unpaged]
+
+    @pytest.mark.parametrize("endpoint", ["all-ads", "new-ads", "all-ads/cards"])
+    def test_page_size_capped(self, endpoint):
+        """
+        The pages should not render more cards than the maximal page size
+        """
+        response = client.get(f"/{endpoint}?limit={constants.ADS_MAX_PAGE_SIZE + 1}")
+        assert response.status_code == 422
+        response = client.get(f"/{endpoint}")
+        assert len(response.context["ad_list"]) == min(constants.ADS_PAGE_SIZE,
+                                                       len(DB_TEST_ENTRIES))
+
+    @pytest.mark.parametrize("cursor", ["invalid", "W10", "WzEsMiwzXQ"])
+    def test_invalid_cursor(self, cursor):
+        """
+        Malformed cursors should be rejected with an invalid response
+        """
+        response = client.get(f"/all-ads?limit=2&cursor={cursor}")
+        assert response.status_code == 422
+
+
+class TestServerOptions:
+    """
+    Testing the options of the production and development servers.
+    """
+
+    def test_production_defaults(self):
+        """
+        The production server should run the configured workers without the reloader
+        """
+        options = main_app._server_options(main_app._parse_server_args([])) # pylint: disable=W0212
+        assert options["workers"] == constants.WORKERS
+        assert "reload" not in options
+        assert (options["host"], options["port"]) == (constants.HOST, constants.PORT)
+        assert options["backlog"] == constants.BACKLOG
+        assert options["timeout_keep_alive"] == constants.KEEP_ALIVE
+        assert options["loop"] in ("uvloop", "asyncio")
+        assert options["http"] in ("httptools", "h11")
+
+    def test_options_override(self):
+        """
+        The command line options should override the environment settings
+        """
+        args = main_app._parse_server_args([ # pylint: disable=W0212
+            "--workers", "3", "--port", "9000", "--backlog", "64", "--keep-alive", "30",
+            "--limit-concurrency", "500"])
+        options = main_app._server_options(args) # pylint: disable=W0212
+        assert options["workers"] == 3
+        assert options["port"] == 9000
+        assert (options["backlog"], options["timeout_keep_alive"]) == (64, 30)
+        assert options["limit_concurrency"] == 500
+
+    def test_dev_mode(self):
+        """
+        The development server should be a single process reloading on the changes
+        """
+        options = main_app._server_options( # pylint: disable=W0212
+            main_app._parse_server_args(["--dev", "--workers", "4"])) # pylint: disable=W0212
+        assert options["reload"]
+        assert "workers" not in options
+
+
+class TestStartup:
+    """
+    Testing that the app is prepared by its startup and not by its import.
+    """
+
+    def test_import_without_side_effects(self, tmp_path):
+        """
+        Importing the app should neither create the database nor import uvicorn and pandas
+        """
+        db_file = tmp_path / "data" / "listings.db"
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, app; print(sorted(name for name in "
+                                   "('uvicorn', 'pandas', 'numpy') if name in sys.modules))"],
+            env=dict(os.environ, IMOT_DATABASE=str(db_file)), capture_output=True, text=True,
+            check=True)
+        assert result.stdout.strip() == "[]"
+        assert not db_file.exists()
+
+    def test_startup_prepares_database(self, tmp_path, monkeypatch):
+        """
+        The startup should upgrade the database and compile the templates once
+        """
+        startup_engine = create_sqlite_engine(f"sqlite:///{tmp_path / 'startup.db'}")
+        monkeypatch.setattr(main_app, "engine", startup_engine)
+        monkeypatch.setattr(main_app, "create_db_folder", lambda: None)
+        main_app.prepare_database.cache_clear()
+        try:
+            with TestClient(app):
+                assert inspect(startup_engine).has_table("ads")
+                assert inspect(startup_engine).has_table("crawl_runs")
+                assert len(main_app.templates.env.cache) == len(
+                    main_app.templates.env.list_templates())
+        finally:
+            main_app.prepare_database.cache_clear()
+            startup_engine.dispose()
@@ -0,0 +1,95 @@
+"""
+Module providing testcases for the query results cache.
+"""
+# Built in or third party modules
+import os
+import sys
+sys.path.append(os.getcwd())
+
+# Own imports
+from utils import QueryCache # pylint: disable=C0413
+
+
+class TestQueryCache:
+    """
+    Testing the LRU, time to live and data version handling of the cache.
+    """
+
+    def setup_method(self):
+        """
+        Every test starts with a new cache holding up to 3 entries and 10 rows
+        """
+        self.cache = QueryCache(max_entries=3, max_weight=10, ttl=60) # pylint: disable=W0201
+        self.computed = [] # pylint: disable=W0201
+
+    def _get(self, key, version=1, weight=1):
+        """
+        Utility method reading the key and recording whether it was computed
+        """
+        def compute():
+            self.computed.append(key)
+            return f"value of {key}"
+        return self.cache.get_or_compute(key, version, compute, lambda value: weight)
+
+    def test_hit_and_miss(self):
+        """
+        The second read of a key should not compute it again
+        """
+        assert self._get("a") == "value of a"
+        assert self._get("a") == "value of a"
+        assert self.computed == ["a"]
+        stats = self.cache.stats()
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+    def test_new_data_version(self):
+        """
+        An entry computed for an older data version should be computed again
+        """
+        self._get("a", version=1)
+        self._get("a", version=2)
+        self._get("a", version=2)
+        assert self.computed == ["a", "a"]
+        assert self.cache.stats()["invalidations"] == 1
+
+    def test_expired_entry(self, monkeypatch):
+        """
+        An entry older than the time to live should be computed again
+        """
+        self._get("a")
+        monkeypatch.setattr("utils.cache.time.monotonic", lambda: float("inf"))
+        self._get("a")
+        assert self.computed == ["a", "a"]
+
+    def test_least_recently_used_evicted(self):
+        """
+        Going over the entries bound should drop the least recently used entry
+        """
+        for key in ("a", "b", "c"):
+            self._get(key)
+        self._get("a")
+        self._get("d")
+        self._get("a")
+        self._get("b")
+        assert self.computed == ["a", "b", "c", "d", "b"]
+        assert self.cache.stats()["evictions"] == 2
+
+    def test_weight_bound(self):
+        """
+        The total weight should stay within the bound and too heavy results are not cached
+        """
+        self._get("a", weight=6)
+        self._get("b", weight=6)
+        assert self.cache.stats()["entries"] == 1
+        assert self.cache.stats()["weight"] == 6
+        self._get("c", weight=11)
+        self._get("c", weight=11)
+        assert self.computed == ["a", "b", "c", "c"]
+
+    def test_disabled(self):
+        """
+        A cache without entries should always compute the value
+        """
+        self.cache = QueryCache(max_entries=0, max_weight=10, ttl=60) # pylint: disable=W0201
+        self._get("a")
+        self._get("a")
+        assert self.computed == ["a", "a"]
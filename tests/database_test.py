@@ -0,0 +1,576 @@
+"""
+Module providing testcases for the database layout: indexes, query plans and migrations.
+"""
+# Built in or third party modules
+import sqlite3
+import os
+import sys
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+sys.path.append(os.getcwd())
+
+# Own imports
+from db_utils import crud, database, migrations, models # pylint: disable=C0413
+from utils import constants # pylint: disable=C0413
+import app as main_app # pylint: disable=C0413
+import generate_test_db # pylint: disable=C0413
+from generate_test_db import FILTER_SHAPES, FILTER_VALUES # pylint: disable=C0413
+
+
+# Shapes of the repeated equality filters and of the range filters
+MULTI_FILTER_SHAPES = {
+    "locations": {"location": [constants.AdLocation("Младост 1A"),
+                               constants.AdLocation("Люлин 3")]},
+    "locations+types": {"location": [constants.AdLocation("Младост 1A"),
+                                     constants.AdLocation("Люлин 3")],
+                        "home_type": [constants.HomeType.DVISTAEN, constants.HomeType.TRISTAEN]},
+    "sources+type": {"source_name": [constants.AdSource.ERA, constants.AdSource.UES],
+                     "home_type": constants.HomeType.DVISTAEN},
+}
+RANGE_FILTER_SHAPES = {
+    "price": {"min_price": 100000, "max_price": 200000},
+    "size+price_per_m2": {"min_size": 50, "max_size": 90, "min_price_per_m2": 1500,
+                          "max_price_per_m2": 2500},
+    "location+all": {"location": constants.AdLocation("Младост 1A"), "min_price": 100000,
+                     "max_price": 200000, "min_size": 50, "max_size": 90,
+                     "max_price_per_m2": 2500},
+}
+LAST_ROW = {"price": 100000, "location": "Младост 1A", "home_size": 70,
+            "source_name": "era", "home_type": "Двустаен", "id": 10}
+CURSOR = crud.encode_cursor(type("LastRow", (), LAST_ROW))
+
+
+@pytest.fixture(name="plan_engine", scope="module")
+def fixture_plan_engine():
+    """
+    In-memory database with the current models, recording every executed statement.
+    The slow query log is disabled, so the recorded statements are only the ones of the queries.
+    """
+    engine = create_engine("sqlite://", poolclass=StaticPool,
+                           connect_args={"check_same_thread": False})
+    migrations.migrate(engine)
+    engine.statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, params, context, many:
+                 engine.statements.append((statement, params)))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(constants, "SLOW_QUERY_MS", -1)
+        yield engine
+    engine.dispose()
+
+
+def _query_plan(engine, statement, params):
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def _verify_plan(plan):
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+    assert all("USING INDEX" in step or "USING COVERING INDEX" in step
+               for step in plan if step.startswith(("SCAN", "SEARCH"))), plan
+
+
+class TestQueryPlans:
+    """
+    Every query issued by the ads endpoints should be served by an index without sorting.
+    """
+
+    @pytest.mark.parametrize("only_new_ads", [False, True])
+    @pytest.mark.parametrize("cursor", [None, CURSOR])
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids="+".join)
+    def test_page_query(self, plan_engine, shape, cursor, only_new_ads):
+        """
+        Test the plan of the page query of /all-ads and /new-ads
+        """
+        filters = {name: FILTER_VALUES[name] for name in shape}
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        main_app._read_ads(filters, limit=10, db_session=session, only_new_ads=only_new_ads, # pylint: disable=W0212
+                           cursor=cursor)
+        session.close()
+        _verify_plan(_query_plan(plan_engine, *plan_engine.statements[-1]))
+
+    @pytest.mark.parametrize("only_new_ads", [False, True])
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids="+".join)
+    def test_export_query(self, plan_engine, shape, only_new_ads):
+        """
+        Test the plan of the export query of /download-all-ads and /download-new-ads
+        """
+        filters = {name: FILTER_VALUES[name] for name in shape}
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        list(crud.stream_ads(session, only_new_ads=only_new_ads, **filters))
+        session.close()
+        _verify_plan(_query_plan(plan_engine, *plan_engine.statements[-1]))
+
+    @pytest.mark.parametrize("only_new_ads", [False, True])
+    @pytest.mark.parametrize("shape", FILTER_SHAPES, ids="+".join)
+    def test_summary_query(self, plan_engine, shape, only_new_ads):
+        """
+        Test the plan of the per source summary query of /new-ads
+        """
+        filters = {name: FILTER_VALUES[name] for name in shape}
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        crud.count_ads_by_source(session, only_new_ads=only_new_ads, **filters)
+        session.close()
+        plan = _query_plan(plan_engine, *plan_engine.statements[-1])
+        index = "ix_ads_run_source_name_sort" if only_new_ads else "ix_ads_source_name_sort"
+        if set(shape) <= {"source_name", "price", "home_size"}:
+            # Grouped straight from the source_name index without touching the table
+            assert f"USING COVERING INDEX {index}" in plan[0], plan
+            # The latest crawl run is looked up once
+            assert plan[1:] in ([], ["SCALAR SUBQUERY 1",
+                                     "SEARCH crawl_runs USING INDEX ix_crawl_runs_finished"])
+        else:
+            # Grouping the rows of a single location/home type is a small sort
+            assert all("USING COVERING INDEX" in step for step in plan
+                       if step.startswith(("SCAN ads", "SEARCH ads"))), plan
+
+    @pytest.mark.parametrize("cursor", [None, CURSOR])
+    @pytest.mark.parametrize("shape", MULTI_FILTER_SHAPES)
+    def test_repeated_filters_query(self, plan_engine, shape, cursor):
+        """
+        Several values of a filter should be seeks of every value in the index of the seek
+        column. Their ranges are merged by the small sort that stops at the page size.
+        """
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        main_app._read_ads(MULTI_FILTER_SHAPES[shape], limit=10, db_session=session, # pylint: disable=W0212
+                           cursor=cursor)
+        session.close()
+        plan = _query_plan(plan_engine, *plan_engine.statements[-1])
+        column = crud._seek_column(**MULTI_FILTER_SHAPES[shape]) # pylint: disable=W0212
+        assert plan[0].startswith(f"SEARCH ads USING INDEX ix_ads_{column}_sort ({column}=?"), plan
+        assert plan[1:] in ([], ["USE TEMP B-TREE FOR ORDER BY"]), plan
+
+    @pytest.mark.parametrize("only_new_ads", [False, True])
+    @pytest.mark.parametrize("shape", RANGE_FILTER_SHAPES)
+    def test_range_filters_query(self, plan_engine, shape, only_new_ads):
+        """
+        The bounds of the price, the size and the price per square meter should be checked
+        on the entries of the ordered index
+        """
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        main_app._read_ads(RANGE_FILTER_SHAPES[shape], limit=10, db_session=session, # pylint: disable=W0212
+                           only_new_ads=only_new_ads, cursor=CURSOR)
+        session.close()
+        _verify_plan(_query_plan(plan_engine, *plan_engine.statements[-1]))
+
+    def test_keyset_is_a_seek(self, plan_engine):
+        """
+        The next page should be a range seek in the index instead of a scan from the start
+        """
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        main_app._read_ads({}, limit=10, db_session=session, cursor=CURSOR) # pylint: disable=W0212
+        session.close()
+        plan = _query_plan(plan_engine, *plan_engine.statements[-1])
+        assert plan[0].startswith("SEARCH ads USING INDEX ix_ads_sort ((price,location")
+
+    def test_price_history_query(self, plan_engine):
+        """
+        The history of a listing should be a range of the primary key of the history table
+        """
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        crud.get_price_history(session, "https://era.bg/1")
+        session.close()
+        plan = _query_plan(plan_engine, *plan_engine.statements[-1])
+        assert plan[0] == "SEARCH price_history USING PRIMARY KEY (url=?)", plan
+        assert plan[1].startswith("SEARCH crawl_runs USING INTEGER PRIMARY KEY"), plan
+        assert len(plan) == 2, plan
+
+    def test_price_drops_query(self, plan_engine):
+        """
+        The recent drops of a location should be a range of the covering drops index
+        """
+        session = sessionmaker(bind=plan_engine)()
+        plan_engine.statements.clear()
+        crud.get_price_drops(session, FILTER_VALUES["location"].value, 10)
+        session.close()
+        plan = _query_plan(plan_engine, *plan_engine.statements[-1])
+        assert plan[0] == "SEARCH price_history USING COVERING INDEX ix_price_history_drops " \
+                          "(location=? AND crawl_run>?)", plan
+        assert plan[1].startswith("SEARCH crawl_runs USING INTEGER PRIMARY KEY"), plan
+
+
+def _create_old_layout(db_file, ads, new_ads):
+    """
+    It creates a database with the ads and new_ads tables of the old layout
+    """
+    conn = generate_test_db.create_connection(db_file)
+    with conn:
+        for table, entries in (("ads", ads), ("new_ads", new_ads)):
+            conn.execute(f"""CREATE TABLE {table} (id INTEGER PRIMARY KEY,
+                             source_name TEXT NOT NULL, url TEXT NOT NULL, price INTEGER NOT NULL,
+                             home_type TEXT NOT NULL, home_size INTEGER NOT NULL,
+                             location TEXT NOT NULL, image TEXT NOT NULL,
+                             scraping_date TEXT NOT NULL)""")
+            conn.executemany(f"""INSERT INTO {table} (source_name, url, price, home_type,
+                                 home_size, location, image, scraping_date)
+                                 VALUES (?,?,?,?,?,?,?,?)""", entries)
+    return conn
+
+
+def _unique_entries(amount):
+    """
+    Generated entries with unique urls
+    """
+    return [entry[:1] + (f"https://example.bg/{number}",) + entry[2:]
+            for number, entry in enumerate(generate_test_db.build_dataset(amount))]
+
+
+def _url_index_unique(inspector):
+    """
+    Whether the url index of the ads table is unique
+    """
+    return any(index["name"] == "ix_ads_url" and index["unique"]
+               for index in inspector.get_indexes("ads"))
+
+
+def _assert_upsert(engine, entry):
+    """
+    The upsert of a stored listing should update it in place
+    """
+    session = sessionmaker(bind=engine)()
+    run = models.CrawlRuns(started_at="2023-01-01")
+    session.add(run)
+    session.commit()
+    changes = crud.upsert_ads(session, [entry[:2] + (entry[2] + 1,) + entry[3:]], run.id)
+    assert changes["updated"] == 1 and changes["inserted"] == 0
+    session.close()
+
+
+class TestMigrations:
+    """
+    Testing the upgrade of databases created with the old layout.
+    """
+
+    def test_upgrade_indexes(self, tmp_path):
+        """
+        The old single column indexes should be replaced by the declared composite ones,
+        the legacy url index by a unique one
+        """
+        entries = _unique_entries(20)
+        rescraped = [entry[:2] + (1000 + number,) + entry[3:]
+                     for number, entry in enumerate(entries[:2])]
+        db_file = str(tmp_path / "old_layout.db")
+        conn = _create_old_layout(db_file, entries + rescraped, [])
+        with conn:
+            for table in ("ads", "new_ads"):
+                for column in ("id", "source_name", "url", "price", "home_type",
+                               "home_size", "location", "image", "scraping_date"):
+                    conn.execute(f"CREATE INDEX ix_{table}_{column} ON {table} ({column})")
+                conn.execute(f"CREATE INDEX custom_{table}_index ON {table} (url)")
+        conn.close()
+
+        engine = create_engine(f"sqlite:///{db_file}")
+        migrations.migrate(engine)
+        inspector = inspect(engine)
+        for model in (models.Ads, models.CrawlRuns):
+            table = model.__table__
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            declared = {index.name for index in table.indexes}
+            custom = {"custom_ads_index"} if table.name == "ads" else set()
+            assert indexes == declared | custom
+        assert _url_index_unique(inspector)
+        assert "first_seen_run" in {column["name"] for column in inspector.get_columns("ads")}
+        assert not inspector.has_table("new_ads")
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql("SELECT COUNT(*) FROM ads").scalar() == 20
+        _assert_upsert(engine, entries[0])
+        # A second run has nothing left to do
+        assert not migrations.add_missing_columns(engine)
+        assert not migrations.upgrade_indexes(engine)
+        assert not migrations.fold_legacy_new_ads(engine)
+        engine.dispose()
+
+    def test_fold_new_ads(self, tmp_path):
+        """
+        The new_ads table should become the latest crawl run of the ads table
+        """
+        entries = _unique_entries(22)
+        db_file = str(tmp_path / "old_layout.db")
+        # The last 5 ads are new, 2 more new ads are missing in the ads table
+        _create_old_layout(db_file, entries[:20], entries[15:]).close()
+
+        engine = create_engine(f"sqlite:///{db_file}")
+        migrations.migrate(engine)
+        session = sessionmaker(bind=engine)()
+        new_ads = crud.get_filtered_ads(session, only_new_ads=True)
+        assert sorted(ad.url for ad in new_ads) == sorted(entry[1] for entry in entries[15:])
+        assert len(crud.get_filtered_ads(session)) == 22
+        assert sum(crud.count_ads_by_source(session, only_new_ads=True).values()) == 7
+        # The price history starts with the current prices of the listings with a crawl run
+        history = crud.get_price_history(session, entries[20][1])
+        assert [(row.price, row.price_change) for row in history] == [(entries[20][2], None)]
+        assert session.query(models.PriceHistory).count() == 7
+        session.close()
+        engine.dispose()
+
+    def test_merge_duplicate_urls(self, tmp_path):
+        """
+        Only the latest row of a listing stored more than once should be kept, as first seen
+        by the run of the earliest one
+        """
+        entries = _unique_entries(5)
+        rescraped = [entry[:2] + (1000 + number,) + entry[3:]
+                     for number, entry in enumerate(entries[:2])]
+        db_file = str(tmp_path / "duplicates.db")
+        conn = _create_old_layout(db_file, entries + rescraped, entries[3:] + rescraped[1:])
+        with conn:
+            # The url index of the old layout, created by index=True
+            conn.execute("CREATE INDEX ix_ads_url ON ads (url)")
+        conn.close()
+
+        engine = create_engine(f"sqlite:///{db_file}")
+        migrations.migrate(engine)
+        assert _url_index_unique(inspect(engine))
+        session = sessionmaker(bind=engine)()
+        ads = {ad.url: ad for ad in crud.get_filtered_ads(session)}
+        assert len(ads) == 5
+        assert ads[entries[0][1]].price == 1000
+        assert ads[entries[1][1]].price == 1001
+        # The listing re-scraped by the last crawl run stays new
+        assert sorted(ad.url for ad in crud.get_filtered_ads(session, only_new_ads=True)) == \
+            sorted(entry[1] for entry in entries[3:] + entries[1:2])
+        session.close()
+        _assert_upsert(engine, entries[2])
+        engine.dispose()
+
+
+class TestCrawlRuns: # pylint: disable=R0903
+    """
+    Testing the new ads, the ones first seen by the latest finished crawl run.
+    """
+
+    def test_latest_finished_run(self):
+        """
+        Only the ads of the latest finished run should be new
+        """
+        engine = create_engine("sqlite://", poolclass=StaticPool,
+                               connect_args={"check_same_thread": False})
+        migrations.migrate(engine)
+        session = sessionmaker(bind=engine)()
+        assert not crud.get_filtered_ads(session, only_new_ads=True)
+
+        entries = _unique_entries(30)
+        for run, finished_at in ((1, "2023-01-01"), (2, "2023-01-02"), (3, None)):
+            session.add(models.CrawlRuns(id=run, started_at="2023-01-01",
+                                         finished_at=finished_at))
+            for entry in entries[(run - 1) * 10:run * 10]:
+                session.add(models.Ads(**dict(zip(migrations.LISTING_COLUMNS, entry)),
+                                       first_seen_run=run))
+        session.commit()
+
+        new_urls = sorted(entry[1] for entry in entries[10:20])
+        assert sorted(ad.url for ad in crud.get_filtered_ads(session, only_new_ads=True)) \
+            == new_urls
+        assert sorted(row.url for row in crud.get_ads_rows(session, ("url",),
+                                                           only_new_ads=True)) == new_urls
+        assert len(list(crud.stream_ads(session, only_new_ads=True))) == 10
+        assert len(crud.get_ordered_ads(session, only_new_ads=True)) == 10
+        assert len(crud.get_filtered_ads(session)) == 30
+        session.close()
+        engine.dispose()
+
+
+class TestNullSortKeys:
+    """
+    Testing the pages of the listings with empty sort key columns.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        """
+        Listings with NULL prices, locations, sizes and types, some of them equal otherwise
+        """
+        cls.engine = create_engine("sqlite://", poolclass=StaticPool,
+                                   connect_args={"check_same_thread": False})
+        migrations.migrate(cls.engine)
+        cls.session_local = sessionmaker(bind=cls.engine)
+        session = cls.session_local()
+        session.add(models.CrawlRuns(id=1, started_at="2023-01-01", finished_at="2023-01-01"))
+        values = [(None, "Люлин 3", 60), (None, None, None), (100000, None, 70),
+                  (100000, "Люлин 3", None), (100000, "Люлин 3", 60), (100000, None, None),
+                  (90000, "Младост 1", None), (None, "Люлин 3", None), (100000, "Люлин 3", 60)]
+        for number, (price, location, home_size) in enumerate(values * 2):
+            session.add(models.Ads(source_name="era" if number % 3 else None,
+                                   url=f"https://era.bg/{number}", price=price,
+                                   location=location, home_size=home_size,
+                                   home_type=None if number % 4 else "Двустаен",
+                                   first_seen_run=1))
+        session.commit()
+        session.close()
+
+    @classmethod
+    def teardown_class(cls):
+        """
+        Close the in-memory database
+        """
+        cls.engine.dispose()
+
+    @pytest.mark.parametrize("filters", [{}, {"location": constants.AdLocation("Люлин 3")},
+                                         {"source_name": constants.AdSource.ERA}])
+    def test_pages_cover_null_keys(self, filters):
+        """
+        Following the cursors page by page should return every listing once, in the order
+        of the unpaged query, also after the pages ending on NULL values
+        """
+        session = self.session_local()
+        unpaged = [ad.id for ad in crud.get_filtered_ads(session, **filters)]
+        ids = []
+        after = None
+        while True:
+            page = crud.get_filtered_ads(session, limit=1, after=after, **filters)
+            if not page:
+                break
+            ids.append(page[0].id)
+            after = crud.decode_cursor(crud.encode_cursor(page[0]))
+        session.close()
+        assert ids == unpaged
+        assert len(ids) == len(set(ids)) > 1
+
+    def test_api_pages(self):
+        """
+        The next links of the JSON API should lead across the listings with NULL values
+        """
+        def override_get_db():
+            session = self.session_local()
+            try:
+                yield session
+            finally:
+                session.close()
+
+        previous = main_app.app.dependency_overrides.get(main_app.get_db)
+        main_app.app.dependency_overrides[main_app.get_db] = override_get_db
+        try:
+            client = TestClient(main_app.app)
+            url = "/api/ads?limit=1"
+            ids = []
+            while url:
+                response = client.get(url)
+                assert response.status_code == 200
+                ids += [item["id"] for item in response.json()["items"]]
+                url = response.json()["next"]
+        finally:
+            if previous is None:
+                main_app.app.dependency_overrides.pop(main_app.get_db)
+            else:
+                main_app.app.dependency_overrides[main_app.get_db] = previous
+        assert sorted(ids) == list(range(1, 19))
+
+    def test_cursor_values(self):
+        """
+        Only the id of a cursor has to be set
+        """
+        last_row = dict.fromkeys(crud.SORT_KEY[:-1], None)
+        assert crud.decode_cursor(crud.encode_cursor(
+            type("LastRow", (), dict(last_row, id=3)))) == (None,) * 5 + (3,)
+        with pytest.raises(ValueError):
+            crud.decode_cursor(crud.encode_cursor(type("LastRow", (), dict(last_row, id=None))))
+
+
+class TestConnectionProfile:
+    """
+    Testing the SQLite connection profile applied to the app connections.
+    """
+
+    def test_pragmas_applied(self, tmp_path):
+        """
+        Every pooled connection should be configured with the profile
+        """
+        engine = database.create_sqlite_engine(f"sqlite:///{tmp_path / 'profile.db'}")
+        with engine.connect() as connection:
+            def pragma(name):
+                return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            assert pragma("journal_mode") == "wal"
+            assert pragma("synchronous") == 1  # NORMAL
+            assert pragma("temp_store") == 2  # MEMORY
+            assert pragma("cache_size") == int(constants.SQLITE_PRAGMAS["cache_size"])
+            assert pragma("busy_timeout") == int(constants.SQLITE_PRAGMAS["busy_timeout"])
+        assert engine.pool.size() == constants.DB_WORKERS
+        engine.dispose()
+
+    def test_invalid_pragma_value(self, tmp_path):
+        """
+        Values that are not plain words or numbers should never reach the PRAGMA statement
+        """
+        engine = database.create_sqlite_engine(f"sqlite:///{tmp_path / 'invalid.db'}",
+                                               pragmas={"cache_size": "1; DROP TABLE ads"})
+        with pytest.raises(ValueError):
+            engine.connect()
+        engine.dispose()
+
+    def test_begin_immediate(self, tmp_path):
+        """
+        The write transaction should hold the write lock from its start until the commit,
+        the writers of other processes wait for it and the readers are not blocked
+        """
+        db_file = tmp_path / "immediate.db"
+        engine = database.create_sqlite_engine(f"sqlite:///{db_file}")
+        other_process = sqlite3.connect(db_file, timeout=0)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE items (id INTEGER PRIMARY KEY)")
+        with engine.begin() as connection:
+            database.begin_immediate(connection)
+            # Already in the transaction, nothing to do
+            database.begin_immediate(connection)
+            assert connection.exec_driver_sql("SELECT COUNT(*) FROM items").scalar() == 0
+            with pytest.raises(sqlite3.OperationalError, match="locked"):
+                other_process.execute("INSERT INTO items VALUES (1)")
+            assert other_process.execute("SELECT COUNT(*) FROM items").fetchone() == (0,)
+            other_process.rollback()
+            connection.exec_driver_sql("INSERT INTO items VALUES (2)")
+        other_process.execute("INSERT INTO items VALUES (1)")
+        other_process.commit()
+        assert other_process.execute("SELECT COUNT(*) FROM items").fetchone() == (2,)
+        other_process.close()
+        engine.dispose()
+
+    def test_failed_statement_timing(self, tmp_path):
+        """
+        The start of a failed statement should not be left in the connection
+        """
+        engine = database.create_sqlite_engine(f"sqlite:///{tmp_path / 'failed.db'}")
+        with engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(OperationalError):
+                    connection.exec_driver_sql("SELECT * FROM missing")
+            assert not connection.info["query_start"]
+        engine.dispose()
+
+    @pytest.mark.parametrize("journal_mode", ["WAL", "DELETE"])
+    def test_data_fingerprint(self, tmp_path, monkeypatch, journal_mode):
+        """
+        The fingerprint should be the same in every process for the same data and change with
+        every commit, also with the in-place updates which add no row
+        """
+        db_file = tmp_path / "fingerprint.db"
+        engine = database.create_sqlite_engine(
+            f"sqlite:///{db_file}", dict(constants.SQLITE_PRAGMAS, journal_mode=journal_mode))
+        migrations.migrate(engine)
+
+        def _fresh_fingerprint():
+            # The probes of another process
+            monkeypatch.setattr(database, "_DATA_VERSION_PROBES", {})
+            return database.data_fingerprint(engine)
+
+        fingerprints = [_fresh_fingerprint()]
+        assert database.data_fingerprint(engine) == _fresh_fingerprint() == fingerprints[0]
+        for statement in ("INSERT INTO crawl_runs (id, started_at) VALUES (1, '2023-01-01')",
+                          "UPDATE crawl_runs SET finished_at = '2023-01-01'",
+                          "UPDATE crawl_runs SET finished_at = '2023-01-02'"):
+            with engine.begin() as connection:
+                connection.exec_driver_sql(statement)
+            fingerprints.append(_fresh_fingerprint())
+        assert len(set(fingerprints)) == len(fingerprints)
+        assert database.data_fingerprint(create_engine("sqlite://")) is None
+        engine.dispose()
@@ -0,0 +1,83 @@
+"""
+Module providing testcases for the bulk generation of test data.
+"""
+# Built in or third party modules
+import collections
+import os
+import sys
+import pytest
+sys.path.append(os.getcwd())
+
+# Own imports
+import generate_test_db # pylint: disable=C0413
+from utils import constants # pylint: disable=C0413
+
+
+GENERATORS = [generate_test_db.generate_batches,
+              pytest.param(generate_test_db.generate_batches_numpy,
+                           marks=pytest.mark.skipif(generate_test_db.np is None,
+                                                    reason="numpy is not installed"))]
+
+
+class TestBulkGeneration:
+    """
+    Testing the generated data and its bulk insertion.
+    """
+
+    @pytest.mark.parametrize("generator", GENERATORS)
+    def test_batches(self, generator):
+        """
+        The entries should come in batches of the requested size with valid values
+        """
+        batches = list(generator(2500, batch_size=1000, seed=1, first_id=10))
+        assert [len(batch) for batch in batches] == [1000, 1000, 500]
+        entries = [entry for batch in batches for entry in batch]
+        assert entries[0][1] == f"https://{entries[0][0]}.bg/10"
+        assert len({entry[1] for entry in entries}) == 2500
+        for source_name, _, price, home_type, home_size, location, _, _ in entries:
+            constants.AdSource(source_name)
+            constants.HomeType(home_type)
+            constants.AdLocation(location)
+            assert generate_test_db.MIN_HOME_SIZE <= home_size <= generate_test_db.MAX_HOME_SIZE
+            assert isinstance(price, int) and price > 0
+
+    @pytest.mark.parametrize("generator", GENERATORS)
+    def test_fixed_seed(self, generator):
+        """
+        The same seed should always generate the same entries
+        """
+        first = list(generator(300, batch_size=100, seed=7))
+        assert first == list(generator(300, batch_size=100, seed=7))
+        assert first != list(generator(300, batch_size=100, seed=8))
+
+    @pytest.mark.parametrize("generator", GENERATORS)
+    def test_skew(self, generator):
+        """
+        A few locations should get most of the ads and the sizes should follow the home type
+        """
+        entries = [entry for batch in generator(20000, seed=3) for entry in batch]
+        locations = collections.Counter(entry[5] for entry in entries).most_common()
+        assert locations[0][1] > 10 * locations[-1][1]
+        sizes = collections.defaultdict(list)
+        for entry in entries:
+            sizes[entry[3]].append(entry[4])
+        assert sum(sizes["Студио"]) / len(sizes["Студио"]) < \
+            sum(sizes["Тристаен"]) / len(sizes["Тристаен"])
+
+    def test_bulk_generate(self, tmp_path):
+        """
+        The new ads should be the last generated ads, more ads should be appended by a new crawl run
+        """
+        conn = generate_test_db.create_connection(str(tmp_path / "bulk.db"))
+        new_ads_sql = """SELECT url FROM ads WHERE first_seen_run =
+                         (SELECT MAX(id) FROM crawl_runs) ORDER BY id"""
+        assert generate_test_db.bulk_generate(conn, 1000, 100, batch_size=300) == 1000
+        first_new_ads = conn.execute(new_ads_sql).fetchall()
+        generate_test_db.bulk_generate(conn, 500, 50, batch_size=300, seed=2)
+        ads = conn.execute("SELECT url FROM ads ORDER BY id").fetchall()
+        new_ads = conn.execute(new_ads_sql).fetchall()
+        conn.close()
+        assert len(ads) == 1500
+        assert len({url for url, in ads}) == 1500
+        assert first_new_ads == ads[900:1000]
+        assert new_ads == ads[1450:1500]
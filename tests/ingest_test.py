@@ -0,0 +1,351 @@
+"""
+Module providing testcases for the crawler ingest: parsing, validation and the upsert endpoint.
+"""
+# Built in or third party modules
+import asyncio
+import json
+import os
+import sys
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+sys.path.append(os.getcwd())
+
+# Own imports
+from db_utils import crud, migrations # pylint: disable=C0413
+from db_utils.snapshot import SnapshotStore # pylint: disable=C0413
+from utils import constants # pylint: disable=C0413
+from utils.ingest import AdParser, iter_line_batches, validate_ad # pylint: disable=C0413
+import app as main_app # pylint: disable=C0413
+from app import app, get_db, get_writer_db # pylint: disable=C0413
+
+
+AD = {"source_name": "era", "url": "https://era.bg/1", "price": 120000,
+      "home_type": "Двустаен", "home_size": 65, "location": "Люлин 3",
+      "image": "some_image", "scraping_date": "01-02-23"}
+ADMIN_HEADERS = {"X-Admin-Token": "secret"}
+
+
+def _ads(amount, **changes):
+    """
+    Valid listings with unique urls
+    """
+    return [dict(AD, url=f"https://era.bg/{number}", **changes) for number in range(amount)]
+
+
+def _ndjson(records) -> bytes:
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode()
+
+
+class TestAdParser:
+    """
+    Testing the single pass parsing and validation of the ingested lines.
+    """
+
+    def test_valid_ad(self):
+        """
+        The values should be returned in the order of the ingest columns
+        """
+        assert validate_ad(AD) == tuple(AD[column] for column in crud.INGEST_COLUMNS)
+        # Missing image and scraping date are stored empty
+        assert validate_ad(dict(AD, image=None, scraping_date=None))[-2:] == ("", "")
+
+    @pytest.mark.parametrize("changes", [{"source_name": "unknown"},
+                                         {"location": "Paris"},
+                                         {"home_type": "Замък"},
+                                         {"price": -1},
+                                         {"price": "1e5"},
+                                         {"price": True},
+                                         {"home_size": 0},
+                                         {"url": "era.bg/1"},
+                                         {"url": None},
+                                         {"image": 5}])
+    def test_invalid_ad(self, changes):
+        """
+        Listings with unknown or malformed values should be refused
+        """
+        with pytest.raises(ValueError):
+            validate_ad(dict(AD, **changes))
+
+    def test_ndjson(self):
+        """
+        The invalid lines should be rejected with their line numbers, the empty ones skipped
+        """
+        parser = AdParser("ndjson")
+        lines = _ndjson([AD, dict(AD, location="Paris")]).splitlines()
+        rows = parser.parse(lines + [b"", b"{not json", b"[1, 2]", b"\xff\xfe"])
+        assert rows == [validate_ad(AD)]
+        assert parser.rejected == 4
+        assert [error["line"] for error in parser.errors] == [2, 4, 5, 6]
+        assert "location" in parser.errors[0]["error"]
+        # The line numbers continue in the next batch
+        parser.parse([b"{}"])
+        assert parser.errors[-1]["line"] == 7
+
+    def test_csv(self):
+        """
+        The values should be taken by the names in the header, the exported CSV can be ingested
+        """
+        parser = AdParser("csv")
+        header = ",".join(("id",) + tuple(AD)).encode()
+        line = ",".join(["1"] + [str(value) for value in AD.values()]).encode()
+        assert parser.parse([header, line]) == [validate_ad(AD)]
+        assert not parser.parse([line + b",extra", b'"quoted, location",x'])
+        assert parser.rejected == 2
+
+    def test_errors_capped(self):
+        """
+        Only the first rejected lines should be reported, all of them counted
+        """
+        parser = AdParser("ndjson")
+        parser.parse([b"{}"] * 150)
+        assert parser.rejected == 150
+        assert len(parser.errors) == 100
+
+    @pytest.mark.parametrize("chunks, batch_size, expected", [
+        ([b"a\nb", b"\nc\n"], 10, [[b"a", b"b", b"c"]]),
+        ([b"a\r\nb\r\n", b"c"], 2, [[b"a", b"b"], [b"c"]]),
+        ([b"a", b"", b"b\n", b"c\nd\ne\n"], 2, [[b"ab", b"c"], [b"d", b"e"]]),
+        ([], 2, []),
+    ])
+    def test_line_batches(self, chunks, batch_size, expected):
+        """
+        The body should be split into lines regardless of the chunk borders
+        """
+        async def _chunks():
+            for chunk in chunks:
+                yield chunk
+
+        async def _collect():
+            return [batch async for batch in iter_line_batches(_chunks(), batch_size)]
+
+        assert asyncio.run(_collect()) == expected
+
+
+class TestIngestEndpoint:
+    """
+    Testing the upsert of the ingested listings into a database of their own.
+    """
+
+    @classmethod
+    def setup_class(cls):
+        """
+        The endpoints of the test client use an in-memory database
+        """
+        cls.engine = create_engine("sqlite://", poolclass=StaticPool,
+                                   connect_args={"check_same_thread": False})
+        cls.session_local = sessionmaker(autocommit=False, autoflush=False, bind=cls.engine)
+        cls.previous_override = app.dependency_overrides.get(get_db)
+
+        def override_get_db():
+            database = cls.session_local()
+            try:
+                yield database
+            finally:
+                database.close()
+
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_writer_db] = override_get_db
+        cls.client = TestClient(app)
+
+    @classmethod
+    def teardown_class(cls):
+        """
+        The other test modules get their database back
+        """
+        app.dependency_overrides[get_db] = cls.previous_override
+        app.dependency_overrides.pop(get_writer_db)
+        cls.engine.dispose()
+
+    def setup_method(self):
+        """
+        Every test starts with an empty database and the admin token configured
+        """
+        migrations.Base.metadata.drop_all(bind=self.engine)
+        migrations.migrate(self.engine)
+        self.admin_token = constants.ADMIN_TOKEN # pylint: disable=W0201
+        constants.ADMIN_TOKEN = "secret"
+
+    def teardown_method(self):
+        """
+        Restore the configured admin token
+        """
+        constants.ADMIN_TOKEN = self.admin_token
+
+    def _ingest(self, body, content_type="application/x-ndjson", **params):
+        return self.client.post("/api/ingest", content=body, params=params,
+                                headers={"Content-Type": content_type, **ADMIN_HEADERS})
+
+    def _new_urls(self):
+        urls = []
+        url = "/api/new-ads?fields=url"
+        while url:
+            body = self.client.get(url).json()
+            urls.extend(item["url"] for item in body["items"])
+            url = body["next"]
+        return sorted(urls)
+
+    @pytest.mark.parametrize("admin_token, headers",
+                             [(None, ADMIN_HEADERS),
+                              ("secret", {}),
+                              ("secret", {"X-Admin-Token": "guess"}),
+                              ("secret", {"X-Admin-Token": "gué".encode()})])
+    def test_forbidden(self, admin_token, headers):
+        """
+        The ingest should be refused without the configured admin token
+        """
+        constants.ADMIN_TOKEN = admin_token
+        response = self.client.post("/api/ingest", content=_ndjson([AD]),
+                                    headers={"Content-Type": "application/x-ndjson", **headers})
+        assert response.status_code == 403
+
+    def test_unsupported_content_type(self):
+        """
+        Only NDJSON and CSV bodies should be accepted
+        """
+        assert self._ingest(b"<ads/>", "application/xml").status_code == 415
+
+    def test_upsert(self, monkeypatch):
+        """
+        The listings should be inserted, updated or left unchanged by their url, batch by batch
+        """
+        monkeypatch.setattr(constants, "INGEST_BATCH_SIZE", 4)
+        ads = _ads(10)
+        response = self._ingest(_ndjson(ads + [dict(AD, location="Paris")]))
+        assert response.status_code == 200
+        result = response.json()
+        assert result["finished"] is True
+        assert result["totals"] == {"lines": 11, "rows": 10, "rejected": 1,
+                                    "inserted": 10, "updated": 0, "unchanged": 0}
+        assert [batch["lines"] for batch in result["batches"]] == [4, 4, 3]
+        assert result["errors"][0]["line"] == 11
+        assert self._new_urls() == sorted(ad["url"] for ad in ads)
+
+        # The next crawl run sees 5 of the listings again, 2 of them with a new price
+        seen_again = ads[:3] + [dict(ad, price=99000) for ad in ads[3:5]]
+        result = self._ingest(_ndjson(seen_again + _ads(12)[10:])).json()
+        assert result["crawl_run"] == 2
+        assert result["totals"]["inserted"] == 2
+        assert result["totals"]["updated"] == 2
+        assert result["totals"]["unchanged"] == 3
+        # Only the listings first seen by the latest run are new
+        assert self._new_urls() == ["https://era.bg/10", "https://era.bg/11"]
+        response = self.client.get("/api/ads", params={"fields": "url,price", "limit": 100})
+        prices = {item["url"]: item["price"] for item in response.json()["items"]}
+        assert len(prices) == 12
+        assert prices["https://era.bg/3"] == 99000
+
+    def test_csv_export_ingested(self):
+        """
+        The CSV export of the app should be ingested unchanged
+        """
+        self._ingest(_ndjson(_ads(5)))
+        exported = self.client.get("/download-all-ads").content
+        result = self._ingest(exported, "text/csv; charset=utf-8").json()
+        assert result["totals"] == {"lines": 6, "rows": 5, "rejected": 0,
+                                    "inserted": 0, "updated": 0, "unchanged": 5}
+
+    def test_crawl_run_continued(self):
+        """
+        A crawl run should span several requests and its listings become new once it finishes
+        """
+        first = self._ingest(_ndjson(_ads(3)), finish=False).json()
+        assert first["finished"] is False
+        assert not self._new_urls()
+        crawl_run = first["crawl_run"]
+        second = self._ingest(_ndjson(_ads(6)[3:]), crawl_run=crawl_run).json()
+        assert second["crawl_run"] == crawl_run
+        assert len(self._new_urls()) == 6
+        assert self._ingest(b"", crawl_run=crawl_run).status_code == 409
+        assert self._ingest(b"", crawl_run=crawl_run + 1).status_code == 404
+
+    def test_price_history(self):
+        """
+        Every crawl run which sees a listing with a new price should add to its history
+        """
+        ads = _ads(3)
+        self._ingest(_ndjson(ads))
+        self._ingest(_ndjson([dict(ads[0], price=110000), ads[1]]))
+        self._ingest(_ndjson([dict(ads[0], price=130000)]))
+        response = self.client.get("/api/price-history", params={"url": ads[0]["url"]})
+        assert response.status_code == 200
+        history = response.json()["history"]
+        assert [(entry["crawl_run"], entry["price"], entry["price_change"])
+                for entry in history] == [(1, 120000, None), (2, 110000, -10000),
+                                          (3, 130000, 20000)]
+        assert history[0]["date"]
+        # An unchanged price is not recorded again
+        response = self.client.get("/api/price-history", params={"url": ads[1]["url"]})
+        assert len(response.json()["history"]) == 1
+        response = self.client.get("/api/price-history", params={"url": "https://era.bg/x"})
+        assert response.status_code == 404
+
+    def test_price_changes_within_a_run(self):
+        """
+        A crawl run should keep one entry per listing, with the change since the previous run
+        """
+        ad = _ads(1)[0]
+        self._ingest(_ndjson([ad]))
+        crawl_run = self._ingest(_ndjson([dict(ad, price=100000)]), finish=False).json()
+        self._ingest(_ndjson([dict(ad, price=90000), dict(ad, price=95000)]),
+                     crawl_run=crawl_run["crawl_run"])
+        history = self.client.get("/api/price-history", params={"url": ad["url"]}).json()
+        assert [(entry["price"], entry["price_change"]) for entry in history["history"]] == \
+            [(120000, None), (95000, -25000)]
+
+    def test_price_drops(self):
+        """
+        The biggest drops should come first, grouped by location
+        """
+        ads = _ads(4) + [dict(AD, url="https://era.bg/mladost", location="Младост 1")]
+        self._ingest(_ndjson(ads))
+        drops = [dict(ads[0], price=100000), dict(ads[1], price=60000),
+                 dict(ads[2], price=150000), dict(ads[4], price=119000)]
+        self._ingest(_ndjson(drops))
+        response = self.client.get("/api/price-drops")
+        assert response.status_code == 200
+        locations = response.json()["locations"]
+        assert set(locations) == {"Люлин 3", "Младост 1"}
+        assert [(drop["url"], drop["previous_price"], drop["price"], drop["price_change"])
+                for drop in locations["Люлин 3"]] == [("https://era.bg/1", 120000, 60000, -60000),
+                                                      ("https://era.bg/0", 120000, 100000, -20000)]
+        response = self.client.get("/api/price-drops",
+                                   params={"location": "Люлин 3", "limit": 1})
+        assert [drop["url"] for drop in response.json()["locations"]["Люлин 3"]] == \
+            ["https://era.bg/1"]
+        assert self.client.get("/api/price-drops", params={"location": "Paris"}).status_code \
+            == 422
+
+    def test_statistics_refreshed(self):
+        """
+        The statistics of the data page should include the listings of every finished crawl run
+        """
+        self._ingest(_ndjson(_ads(4)))
+        self._ingest(_ndjson(_ads(6)[4:]), finish=False)
+        response = self.client.get("/data")
+        assert response.context["sources"] == [("era", 4)]
+        (location, home_type, listings, *_), = response.context["market"]
+        assert (location, home_type, listings) == ("Люлин 3", "Двустаен", 4)
+        assert "Люлин 3" in response.text
+
+    def test_snapshot_published(self, monkeypatch, tmp_path):
+        """
+        In the snapshot mode a finished crawl run should publish the snapshot read by the pages
+        """
+        store = SnapshotStore(str(tmp_path))
+        monkeypatch.setattr(main_app, "snapshots", store)
+        monkeypatch.setattr(constants, "SNAPSHOT_MODE", True)
+        assert self._ingest(_ndjson(_ads(3)), finish=False).json()["snapshot"] is None
+        assert store.published() is None
+        result = self._ingest(_ndjson(_ads(5)[3:]), crawl_run=1).json()
+        assert os.path.join(str(tmp_path), result["snapshot"]) == store.published()
+        sessions = main_app.get_db()
+        db_session = next(sessions)
+        try:
+            assert db_session.get_bind() is store.engine()
+            assert len(crud.get_filtered_ads(db_session, only_new_ads=True)) == 5
+        finally:
+            sessions.close()
+            store.engine().dispose()
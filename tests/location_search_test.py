@@ -0,0 +1,84 @@
+"""
+Module providing testcases for the free text location search.
+"""
+# Built in or third party modules
+import os
+import sys
+import pytest
+sys.path.append(os.getcwd())
+
+# Own imports
+from utils import constants # pylint: disable=C0413
+from utils.location_search import location_index, transliterate # pylint: disable=C0413
+
+
+class TestLocationSearch:
+    """
+    Testing the transliteration, the matching and the ranking of the locations.
+    """
+
+    def test_transliterate(self):
+        """
+        The Latin letters should become Cyrillic ones, the longest sequences first
+        """
+        assert transliterate("Oborishte") == "оборище"
+        assert transliterate("Lyulin-3") == "люлин 3"
+        assert transliterate("  Hadzhi   Dimitar ") == "хаджи димитар"
+        assert transliterate("Младост 1A") == "младост 1а"
+
+    @pytest.mark.parametrize("query, expected", [
+        ("Младост 1A", ("Младост 1A",)),
+        ("mladost 1a", ("Младост 1A",)),
+        ("МЛАДОСТ 1а", ("Младост 1A",)),
+        ("lulin 3", ("Люлин 3",)),
+        ("lyulin 3", ("Люлин 3",)),
+        ("zona b5", ("Зона Б-5",)),
+        ("Люлин", ("Люлин",)),
+    ])
+    def test_exact_match(self, query, expected):
+        """
+        A full name, in any case and script, should stand only for its location
+        """
+        assert location_index().resolve(query) == expected
+
+    def test_prefix_match(self):
+        """
+        A prefix should stand for every location it starts
+        """
+        mladost = tuple(sorted(location.value for location in constants.AdLocation
+                               if location.value.startswith("Младост")))
+        assert len(mladost) == 5
+        assert location_index().resolve("mladost") == mladost
+        assert location_index().resolve("Младост") == mladost
+        assert location_index().resolve("studentski") == ("Студентски град",)
+
+    @pytest.mark.parametrize("query, expected", [
+        ("mladots 2", "Младост 2"),
+        ("dianabd", "Дианабад"),
+        ("Оборишще", "Оборище"),
+        ("tsentar", "Център"),
+    ])
+    def test_typo_match(self, query, expected):
+        """
+        A misspelled name should stand for the most similar location
+        """
+        assert location_index().resolve(query) == (expected,)
+
+    @pytest.mark.parametrize("query", ["", "  ", "qwxz", "Париж"])
+    def test_no_match(self, query):
+        """
+        A text without similar locations should match nothing
+        """
+        assert not location_index().resolve(query)
+        assert not location_index().search(query)
+
+    def test_ranking(self):
+        """
+        The exact match should come first, then the prefix matches, then the fuzzy ones
+        """
+        results = location_index().search("lulin 1", limit=5)
+        assert results[0] == ("Люлин 1", 1.0)
+        assert results[1][0] == "Люлин 10"
+        scores = [score for _, score in results]
+        assert scores == sorted(scores, reverse=True)
+        assert len(location_index().search("lulin", limit=3)) == 3
@@ -0,0 +1,154 @@
+"""
+Module providing testcases for the read-only snapshots of the database.
+"""
+# Built in or third party modules
+import os
+import sqlite3
+import sys
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+sys.path.append(os.getcwd())
+
+# Own imports
+from db_utils import database, migrations # pylint: disable=C0413
+from db_utils.snapshot import SnapshotStore # pylint: disable=C0413
+import generate_test_db # pylint: disable=C0413
+
+
+COUNT_ADS = "SELECT COUNT(*) FROM ads"
+
+
+@pytest.fixture(name="live_engine")
+def fixture_live_engine(tmp_path):
+    """
+    Database file in WAL mode with 500 generated listings
+    """
+    db_file = str(tmp_path / "live.db")
+    connection = generate_test_db.create_connection(db_file)
+    generate_test_db.bulk_generate(connection, 500, 50, seed=3)
+    connection.close()
+    engine = database.create_sqlite_engine(f"sqlite:///{db_file}")
+    migrations.migrate(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(name="store")
+def fixture_store(tmp_path):
+    """
+    Empty snapshot directory
+    """
+    store = SnapshotStore(str(tmp_path / "snapshots"))
+    yield store
+    if store.engine() is not None:
+        store.engine().dispose()
+
+
+def _count(bind):
+    with bind.connect() as connection:
+        return connection.exec_driver_sql(COUNT_ADS).scalar()
+
+
+class TestSnapshots:
+    """
+    Testing the build, the publication and the switch of the snapshots.
+    """
+
+    def test_build(self, live_engine, store):
+        """
+        The snapshot should hold the data and the indexes of the database, analyzed,
+        without a journal and read-only
+        """
+        assert store.engine() is None
+        path = store.build(live_engine)
+        assert store.published() == path
+        snapshot_engine = store.engine()
+        assert _count(snapshot_engine) == _count(live_engine) == 500
+        assert {index["name"] for index in inspect(snapshot_engine).get_indexes("ads")} == \
+            {index["name"] for index in inspect(live_engine).get_indexes("ads")}
+        with snapshot_engine.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "delete"
+            assert connection.exec_driver_sql("SELECT COUNT(*) FROM sqlite_stat1").scalar()
+            with pytest.raises(OperationalError):
+                connection.exec_driver_sql("DELETE FROM ads")
+        assert database.data_version(snapshot_engine) == database.data_version(snapshot_engine)
+        assert database.data_version(snapshot_engine) != database.data_version(live_engine)
+
+    def test_switch(self, live_engine, store):
+        """
+        A new snapshot should serve the next requests, the running ones should finish
+        on the previous snapshot
+        """
+        store.build(live_engine)
+        old_engine = store.engine()
+        old_version = database.data_version(old_engine)
+        running = sessionmaker(bind=old_engine)()
+        assert running.execute(text(COUNT_ADS)).scalar() == 500
+
+        with live_engine.begin() as connection:
+            connection.exec_driver_sql("DELETE FROM ads WHERE id % 5 = 0")
+        store.build(live_engine)
+        new_engine = store.engine()
+        assert new_engine is not old_engine
+        assert database.data_version(new_engine) != old_version
+        assert _count(new_engine) == 400
+        assert running.execute(text(COUNT_ADS)).scalar() == 500
+        running.close()
+
+    def test_writer_not_contended(self, live_engine, store):
+        """
+        Neither the reads of the snapshot nor the build of the next one should wait
+        for a write transaction of the live database
+        """
+        store.build(live_engine)
+        writer = sqlite3.connect(live_engine.url.database, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        writer.execute("DELETE FROM ads")
+        assert _count(store.engine()) == 500
+        store.build(live_engine)
+        assert _count(store.engine()) == 500
+        writer.execute("COMMIT")
+        writer.close()
+        store.build(live_engine)
+        assert _count(store.engine()) == 0
+
+    def test_published_by_other_process(self, live_engine, store):
+        """
+        Every store of the directory should switch to the snapshot published by any of them
+        """
+        other = SnapshotStore(store.directory)
+        other.build(live_engine)
+        assert store.published() == other.published()
+        assert _count(store.engine()) == 500
+        assert str(store.engine().url.database) == other.published()
+        other.engine().dispose()
+
+    def test_prune(self, live_engine, tmp_path):
+        """
+        Only the newest snapshots should be kept, the published one among them
+        """
+        store = SnapshotStore(str(tmp_path / "snapshots"), keep=2)
+        paths = [store.build(live_engine) for _ in range(4)]
+        assert sorted(name for name in os.listdir(store.directory)
+                      if name.endswith(".db")) == sorted(os.path.basename(path)
+                                                         for path in paths[-2:])
+        assert store.published() == paths[-1]
+
+    def test_reused_inode(self, live_engine, store):
+        """
+        A snapshot reusing the inode of a deleted one should get a version of its own
+        """
+        path = store.build(live_engine)
+        old_version = database.data_version(store.engine())
+        old_fingerprint = database.data_fingerprint(store.engine())
+        store.engine().dispose()
+        # The renamed file keeps its inode, like a new file reusing the freed one
+        renamed = os.path.join(store.directory, "snapshot-0-0.db")
+        os.rename(path, renamed)
+        new_engine = database.create_snapshot_engine(renamed)
+        assert database.data_version(new_engine) != old_version
+        assert database.data_fingerprint(new_engine) != old_fingerprint
+        new_engine.dispose()
+        database.forget_snapshot(renamed)
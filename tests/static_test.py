@@ -0,0 +1,86 @@
+"""
+Module providing testcases for the precompressed static files.
+"""
+# Built in or third party modules
+import gzip
+import os
+import sys
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+sys.path.append(os.getcwd())
+
+# Own imports
+from utils import static # pylint: disable=C0413
+
+
+STYLES = b"body { margin: 0; }\n" * 100
+
+
+@pytest.fixture(name="static_client")
+def fixture_static_client(tmp_path):
+    """
+    Client of an app serving a static directory with a single precompressed stylesheet
+    """
+    (tmp_path / "styles.css").write_bytes(STYLES)
+    (tmp_path / "tiny.js").write_bytes(b"let a;")
+    static.precompress_directory(str(tmp_path))
+    test_app = FastAPI()
+    static_files = static.PrecompressedStaticFiles(directory=str(tmp_path))
+    test_app.mount("/static", static_files, name="static")
+    yield TestClient(test_app), static_files
+
+
+class TestPrecompressedStaticFiles:
+    """
+    Testing the precompressed variants and the content hashed URLs of the static files.
+    """
+
+    def test_variants_built(self, tmp_path, static_client): # pylint: disable=W0613
+        """
+        Only the files worth compressing should get variants, built once
+        """
+        assert gzip.decompress((tmp_path / "styles.css.gz").read_bytes()) == STYLES
+        assert not (tmp_path / "tiny.js.gz").exists()
+        assert not static.precompress_directory(str(tmp_path))
+
+    @pytest.mark.parametrize("accept_encoding, expected_encoding",
+                             [("gzip", "gzip"), ("identity", None), ("gzip;q=0", None),
+                              pytest.param("gzip, br", "br", marks=pytest.mark.skipif(
+                                  static.brotli is None, reason="brotli is not installed"))])
+    def test_negotiated_variant(self, static_client, accept_encoding, expected_encoding):
+        """
+        The variant accepted by the client should be served with the original media type
+        """
+        client, _ = static_client
+        response = client.get("/static/styles.css", headers={"Accept-Encoding": accept_encoding})
+        assert response.status_code == 200
+        assert response.headers.get("content-encoding") == expected_encoding
+        assert response.headers["content-type"].startswith("text/css")
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.content == STYLES
+
+    def test_stale_variant_ignored(self, tmp_path, static_client):
+        """
+        A variant older than the file should not be served
+        """
+        client, _ = static_client
+        stale = os.path.getmtime(tmp_path / "styles.css") - 10
+        os.utime(tmp_path / "styles.css.gz", (stale, stale))
+        response = client.get("/static/styles.css", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+
+    def test_hashed_url_cached_forever(self, tmp_path, static_client):
+        """
+        Only the URLs with the hash of the current content should be cached by the browsers
+        """
+        client, static_files = static_client
+        version = static_files.content_hash("styles.css")
+        response = client.get(f"/static/styles.css?v={version}")
+        assert response.headers["cache-control"] == static.IMMUTABLE_CACHE_CONTROL
+        response = client.get("/static/styles.css")
+        assert response.headers["cache-control"] == "no-cache"
+        (tmp_path / "styles.css").write_bytes(STYLES + b"p { margin: 1px; }\n")
+        assert static_files.content_hash("styles.css") != version
+        response = client.get(f"/static/styles.css?v={version}")
+        assert response.headers["cache-control"] == "no-cache"
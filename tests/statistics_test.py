@@ -0,0 +1,112 @@
+"""
+Module providing testcases for the precomputed market statistics of the data page.
+"""
+# Built in or third party modules
+import os
+import sys
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+sys.path.append(os.getcwd())
+
+# Own imports
+from db_utils import migrations, statistics # pylint: disable=C0413
+from utils import constants # pylint: disable=C0413
+import generate_test_db # pylint: disable=C0413
+
+
+def _generate(db_file, amount, seed):
+    """
+    Bulk generated listings, found by two crawl runs
+    """
+    connection = generate_test_db.create_connection(db_file)
+    generate_test_db.bulk_generate(connection, amount, amount // 10, seed=seed)
+    connection.close()
+
+
+def _tables(engine, tables=statistics.STATS_TABLES[:-1]):
+    """
+    The contents of the statistics tables
+    """
+    with engine.connect() as connection:
+        return {table: sorted(connection.exec_driver_sql(f"SELECT * FROM {table}").fetchall())
+                for table in tables}
+
+
+@pytest.fixture(name="stats_engine")
+def fixture_stats_engine(tmp_path):
+    """
+    Database file with 5000 generated listings
+    """
+    db_file = str(tmp_path / "stats.db")
+    _generate(db_file, 5000, seed=5)
+    engine = create_engine(f"sqlite:///{db_file}")
+    migrations.migrate(engine)
+    yield engine
+    engine.dispose()
+
+
+class TestStatistics:
+    """
+    Testing the incremental refresh of the statistics tables.
+    """
+
+    def test_refresh(self, stats_engine): # pylint: disable=R0914
+        """
+        The statistics should describe all the listings, with the percentiles accurate up to
+        half a bucket
+        """
+        assert statistics.refresh_statistics(stats_engine, batch_size=1500) == 5000
+        assert statistics.refresh_statistics(stats_engine) == 0
+        session = sessionmaker(bind=stats_engine)()
+        stats = statistics.get_statistics(session)
+        session.close()
+        with stats_engine.connect() as connection:
+            sources = connection.exec_driver_sql(
+                "SELECT source_name, COUNT(*) FROM ads GROUP BY source_name").fetchall()
+            prices = connection.exec_driver_sql(
+                "SELECT location, home_type, price * 1.0 / home_size FROM ads").fetchall()
+            runs = connection.exec_driver_sql(
+                "SELECT first_seen_run, COUNT(*), AVG(price * 1.0 / home_size) FROM ads "
+                "GROUP BY first_seen_run ORDER BY first_seen_run DESC").fetchall()
+        assert sorted(stats["sources"]) == sorted(sources)
+        assert sum(row.listings for row in stats["market"]) == 5000
+        assert [(row.crawl_run, row.listings) for row in stats["trend"]] == \
+            [tuple(run[:2]) for run in runs]
+        assert stats["trend"][0][-1] == pytest.approx(runs[0][-1])
+        assert stats["refreshed_at"]
+
+        # Half a bucket and the rounding to whole numbers
+        tolerance = constants.STATS_BUCKET_WIDTH / 2 + 0.5
+        for location, home_type, listings, p25, median, p75 in stats["market"]:
+            values = np.array([price_per_m2 for row_location, row_type, price_per_m2 in prices
+                               if (row_location, row_type) == (location, home_type)])
+            assert len(values) == listings
+            expected = np.percentile(values, [25, 50, 75], method="inverted_cdf")
+            assert np.abs(np.array([p25, median, p75]) - expected).max() <= tolerance
+
+    def test_incremental(self, stats_engine):
+        """
+        Folding only the new listings should end with the same statistics as a rebuild
+        """
+        statistics.refresh_statistics(stats_engine)
+        _generate(stats_engine.url.database, 2000, seed=6)
+        assert statistics.refresh_statistics(stats_engine, batch_size=700) == 2000
+        incremental = _tables(stats_engine)
+        assert statistics.refresh_statistics(stats_engine, rebuild=True) == 7000
+        assert _tables(stats_engine) == incremental
+
+    def test_bucket_width_changed(self, stats_engine, monkeypatch):
+        """
+        The histogram should be rebuilt when the bucket width is configured differently
+        """
+        statistics.refresh_statistics(stats_engine)
+        monkeypatch.setattr(constants, "STATS_BUCKET_WIDTH", 100)
+        assert statistics.refresh_statistics(stats_engine) == 5000
+        buckets = _tables(stats_engine, ("stats_price_histogram",))["stats_price_histogram"]
+        assert sum(row.listings for row in buckets) == 5000
+        with stats_engine.connect() as connection:
+            assert connection.exec_driver_sql(
+                "SELECT MAX(price / home_size) / 100 FROM ads").scalar() == \
+                max(row.bucket for row in buckets)
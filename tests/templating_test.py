@@ -0,0 +1,128 @@
+"""
+Module providing testcases for the template setup and the ad cards renderer.
+"""
+# Built in or third party modules
+import os
+import sys
+from types import SimpleNamespace
+sys.path.append(os.getcwd())
+
+# Own imports
+from utils.templating import build_templates, precompile_templates # pylint: disable=C0413
+from utils.templating import CardRenderer, CARD_SEPARATOR # pylint: disable=C0413
+
+
+TEMPLATES_DIR = os.path.join(os.getcwd(), "templates")
+
+
+def _ad(ad_id, price=100000, location="Лозенец", url="https://example.com/ad"):
+    """
+    It returns an ad with the attributes used by the card template
+    """
+    return SimpleNamespace(id=ad_id, source_name="era", image="https://example.com/image.jpg",
+                           home_type="Двустаен", home_size=70, location=location, price=price,
+                           scraping_date="2023-03-05", url=url)
+
+
+class TestBuildTemplates:
+    """
+    Testing the precompiled templates and their bytecode cache.
+    """
+
+    def test_precompiled(self, tmp_path):
+        """
+        Nothing should be compiled when the templates are built, every template should be
+        compiled and its bytecode cached once they are precompiled
+        """
+        templates = build_templates(TEMPLATES_DIR)
+        assert not templates.env.auto_reload
+        assert not templates.env.cache
+        names = precompile_templates(templates, cache_dir=str(tmp_path / "cache"))
+        assert "_card.html" in names
+        assert len(templates.env.cache) == len(names)
+        assert len(os.listdir(tmp_path / "cache")) == len(names)
+        # The next process loads the bytecode instead of compiling the templates
+        again = build_templates(TEMPLATES_DIR)
+        assert precompile_templates(again, cache_dir=str(tmp_path / "cache")) == names
+        assert len(again.env.cache) == len(names)
+
+    def test_auto_reload(self, tmp_path):
+        """
+        The changed templates should be reloaded only with the auto reload switched on
+        """
+        page = tmp_path / "templates" / "page.html"
+        page.parent.mkdir()
+        page.write_text("first")
+        reloading = build_templates(str(page.parent), auto_reload=True)
+        static = build_templates(str(page.parent))
+        for templates in (reloading, static):
+            precompile_templates(templates, cache_dir=str(tmp_path / "cache"))
+        stat = os.stat(page)
+        page.write_text("second")
+        os.utime(page, (stat.st_atime, stat.st_mtime + 10))
+        assert reloading.get_template("page.html").render() == "second"
+        assert static.get_template("page.html").render() == "first"
+
+
+class TestCardRenderer:
+    """
+    Testing the rendering of the cards kept per ad id and data version.
+    """
+
+    def setup_method(self):
+        """
+        Every test starts with a renderer keeping up to 3 cards
+        """
+        templates = build_templates(TEMPLATES_DIR)
+        self.template = templates.get_template("_card.html") # pylint: disable=W0201
+        self.renderer = CardRenderer(templates.env, "_card.html", # pylint: disable=W0201
+                                     max_entries=3)
+
+    def _expected(self, ads) -> str:
+        return self.template.render(ad_list=ads).replace(CARD_SEPARATOR, "")
+
+    def test_cards_kept(self):
+        """
+        The kept cards should be reused in the order of the ads
+        """
+        ads = [_ad(1), _ad(2)]
+        first = self.renderer.render(ads, version=1)
+        assert first == self._expected(ads)
+        assert "€100,000" in first
+        assert self.renderer.render(ads[::-1], version=1) == self._expected(ads[::-1])
+        assert self.renderer.stats() == {"hits": 2, "misses": 2, "entries": 2}
+
+    def test_new_data_version(self):
+        """
+        The cards kept for an older data version should be rendered again
+        """
+        self.renderer.render([_ad(1)], version=1)
+        card = self.renderer.render([_ad(1, price=90000)], version=2)
+        assert "€90,000" in card
+        assert self.renderer.stats()["misses"] == 2
+
+    def test_unversioned_data(self):
+        """
+        The cards of data without a version should not be kept
+        """
+        self.renderer.render([_ad(1)])
+        assert self.renderer.stats() == {"hits": 0, "misses": 0, "entries": 0}
+
+    def test_bounded(self):
+        """
+        The least recently shown cards should be dropped beyond the bound
+        """
+        self.renderer.render([_ad(ad_id) for ad_id in range(5)], version=1)
+        assert self.renderer.stats()["entries"] == 3
+        self.renderer.render([_ad(4), _ad(0)], version=1)
+        assert self.renderer.stats()["hits"] == 1
+
+    def test_escaped_values(self):
+        """
+        Values looking like the separator should be escaped and not split the cards
+        """
+        ads = [_ad(1, location=f"Лозенец {CARD_SEPARATOR}"), _ad(2, url="https://x/?a=<b>")]
+        cards = self.renderer.render(ads, version=1)
+        assert cards == self._expected(ads)
+        assert CARD_SEPARATOR not in cards
+        assert "&lt;!--card--&gt;" in cards
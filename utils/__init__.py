@@ -3,3 +3,4 @@ Utility initialization module.
 """
 from .constants import *
 from .helpers import *
+from .cache import *
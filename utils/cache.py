@@ -0,0 +1,90 @@
+"""
+Module holding the in-process cache of the query results.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ["QueryCache"]
+
+
+class QueryCache: # pylint: disable=R0902
+    """
+    Thread safe LRU cache with a time to live, bounded by the amount of entries and by
+    their total weight (the amount of cached rows).
+    Every entry is stored along with the data version it was computed for, an entry
+    with a different data version is stale and gets computed again.
+    """
+
+    def __init__(self, max_entries: int, max_weight: int, ttl: float):
+        """
+        :param max_entries: the maximum amount of cached results, 0 disables the cache
+        :param max_weight: the maximum total weight of the cached results
+        :param ttl: seconds after which an entry expires even if the data did not change
+        """
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get_or_compute(self, key, version, compute, weigh=lambda value: 1):
+        """
+        It returns the cached value of the key or computes and caches it on a miss.
+        The computation runs outside of the lock, so a slow query does not block the hits.
+
+        :param key: hashable key of the result (the normalized query parameters)
+        :param version: the current data version of the database
+        :param compute: callable without arguments returning the value
+        :param weigh: callable returning the weight of the value
+        :return: the cached or the computed value.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, expires_at, _weight, value = entry
+                if entry_version == version and expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+        value = compute()
+        self._store(key, version, value, weigh(value), now + self.ttl)
+        return value
+
+    def _store(self, key, version, value, weight, expires_at):
+        if not self.max_entries or weight > self.max_weight:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (version, expires_at, weight, value)
+            self._weight += weight
+            while len(self._entries) > self.max_entries or self._weight > self.max_weight:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._weight -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """
+        It drops every cached entry, the counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def stats(self) -> dict:
+        """
+        It returns the counters and the current size of the cache.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "invalidations": self.invalidations, "entries": len(self._entries),
+                    "weight": self._weight}
@@ -0,0 +1,35 @@
+"""
+Module holding the compression middleware of the dynamic responses.
+"""
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+
+__all__ = ["CompressionMiddleware"]
+
+
+class _Responder(GZipResponder): # pylint: disable=R0903
+    """
+    GZip responder passing through the messages other than the response start and body.
+    Starlette drops them, including the template extension used by the test client.
+    """
+
+    async def send_with_gzip(self, message):
+        if message["type"] in ("http.response.start", "http.response.body"):
+            await super().send_with_gzip(message)
+        else:
+            await self.send(message)
+
+
+class CompressionMiddleware(GZipMiddleware): # pylint: disable=R0903
+    """
+    It compresses the responses bigger than minimum_size with gzip, when the client accepts it.
+    Responses that already have a Content-Encoding (the precompressed static files)
+    are sent as they are.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _Responder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
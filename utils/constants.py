@@ -5,13 +5,112 @@ import os
 import enum
 
 
-__all__ = ["STATIC_DIR", "DATA_DIR", "DATABASE",
-           "AdSource", "AdLocation", "HomeType"]
+__all__ = ["STATIC_DIR", "DATA_DIR", "DATABASE", "DB_WORKERS", "DB_MAX_OVERFLOW",
+           "SQLITE_PRAGMAS", "QUERY_CACHE_MAX_ENTRIES", "QUERY_CACHE_MAX_ROWS", "QUERY_CACHE_TTL",
+           "GZIP_MIN_SIZE", "GZIP_LEVEL", "SLOW_QUERY_MS", "ADMIN_TOKEN",
+           "PROFILE_INTERVAL_MS", "INGEST_BATCH_SIZE",
+           "INGEST_CACHE_SIZE", "STATS_BUCKET_WIDTH", "STATS_BATCH_SIZE", "ADS_PAGE_SIZE",
+           "ADS_MAX_PAGE_SIZE", "TEMPLATES_AUTO_RELOAD", "TEMPLATE_CACHE_DIR", "CARD_CACHE_SIZE",
+           "MIGRATE_ON_STARTUP", "HOST", "PORT", "WORKERS", "BACKLOG", "KEEP_ALIVE",
+           "LIMIT_CONCURRENCY", "SNAPSHOT_MODE", "SNAPSHOT_DIR", "SNAPSHOT_KEEP",
+           "SNAPSHOT_PRAGMAS", "AdSource", "AdLocation", "HomeType"]
 
 
 STATIC_DIR = os.path.join(os.getcwd(), 'static')
 DATA_DIR = os.path.join(os.getcwd(), "data")
-DATABASE = os.path.join(DATA_DIR, "listings_data.db")
+DATABASE = os.environ.get("IMOT_DATABASE",
+                          os.path.join(DATA_DIR, "listings_data.db"))
+# Size of the thread pool that runs the blocking database and export work
+DB_WORKERS = int(os.environ.get("IMOT_DB_WORKERS",
+                                min(32, (os.cpu_count() or 1) + 4)))
+# Extra connections for the requests that keep one open between the executor calls
+# (the streamed CSV exports), closed again once they are returned to the pool
+DB_MAX_OVERFLOW = int(os.environ.get("IMOT_DB_MAX_OVERFLOW", 2 * DB_WORKERS))
+# SQLite connection profile applied to every new connection.
+# Every value can be overridden with the IMOT_SQLITE_<NAME> environment variable.
+_SQLITE_PRAGMA_DEFAULTS = {
+    # readers and the crawler writing the same file do not block each other
+    "journal_mode": "WAL",
+    # in WAL mode the database stays consistent, only the last commits may be lost on power loss
+    "synchronous": "NORMAL",
+    # 256 MiB, reads are served from the OS page cache shared by all the connections
+    "mmap_size": 268435456,
+    # negative values are in KiB: 16 MiB of page cache per connection
+    "cache_size": -16384,
+    "temp_store": "MEMORY",
+    # milliseconds to wait for a lock held by the writer before failing
+    "busy_timeout": 5000,
+}
+SQLITE_PRAGMAS = {name: os.environ.get(f"IMOT_SQLITE_{name.upper()}", str(default))
+                  for name, default in _SQLITE_PRAGMA_DEFAULTS.items()}
+# Bounds of the in-process cache of the ads query results, 0 entries disable the cache
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("IMOT_QUERY_CACHE_MAX_ENTRIES", 512))
+# Total amount of cached ads, keeps the memory used by the cache bounded
+QUERY_CACHE_MAX_ROWS = int(os.environ.get("IMOT_QUERY_CACHE_MAX_ROWS", 50000))
+# Seconds after which a cached result is read again even without new data
+QUERY_CACHE_TTL = float(os.environ.get("IMOT_QUERY_CACHE_TTL", 600))
+# Dynamic responses smaller than this amount of bytes are sent uncompressed
+GZIP_MIN_SIZE = int(os.environ.get("IMOT_GZIP_MIN_SIZE", 1024))
+# Level 6 compresses the repeated HTML and CSV markup almost as well as 9 at a fraction of the cost
+GZIP_LEVEL = int(os.environ.get("IMOT_GZIP_LEVEL", 6))
+# Crud queries slower than this amount of milliseconds are logged with their query plan,
+# a negative value disables the slow query log
+SLOW_QUERY_MS = float(os.environ.get("IMOT_SLOW_QUERY_MS", 250))
+# Token of the admin only features (profiling of single requests, the crawler ingest),
+# disabled when not set
+ADMIN_TOKEN = os.environ.get("IMOT_ADMIN_TOKEN")
+# Interval between the stack samples of the request profiler
+PROFILE_INTERVAL_MS = float(os.environ.get("IMOT_PROFILE_INTERVAL_MS", 1))
+# Lines of the ingest body upserted per transaction. Bigger batches amortize the commits,
+# the readers are not blocked by the write transactions in WAL mode.
+INGEST_BATCH_SIZE = int(os.environ.get("IMOT_INGEST_BATCH_SIZE", 20000))
+# Page cache of the connection writing an ingest batch, negative values are in KiB: 256 MiB
+INGEST_CACHE_SIZE = int(os.environ.get("IMOT_INGEST_CACHE_SIZE", -262144))
+# Width of the price per square meter buckets of the statistics, the percentiles shown on the
+# data page are accurate up to half of it
+STATS_BUCKET_WIDTH = int(os.environ.get("IMOT_STATS_BUCKET_WIDTH", 25))
+# Listings folded into the statistics per transaction when they are refreshed
+STATS_BATCH_SIZE = int(os.environ.get("IMOT_STATS_BATCH_SIZE", 100000))
+# Cards rendered by the first chunk of the ads pages and by every fragment loaded on scroll,
+# the limit query parameter is capped at the maximum, so the render time stays bounded
+ADS_PAGE_SIZE = int(os.environ.get("IMOT_ADS_PAGE_SIZE", 48))
+ADS_MAX_PAGE_SIZE = int(os.environ.get("IMOT_ADS_MAX_PAGE_SIZE", 100))
+# Check the templates for changes on every use, only worth it while developing them
+TEMPLATES_AUTO_RELOAD = os.environ.get("IMOT_TEMPLATES_AUTO_RELOAD", "0").lower() in ("1", "true")
+# Directory of the compiled templates shared by the processes, a temporary one when not set
+TEMPLATE_CACHE_DIR = os.environ.get("IMOT_TEMPLATE_CACHE_DIR")
+# Rendered ad cards kept for the next pages showing the same ads, 0 disables keeping them
+CARD_CACHE_SIZE = int(os.environ.get("IMOT_CARD_CACHE_SIZE", 10000))
+# Upgrade the database when the app starts, off when the migrations are run separately
+# (python -m db_utils.migrations) or by the server before starting its workers
+MIGRATE_ON_STARTUP = os.environ.get("IMOT_MIGRATE_ON_STARTUP", "1").lower() in ("1", "true")
+# Settings of the production server (python app.py), the command line options override them
+HOST = os.environ.get("IMOT_HOST", "127.0.0.1")
+PORT = int(os.environ.get("IMOT_PORT", 8000))
+# Worker processes, each one with its own event loop, thread pool and caches
+WORKERS = int(os.environ.get("IMOT_WORKERS", os.cpu_count() or 1))
+# Connections waiting to be accepted by the workers
+BACKLOG = int(os.environ.get("IMOT_BACKLOG", 2048))
+# Seconds an idle keep-alive connection stays open
+KEEP_ALIVE = int(os.environ.get("IMOT_KEEP_ALIVE", 5))
+# Connections and tasks per worker above which the requests get 503, unlimited when not set
+LIMIT_CONCURRENCY = int(os.environ["IMOT_LIMIT_CONCURRENCY"]) \
+    if os.environ.get("IMOT_LIMIT_CONCURRENCY") else None
+# Serve the reads from a read-only snapshot of the database taken after every crawl run,
+# the live database is then only used by the ingest
+SNAPSHOT_MODE = os.environ.get("IMOT_SNAPSHOT_MODE", "0").lower() in ("1", "true")
+# Directory of the snapshots and of the pointer to the published one
+SNAPSHOT_DIR = os.environ.get("IMOT_SNAPSHOT_DIR", os.path.join(DATA_DIR, "snapshots"))
+# Snapshots kept on disk, the previous one still serves the requests started before the switch
+SNAPSHOT_KEEP = int(os.environ.get("IMOT_SNAPSHOT_KEEP", 2))
+# Connection profile of the snapshots. They are never written, so they have no journal and
+# no locks to set up and the whole file can be memory mapped (1 GiB by default).
+SNAPSHOT_PRAGMAS = {
+    "mmap_size": os.environ.get("IMOT_SNAPSHOT_MMAP_SIZE", "1073741824"),
+    "cache_size": SQLITE_PRAGMAS["cache_size"],
+    "temp_store": SQLITE_PRAGMAS["temp_store"],
+    "query_only": "1",
+}
 
 
 class AdSource(enum.Enum):
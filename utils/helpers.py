@@ -1,10 +1,18 @@
 """
 Modulel holding utility helper functions.
 """
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+import json
 import os
 from . import constants
 
-__all__ = ["create_db_folder"]
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+__all__ = ["create_db_folder", "dump_json", "build_etag", "http_date", "is_not_modified"]
 
 
 def create_db_folder():
@@ -13,3 +21,60 @@ def create_db_folder():
     """
     if not os.path.exists(constants.DATA_DIR):
         os.mkdir(constants.DATA_DIR)
+
+
+def dump_json(data) -> bytes:
+    """
+    Serialize the data to UTF-8 encoded JSON, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data) # pylint: disable=E1101
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def build_etag(*parts) -> str:
+    """
+    Build a weak entity tag out of the values the response depends on.
+    Weak, because the body may be sent compressed or not.
+    """
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def http_date(timestamp: float) -> str:
+    """
+    Format the timestamp as a HTTP date, as used by the Last-Modified header.
+    """
+    return formatdate(timestamp, usegmt=True)
+
+
+def _opaque_tag(tag: str) -> str:
+    """
+    Strip the weakness indicator of the entity tag.
+    """
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def is_not_modified(headers, etag: str, last_modified: float) -> bool:
+    """
+    Check the conditional request headers against the current validators of the response.
+    If-None-Match takes precedence over If-Modified-Since.
+    Params:
+    headers: the request headers
+    etag: the current entity tag of the response
+    last_modified: timestamp of the last change of the data
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, the W/ prefix is ignored
+        tags = {_opaque_tag(tag.strip()) for tag in if_none_match.split(",")}
+        return "*" in tags or _opaque_tag(etag) in tags
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have a resolution of one second
+    return int(last_modified) <= since
@@ -0,0 +1,176 @@
+"""
+Module parsing and validating the listings sent by the crawler to the ingest endpoint.
+
+The body is NDJSON (one JSON object per line) or CSV with a header line, one listing per line.
+Every line is parsed and validated in a single pass, the invalid ones are rejected with
+the reason and the valid ones are returned as rows ready to be upserted.
+"""
+import csv
+import json
+
+from . import constants
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+__all__ = ["AdParser", "validate_ad", "iter_line_batches", "INGEST_FORMATS"]
+
+
+# Content types accepted by the ingest endpoint and the format of their body
+INGEST_FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/json": "ndjson",
+    "text/csv": "csv",
+}
+# Only the first rejected lines are reported back, the rest is only counted
+MAX_REPORTED_ERRORS = 100
+_SOURCES = frozenset(source.value for source in constants.AdSource)
+_LOCATIONS = frozenset(location.value for location in constants.AdLocation)
+_HOME_TYPES = frozenset(home_type.value for home_type in constants.HomeType)
+_loads = orjson.loads if orjson is not None else json.loads # pylint: disable=E1101
+
+
+def _positive_int(record, name) -> int:
+    value = record.get(name)
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ValueError(f"{name} must be a positive integer, got {value!r}")
+    return value
+
+
+def _member(record, name, allowed) -> str:
+    value = record.get(name)
+    if value not in allowed:
+        raise ValueError(f"Unknown {name}: {value!r}")
+    return value
+
+
+def _text(record, name) -> str:
+    value = record.get(name)
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ValueError(f"{name} must be a string, got {value!r}")
+    return value
+
+
+def validate_ad(record) -> tuple:
+    """
+    It checks the listing against the known sources, locations and home types and returns its
+    values in the order of crud.INGEST_COLUMNS. Raises ValueError for an invalid listing.
+
+    :param record: dictionary with the values of the listing
+    """
+    url = record.get("url")
+    if not isinstance(url, str) or not url.startswith(("https://", "http://")):
+        raise ValueError(f"url must be an absolute http(s) URL, got {url!r}")
+    return (_member(record, "source_name", _SOURCES),
+            url,
+            _positive_int(record, "price"),
+            _member(record, "home_type", _HOME_TYPES),
+            _positive_int(record, "home_size"),
+            _member(record, "location", _LOCATIONS),
+            _text(record, "image"),
+            _text(record, "scraping_date"))
+
+
+class AdParser: # pylint: disable=R0903
+    """
+    Stateful parser of the lines of an ingest body, they have to be passed in their order.
+    It keeps the CSV header, the line numbers and the rejected lines.
+    """
+
+    def __init__(self, content_format: str, header_aliases=None):
+        """
+        :param content_format: "ndjson" or "csv"
+        :param header_aliases: column names of the CSV header labels, like the ones of the export
+        """
+        self.format = content_format
+        self.header_aliases = header_aliases or {}
+        self.line_number = 0
+        self.rejected = 0
+        self.errors = []
+        self._header = None
+
+    def _reject(self, line_number, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_number, "error": reason})
+
+    def _records(self, lines):
+        """
+        It yields the line number and the dictionary of every non empty line
+        """
+        for raw_line in lines:
+            self.line_number += 1
+            try:
+                line = raw_line.decode("utf-8")
+            except UnicodeDecodeError:
+                self._reject(self.line_number, "The line is not valid UTF-8")
+                continue
+            if not line.strip():
+                continue
+            if self.format == "ndjson":
+                try:
+                    record = _loads(line)
+                except ValueError:
+                    self._reject(self.line_number, "The line is not valid JSON")
+                    continue
+            else:
+                # A non empty line is always a row, the default only keeps the generator safe
+                values = next(csv.reader([line]), [])
+                if self._header is None:
+                    self._header = [self.header_aliases.get(name.strip(), name.strip())
+                                    for name in values]
+                    continue
+                if len(values) != len(self._header):
+                    self._reject(self.line_number,
+                                 f"Expected {len(self._header)} values, got {len(values)}")
+                    continue
+                record = dict(zip(self._header, values))
+            if not isinstance(record, dict):
+                self._reject(self.line_number, "The line is not a JSON object")
+                continue
+            yield self.line_number, record
+
+    def parse(self, lines) -> list:
+        """
+        It returns the rows of the valid listings of the lines, the invalid ones are rejected.
+
+        :param lines: the lines of the body as bytes, without the line endings
+        """
+        rows = []
+        for line_number, record in self._records(lines):
+            try:
+                rows.append(validate_ad(record))
+            except ValueError as exc:
+                self._reject(line_number, str(exc))
+        return rows
+
+
+async def iter_line_batches(chunks, batch_size: int):
+    """
+    It splits the streamed body into batches of lines.
+
+    :param chunks: async iterator of the body chunks
+    :param batch_size: the amount of lines per batch, the last batch may be smaller
+    """
+    remainder = b""
+    lines = []
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        parts = (remainder + chunk).split(b"\n")
+        remainder = parts.pop()
+        lines.extend(part.rstrip(b"\r") for part in parts)
+        while len(lines) >= batch_size:
+            yield lines[:batch_size]
+            lines = lines[batch_size:]
+    if remainder:
+        lines.append(remainder.rstrip(b"\r"))
+    if lines:
+        yield lines
@@ -0,0 +1,232 @@
+"""
+Module holding the per request instrumentation and the metrics of the app.
+
+Every request gets a RequestStats object in a context variable. The database hooks and the
+phases of the endpoints add their timings to it, the middleware sends them to the client
+as a Server-Timing header and aggregates them in the Prometheus metrics served on /metrics.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ["RequestStats", "current_stats", "phase", "query_phase", "record_query",
+           "record_rows", "InstrumentationMiddleware", "Metrics", "METRICS"]
+
+
+PHASES = ("db", "hydrate", "render", "serialize")
+# Query parameters that make the filter shape of a request
+FILTER_PARAMS = ("source_name", "price", "location", "home_size", "home_type",
+                 "location_search", "min_price", "max_price", "min_size", "max_size",
+                 "min_price_per_m2", "max_price_per_m2")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestStats: # pylint: disable=R0903
+    """
+    Timings of the phases of a single request, the amount of queries and of fetched rows.
+    """
+    __slots__ = ("phases", "queries", "rows")
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.rows = 0
+
+    def server_timing(self, total: float) -> str:
+        """
+        It returns the value of the Server-Timing header, the durations are in milliseconds
+        """
+        metrics = [f'db;dur={self.phases["db"] * 1000:.3f};'
+                   f'desc="{self.queries} queries, {self.rows} rows"']
+        metrics += [f"{name};dur={seconds * 1000:.3f}"
+                    for name, seconds in self.phases.items() if name != "db" and seconds]
+        metrics.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(metrics)
+
+
+_CURRENT_STATS = contextvars.ContextVar("imot_request_stats", default=None)
+
+
+def current_stats():
+    """
+    It returns the stats of the request being handled or None outside of a request
+    """
+    return _CURRENT_STATS.get()
+
+
+@contextmanager
+def phase(name: str):
+    """
+    It adds the time spent in the block to the phase of the current request.
+    """
+    stats = _CURRENT_STATS.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[name] += time.perf_counter() - start
+
+
+@contextmanager
+def query_phase():
+    """
+    It splits the time spent in the block running a query between the database (the time
+    of the statement executions, recorded by the engine hooks) and the hydration (fetching
+    the rows and building the objects out of them).
+    """
+    stats = _CURRENT_STATS.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    db_before = stats.phases["db"]
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.phases["hydrate"] += max(elapsed - (stats.phases["db"] - db_before), 0.0)
+
+
+def record_query(duration: float):
+    """
+    It records an executed statement in the stats of the current request
+    """
+    stats = _CURRENT_STATS.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.phases["db"] += duration
+
+
+def record_rows(amount: int):
+    """
+    It records the amount of rows fetched for the current request
+    """
+    stats = _CURRENT_STATS.get()
+    if stats is not None:
+        stats.rows += amount
+
+
+def filter_shape(query_string: bytes) -> str:
+    """
+    It returns the names of the filters used by the request, ex. "location+price"
+    """
+    names = {item.split(b"=", 1)[0].decode("latin-1") for item in query_string.split(b"&")}
+    return "+".join(name for name in FILTER_PARAMS if name in names) or "none"
+
+
+class Metrics:
+    """
+    Thread safe registry of the aggregated request metrics, rendered in the Prometheus
+    text exposition format.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (route, filter shape) -> [bucket counts..., sum, count]
+        self._latency = {}
+        # route -> {phase: seconds, "queries": amount, "rows": amount}
+        self._totals = {}
+
+    def observe(self, route: str, shape: str, duration: float, stats: RequestStats):
+        """
+        It records a finished request
+        """
+        index = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            latency = self._latency.get((route, shape))
+            if latency is None:
+                latency = self._latency[(route, shape)] = [0] * (len(self.buckets) + 3)
+            latency[index] += 1
+            latency[-2] += duration
+            latency[-1] += 1
+            totals = self._totals.get(route)
+            if totals is None:
+                totals = self._totals[route] = dict.fromkeys(PHASES + ("queries", "rows"), 0)
+            for name, seconds in stats.phases.items():
+                totals[name] += seconds
+            totals["queries"] += stats.queries
+            totals["rows"] += stats.rows
+
+    def render(self, extra_metrics=()) -> str: # pylint: disable=R0914
+        """
+        It returns the metrics in the Prometheus text format.
+
+        :param extra_metrics: (name, type, value) of other metrics, like the cache counters
+        """
+        with self._lock:
+            latency = {key: list(values) for key, values in self._latency.items()}
+            totals = {route: dict(values) for route, values in self._totals.items()}
+        lines = ["# HELP imot_request_duration_seconds Latency of the requests.",
+                 "# TYPE imot_request_duration_seconds histogram"]
+        for (route, shape), values in sorted(latency.items()):
+            labels = f'route="{_escape(route)}",filter_shape="{shape}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f'imot_request_duration_seconds_bucket{{{labels},le="{bound}"}}'
+                             f" {cumulative}")
+            lines.append(f"imot_request_duration_seconds_sum{{{labels}}} {values[-2]}")
+            lines.append(f"imot_request_duration_seconds_count{{{labels}}} {values[-1]}")
+        lines += ["# HELP imot_request_phase_seconds_total Time spent per phase of the requests.",
+                  "# TYPE imot_request_phase_seconds_total counter"]
+        for route, values in sorted(totals.items()):
+            for name in PHASES:
+                lines.append(f'imot_request_phase_seconds_total{{route="{_escape(route)}",'
+                             f'phase="{name}"}} {values[name]}')
+        for name, help_text in (("queries", "Statements executed by the requests."),
+                                ("rows", "Rows fetched by the requests.")):
+            lines += [f"# HELP imot_db_{name}_total {help_text}",
+                      f"# TYPE imot_db_{name}_total counter"]
+            for route, values in sorted(totals.items()):
+                lines.append(f'imot_db_{name}_total{{route="{_escape(route)}"}} {values[name]}')
+        for name, metric_type, value in extra_metrics:
+            lines += [f"# TYPE {name} {metric_type}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+METRICS = Metrics()
+
+
+class InstrumentationMiddleware: # pylint: disable=R0903
+    """
+    Pure ASGI middleware measuring every HTTP request. It adds the Server-Timing header to the
+    response and records the request in the metrics once the whole body was sent.
+    """
+
+    def __init__(self, app, metrics=METRICS):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = _CURRENT_STATS.set(stats)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timing = stats.server_timing(time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", timing.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _CURRENT_STATS.reset(token)
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or scope.get("root_path") or "unmatched"
+            self.metrics.observe(route_path, filter_shape(scope.get("query_string", b"")),
+                                 time.perf_counter() - start, stats)
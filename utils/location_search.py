@@ -0,0 +1,152 @@
+"""
+Module matching free text against the known locations.
+
+The locations are a small fixed set, so they are indexed in memory by their trigrams, once.
+Both their Bulgarian names and the Latin names of the AdLocation members are indexed and
+the Latin queries are also transliterated to Cyrillic, so "mladost", "lyulin 3" and
+"Младост" all find their locations. A query matches a location exactly, as a prefix of
+its name or, to tolerate the typos, by the similarity of their trigrams.
+"""
+import functools
+import re
+from collections import defaultdict
+
+from . import constants
+
+__all__ = ["LocationIndex", "location_index", "transliterate"]
+
+
+# Bulgarian streamlined system, read backwards. The longer sequences are matched first.
+_LATIN_TO_CYRILLIC = {
+    "sht": "щ", "zh": "ж", "ch": "ч", "sh": "ш", "ts": "ц", "yu": "ю", "ya": "я",
+    "a": "а", "b": "б", "c": "ц", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х",
+    "i": "и", "j": "ж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п",
+    "q": "к", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс",
+    "y": "й", "z": "з",
+}
+_LATIN_RE = re.compile("|".join(sorted(_LATIN_TO_CYRILLIC, key=len, reverse=True)))
+_SEPARATORS_RE = re.compile(r"[\W_]+")
+# Scores of the kinds of matches, a prefix always ranks above a fuzzy match
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.75
+# Minimal trigram similarity of a fuzzy match
+MIN_SIMILARITY = 0.3
+
+
+def _normalize(text: str) -> str:
+    """
+    It returns the lower case words of the text separated by single spaces
+    """
+    return " ".join(_SEPARATORS_RE.sub(" ", text.lower()).split())
+
+
+def transliterate(text: str) -> str:
+    """
+    It returns the normalized text with its Latin letters replaced by Cyrillic ones
+    """
+    return _LATIN_RE.sub(lambda match: _LATIN_TO_CYRILLIC[match.group()], _normalize(text))
+
+
+def _trigrams(text: str) -> frozenset:
+    """
+    It returns the trigrams of the words of the text, padded like the ones of pg_trgm,
+    so the beginnings of the words weigh more
+    """
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[start:start + 3] for start in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+class LocationIndex:
+    """
+    Trigram index of the location names and of their Latin aliases.
+    """
+
+    def __init__(self, locations):
+        """
+        :param locations: iterable of AdLocation members
+        """
+        # Every key is (location, normalized text, trigrams), the Cyrillic keys are
+        # transliterated too, so the Latin letters in names like "Младост 1A" match
+        self._keys = []
+        self._trigram_index = defaultdict(list)
+        for location in locations:
+            self._add(location.value, transliterate(location.value))
+            self._add(location.value, _normalize(location.name))
+
+    def _add(self, location: str, text: str):
+        key_id = len(self._keys)
+        grams = _trigrams(text)
+        self._keys.append((location, text, grams))
+        for gram in grams:
+            self._trigram_index[gram].append(key_id)
+
+    def _scores(self, query: str) -> dict:
+        """
+        It returns the best score of every location matching the query
+        """
+        scores = {}
+        # Both spellings once, in a fixed order
+        for text in dict.fromkeys((_normalize(query), transliterate(query))):
+            if not text:
+                continue
+            grams = _trigrams(text)
+            common = defaultdict(int)
+            for gram in grams:
+                for key_id in self._trigram_index.get(gram, ()):
+                    common[key_id] += 1
+            for key_id, shared in common.items():
+                location, key, key_grams = self._keys[key_id]
+                if key == text:
+                    score = EXACT_SCORE
+                elif key.startswith(text):
+                    # The longer the typed part, the closer to an exact match
+                    score = PREFIX_SCORE + (EXACT_SCORE - PREFIX_SCORE) * len(text) / len(key) / 2
+                else:
+                    # Jaccard similarity of the trigrams
+                    score = shared / (len(grams) + len(key_grams) - shared)
+                    if score < MIN_SIMILARITY:
+                        continue
+                    score *= PREFIX_SCORE
+                scores[location] = max(score, scores.get(location, 0))
+        return scores
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        It returns up to limit (location, score) pairs matching the query, the best first.
+
+        :param query: free text, in Cyrillic or Latin letters
+        :param limit: the maximum amount of locations returned
+        """
+        ranked = sorted(self._scores(query).items(), key=lambda item: (-item[1], item[0]))
+        return [(location, round(score, 3)) for location, score in ranked[:limit]]
+
+    def resolve(self, query: str) -> tuple:
+        """
+        It returns the locations a filter typed as free text stands for: the exactly matching
+        location, else every location the text is a prefix of ("Младост" stands for all of
+        them), else the most similar ones. The tuple is empty when nothing matches.
+
+        :param query: free text, in Cyrillic or Latin letters
+        """
+        scores = self._scores(query)
+        if not scores:
+            return ()
+        best = max(scores.values())
+        if best == EXACT_SCORE:
+            matches = [location for location, score in scores.items() if score == EXACT_SCORE]
+        elif best >= PREFIX_SCORE:
+            matches = [location for location, score in scores.items() if score >= PREFIX_SCORE]
+        else:
+            matches = [location for location, score in scores.items() if score == best]
+        return tuple(sorted(matches))
+
+
+@functools.lru_cache(maxsize=None)
+def location_index() -> LocationIndex:
+    """
+    It returns the index of the AdLocation values, built on the first search
+    """
+    return LocationIndex(constants.AdLocation)
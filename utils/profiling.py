@@ -0,0 +1,173 @@
+"""
+Module providing the on-demand sampling profiler of single requests.
+
+An admin adds `__profile=1` to the query of a request and sends the admin token in the
+X-Admin-Token header. The request is handled as usual, but instead of its response the
+client gets the CPU profile of the work done for it in the database thread pool
+(the queries, the template rendering, the CSV building) in the collapsed stack format,
+ready for flamegraph.pl or speedscope.
+"""
+import collections
+import contextvars
+import hmac
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlencode
+
+__all__ = ["SamplingProfiler", "ProfilingMiddleware", "current_profiler", "PROFILE_PARAM"]
+
+
+PROFILE_PARAM = "__profile"
+ADMIN_TOKEN_HEADER = b"x-admin-token"
+_CURRENT_PROFILER = contextvars.ContextVar("imot_profiler", default=None)
+
+
+def current_profiler():
+    """
+    It returns the profiler of the request being handled or None when it is not profiled
+    """
+    return _CURRENT_PROFILER.get()
+
+
+class SamplingProfiler: # pylint: disable=R0902
+    """
+    It samples the call stacks of the threads working for the profiled request at a fixed
+    interval from a background thread, without tracing every call like cProfile does.
+    """
+
+    def __init__(self, interval: float = 0.001):
+        """
+        :param interval: seconds between two samples
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._threads = collections.Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="imot-profiler", daemon=True)
+        self._started_at = self._stopped_at = None
+
+    def start(self):
+        """
+        It starts sampling
+        """
+        self._started_at = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        """
+        It stops sampling and waits for the sampler thread
+        """
+        self._stopped.set()
+        self._sampler.join()
+        self._stopped_at = time.perf_counter()
+
+    @contextmanager
+    def track_current_thread(self):
+        """
+        The current thread is sampled while the block runs
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._threads[thread_id] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[thread_id] -= 1
+                if not self._threads[thread_id]:
+                    del self._threads[thread_id]
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                thread_ids = list(self._threads)
+            if not thread_ids:
+                continue
+            frames = sys._current_frames() # pylint: disable=W0212
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.stacks[_stack_of(frame)] += 1
+                    self.samples += 1
+
+    def collapsed(self) -> str:
+        """
+        It returns the samples in the collapsed stack format, the most frequent stacks first
+        """
+        duration = (self._stopped_at or time.perf_counter()) - (self._started_at or 0)
+        lines = [f"# {self.samples} samples every {self.interval * 1000:g} ms "
+                 f"in {duration * 1000:.1f} ms"]
+        lines += [f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+
+def _stack_of(frame) -> tuple:
+    """
+    It returns the frames of the stack from the outermost one, as "function (file:line)"
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+class ProfilingMiddleware: # pylint: disable=R0903
+    """
+    Pure ASGI middleware profiling the requests with the profile query parameter.
+    Only the clients sending the admin token may profile, the other ones get 403.
+    When no admin token is configured the profiling is disabled.
+    """
+
+    def __init__(self, app, admin_token=None, interval: float = 0.001):
+        self.app = app
+        self.admin_token = admin_token
+        self.interval = interval
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or PROFILE_PARAM.encode() not in scope["query_string"]:
+            await self.app(scope, receive, send)
+            return
+        query = parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        if not any(name == PROFILE_PARAM for name, _ in query):
+            await self.app(scope, receive, send)
+            return
+        # Compared as bytes, like by the admin endpoints, any header value can be compared
+        token = dict(scope["headers"]).get(ADMIN_TOKEN_HEADER, b"")
+        if not self.admin_token or not hmac.compare_digest(token, self.admin_token.encode()):
+            await _send_text(send, 403, "Profiling needs a valid admin token\n")
+            return
+        # The profiled request is handled without the profile parameter
+        scope = dict(scope, query_string=urlencode(
+            [(name, value) for name, value in query if name != PROFILE_PARAM]).encode())
+        profiler = SamplingProfiler(self.interval)
+        status = {}
+
+        async def discard_response(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+
+        token = _CURRENT_PROFILER.set(profiler)
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard_response)
+        finally:
+            profiler.stop()
+            _CURRENT_PROFILER.reset(token)
+        await _send_text(send, 200, f"# response status {status.get('code')}\n"
+                         + profiler.collapsed())
+
+
+async def _send_text(send, status_code, text):
+    body = text.encode()
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                            (b"content-length", str(len(body)).encode()),
+                            (b"cache-control", b"no-store")]})
+    await send({"type": "http.response.body", "body": body})
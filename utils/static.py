@@ -0,0 +1,148 @@
+"""
+Module serving the static files precompressed and with content hashed URLs.
+
+The compressed variants are built once with: python -m utils.static
+"""
+import gzip
+import hashlib
+import os
+from mimetypes import guess_type
+
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional, gzip is always built
+    brotli = None
+
+__all__ = ["PrecompressedStaticFiles", "precompress_directory"]
+
+
+# Compressed variants in the order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSED_SUFFIXES = tuple(suffix for _, suffix in ENCODINGS)
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _accepted_encodings(headers) -> set:
+    """
+    It returns the content codings accepted by the client, ignoring the ones with q=0
+    """
+    accepted = set()
+    for token in headers.get("accept-encoding", "").split(","):
+        coding, _, params = token.partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Static files that are served from the .br or .gz variant built next to them when the
+    client accepts it. URLs built with `url` carry the hash of the file content, so they
+    can be cached by the browsers forever, every change of the file changes the URL.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hashes = {}
+
+    def content_hash(self, path: str) -> str:
+        """
+        It returns the short hash of the content of the static file, computed once per change.
+
+        :param path: the path of the file within the static directory
+        """
+        full_path, stat_result = self.lookup_path(path)
+        if stat_result is None:
+            return ""
+        return self._file_hash(full_path, stat_result)
+
+    def _file_hash(self, full_path, stat_result):
+        key = (full_path, stat_result.st_mtime_ns, stat_result.st_size)
+        if key not in self._hashes:
+            with open(full_path, "rb") as static_file:
+                self._hashes[key] = hashlib.sha256(static_file.read()).hexdigest()[:12]
+        return self._hashes[key]
+
+    def url(self, request, path: str) -> str:
+        """
+        It returns the URL of the static file with the content hash as a query parameter
+        """
+        return f"{request.url_for('static', path=path)}?v={self.content_hash(path)}"
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        media_type = guess_type(str(full_path))[0] or "text/plain"
+        accepted = _accepted_encodings(request_headers)
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                variant_stat = os.stat(f"{full_path}{suffix}")
+            except OSError:
+                continue
+            if variant_stat.st_mtime < stat_result.st_mtime:
+                # Built for an older version of the file
+                continue
+            response = FileResponse(f"{full_path}{suffix}", status_code=status_code,
+                                    stat_result=variant_stat, method=scope["method"],
+                                    media_type=media_type)
+            response.headers["Content-Encoding"] = encoding
+            break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code,
+                                    stat_result=stat_result, method=scope["method"],
+                                    media_type=media_type)
+        response.headers.add_vary_header("Accept-Encoding")
+        version = QueryParams(scope.get("query_string", b"")).get("v")
+        if version == self._file_hash(full_path, stat_result):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def precompress_directory(directory: str) -> list:
+    """
+    It writes the .gz (and .br when brotli is installed) variant of every file in the
+    directory that is big enough and does not have an up to date variant yet.
+
+    :param directory: the static files directory
+    :return: the list of the written files.
+    """
+    variants = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = lambda data: brotli.compress(data, quality=11)
+    written = []
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            full_path = os.path.join(root, name)
+            if name.endswith(COMPRESSED_SUFFIXES) or \
+                    os.path.getsize(full_path) < MIN_COMPRESS_SIZE:
+                continue
+            with open(full_path, "rb") as static_file:
+                content = static_file.read()
+            for suffix, compress in variants.items():
+                target = f"{full_path}{suffix}"
+                if os.path.exists(target) and \
+                        os.path.getmtime(target) >= os.path.getmtime(full_path):
+                    continue
+                with open(target, "wb") as compressed_file:
+                    compressed_file.write(compress(content))
+                written.append(target)
+    return written
+
+
+if __name__ == "__main__":
+    from utils import constants
+    for written_file in precompress_directory(constants.STATIC_DIR):
+        print(f"{written_file}: {os.path.getsize(written_file)} bytes")
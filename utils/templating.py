@@ -0,0 +1,126 @@
+"""
+Module setting up the Jinja templates and rendering the ad cards.
+
+The templates are compiled once when the app starts, their bytecode is cached on disk for the
+next processes and they are not checked for changes unless the auto reload is switched on.
+The cards are the bulk of the ads pages, every rendered card is kept per ad id and data
+version, so only the cards of the ads not shown since the last change are rendered.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import jinja2
+from fastapi.templating import Jinja2Templates
+from markupsafe import Markup
+
+__all__ = ["build_templates", "precompile_templates", "CardRenderer", "CARD_SEPARATOR"]
+
+
+# Every card of the card template starts with it. The values in the cards are escaped,
+# so they cannot contain it and the rendered cards are split on it.
+CARD_SEPARATOR = "<!--card-->"
+
+
+def build_templates(directory: str, auto_reload: bool = False):
+    """
+    It returns the templates of the directory, compiled on their first use.
+
+    :param directory: the directory of the templates
+    :param auto_reload: whether the templates are checked for changes on every use
+    """
+    return Jinja2Templates(directory, auto_reload=auto_reload)
+
+
+def precompile_templates(templates, cache_dir=None) -> list:
+    """
+    It compiles all the templates, so the first requests do not have to. The bytecode is
+    cached on disk from now on and loaded from there by the next processes.
+    Returns the names of the templates.
+
+    :param templates: the templates built by build_templates
+    :param cache_dir: the directory of the compiled bytecode, a temporary one by default
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    templates.env.bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    names = templates.env.list_templates()
+    for name in names:
+        templates.env.get_template(name)
+    return names
+
+
+class CardRenderer:
+    """
+    Thread safe renderer of the cards of the ads, keeping the last rendered cards.
+    A card is rendered again when the data version changed since it was kept.
+    """
+
+    def __init__(self, environment, template_name: str, max_entries: int):
+        """
+        :param environment: the Jinja environment of the card template
+        :param template_name: the card template, rendering a card per ad of ad_list
+        :param max_entries: the maximum amount of kept cards, 0 disables keeping them
+        """
+        self.environment = environment
+        self.template_name = template_name
+        self.max_entries = max_entries
+        self._cards = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _render_all(self, ads) -> list:
+        """
+        It renders the cards of the ads in a single pass of the template
+        """
+        if not ads:
+            return []
+        # Looked up on every use, it is reloaded when it changed and the auto reload is on
+        template = self.environment.get_template(self.template_name)
+        return template.render(ad_list=ads).split(CARD_SEPARATOR)[1:]
+
+    def render(self, ads, version=None) -> Markup:
+        """
+        It returns the HTML of the cards of the ads, in their order.
+
+        :param ads: the ads, with an id attribute
+        :param version: the data version of the database the ads were read from,
+                        the cards of unversioned data are not kept
+        """
+        if version is None or not self.max_entries:
+            return Markup("".join(self._render_all(ads)))
+        cards = [None] * len(ads)
+        missing = []
+        with self._lock:
+            for position, ad in enumerate(ads):
+                entry = self._cards.get(ad.id)
+                if entry is not None and entry[0] == version:
+                    self._cards.move_to_end(ad.id)
+                    cards[position] = entry[1]
+                else:
+                    missing.append(position)
+            self.hits += len(ads) - len(missing)
+            self.misses += len(missing)
+        rendered = self._render_all([ads[position] for position in missing])
+        with self._lock:
+            for position, card in zip(missing, rendered):
+                cards[position] = card
+                self._cards[ads[position].id] = (version, card)
+                self._cards.move_to_end(ads[position].id)
+            while len(self._cards) > self.max_entries:
+                self._cards.popitem(last=False)
+        return Markup("".join(cards))
+
+    def stats(self) -> dict:
+        """
+        It returns the counters and the current amount of kept cards
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._cards)}
+
+    def clear(self):
+        """
+        It drops the kept cards
+        """
+        with self._lock:
+            self._cards.clear()